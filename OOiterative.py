@@ -1,14 +1,18 @@
 import csv
 import sys
 import operator
-import copy
-from scipy import log, cosh, tanh, exp, floor
+from numpy import log, cosh, tanh, exp, floor
 import numpy as np
 from fractions import Fraction
-from scipy.optimize import bisect
+import time
+import instrument
 import datetime as dt
+from regression import ConvergenceError, SolverDiagnostics
+from OOranking import InitialPowers
 
 day = dt.timedelta(1)
+scaling_factor = 100
+Kfactor = 30
 
 def str2dt(date_as_string):
 	#expects date in the form YYYYMMDD
@@ -110,6 +114,13 @@ class Ranking:
 		self.games = []
 		self.teams = {}
 		self.connected_teams = []
+		self._packed = None # (team names, each week's games as arrays) for _replay_season, built on first use
+		self.initial_powers = InitialPowers()
+		self.tolerance = 0.001 # the powers have settled when no team's power moves more than this in a season replay
+		self.max_iterations = 1000 # season replays before calc_iterative_ranking gives up
+		self.acceleration = 'anderson' # 'anderson', 'aitken' or None for plain repeated replays
+		self.anderson_depth = 5 # how many earlier replays Anderson acceleration combines
+		self.diagnostics = SolverDiagnostics()
 
 	def _make_weeks(self):
 		#weeks go from Thursday to Wednesday to make sure tournaments are captured in a single week
@@ -126,17 +137,25 @@ class Ranking:
 		if last_day != self.end:
 			self.weeks.append(Week(last_day -6*day, self.end))
 
+	@instrument.timed('load_games')
 	def load_games(self, games_file):
-		with open(games_file, 'rU') as csvfile:
-			games_reader = csv.reader(csvfile, dialect='excel')
-			for game in games_reader:
-				self.games.append(Game(game))
+		# games_file can also be a gamestore.GameStore shared with other rankings, only the games in the period are taken from it
+		if not isinstance(games_file, basestring):
+			for i in games_file.rows(self.start, self.end):
+				self.games.append(Game(games_file.row(i)))
+		else:
+			with open(games_file, 'rU') as csvfile:
+				games_reader = csv.reader(csvfile, dialect='excel')
+				for game in games_reader:
+					self.games.append(Game(game))
 
 		for game in self.games:
 			for week in self.weeks:
 				if week.start <= game.date <= week.end:
 					week.add_game(game)
+		self._packed = None
 
+	@instrument.timed('load_teams')
 	def load_teams(self):
 		#loads teams from given ranking period and fills in some key data
 		for week in self.weeks:
@@ -161,17 +180,17 @@ class Ranking:
 					self.teams[home].increment_wins()
 				else:
 					self.teams[away].increment_wins()
+		self._packed = None
 
 	def print_games_by_week(self):
 		for week in self.weeks:
 			week.print_week()
 
 	def _calc_power_change(self, game, verbose_requested=False):
-		scaling_factor = 100
-		Kfactor = 30
-
 		home = self.teams[game.home_team]
 		away = self.teams[game.away_team]
+		if home.name in self.initial_powers.pending or away.name in self.initial_powers.pending:
+			self.initial_powers.resolve(verbose_requested)
 
 		decay = decay_function(game.date,self.start,self.end)
 
@@ -203,19 +222,12 @@ class Ranking:
 				print "%d  %s %6.1f    %6.1f  || %s %6.1f   %6.1f   %6.3f" %(game.date, home.name.ljust(35), home.power, power_change, away.name.ljust(35), away.power, -power_change, game.DOS)
 
 
+		# the power is worked out when it is first needed, along with any other team waiting for one
 		if home.is_new and len(home.data_for_initial_power) >= 3:
-			reg_func = self.make_reg_function(home.data_for_initial_power)
-			home.power = bisect(reg_func,0,2000)
-			home.is_new = False
-			if verbose_requested:
-				print "         " + home.name + " has initial power rating %.1f"  %(home.power)
+			self.initial_powers.add(home)
 
 		if away.is_new and len(away.data_for_initial_power) >= 3:
-			reg_func = self.make_reg_function(away.data_for_initial_power)
-			away.power = bisect(reg_func,0,2000)
-			away.is_new = False
-			if verbose_requested:
-				print "         " + away.name + " has initial power rating %.1f"  %(away.power)
+			self.initial_powers.add(away)
 
 		return power_change
 
@@ -231,11 +243,55 @@ class Ranking:
 			week_change[game.home_team] += power_change
 			week_change[game.away_team] -= power_change
 
+		self.initial_powers.resolve(verbose_requested)
 		for team, change in week_change.iteritems():
 			if not self.teams[team].is_new:
 				self.teams[team].power += change
 
+	def _pack_weeks(self):
+		# each week's games as arrays of home and away team indices, DOS and decay
+		# the decay of a game only depends on its date, so it is worked out once rather than every pass
+		names = self.teams.keys()
+		index = dict((name, i) for i, name in enumerate(names))
+		packed_weeks = []
+		for week in self.weeks:
+			if week.games:
+				home = np.array([index[game.home_team] for game in week.games])
+				away = np.array([index[game.away_team] for game in week.games])
+				DOS = np.array([game.DOS for game in week.games])
+				decay = np.array([decay_function(game.date, self.start, self.end) for game in week.games])
+				packed_weeks.append((home, away, DOS, decay))
+		self._packed = (names, packed_weeks)
+
+	def _season_map(self, power):
+		# the powers after one replay of the season starting from power, in the order of self._packed
+		# the same week by week update as _calc_weekly_change, with all of a week's games done at once as array operations
+		# powers only change at the end of a week, so every game in the week is predicted from the same powers
+		power = np.array(power, dtype=float)
+		names, packed_weeks = self._packed
+		num_teams = len(names)
+		for home, away, DOS, decay in packed_weeks:
+			predicted_DOS = -1 + 2/(1 + exp((power[away] - power[home])/scaling_factor))
+			power_change = Kfactor*(DOS - predicted_DOS)*decay
+			# bincount sums the changes for a team with several games in the week
+			power += np.bincount(home, power_change, num_teams) - np.bincount(away, power_change, num_teams)
+		return power
+
+	def _replay_season(self):
+		if self._packed is None:
+			self._pack_weeks()
+		names = self._packed[0]
+		power = self._season_map([self.teams[name].power for name in names])
+		for name, team_power in zip(names, power):
+			self.teams[name].power = team_power
+
 	def _update_powers(self, verbose_requested=False):
+		# a new team gets its first power part way through a week, which changes the games after it,
+		# so the game by game replay is kept for seasons with new teams and for printing the changes
+		if not verbose_requested and not any(team.is_new for team in self.teams.itervalues()):
+			self._replay_season()
+			return
+
 		if verbose_requested:
 			print "\nPower rating changes"
 			print "%s      %s  %s   %s || %s  %s  %s    %s" %("Date", "Home Team".ljust(33), "  Power  ", "Change", "Away Team".ljust(33),"  Power  ", "Change","DOS")
@@ -248,12 +304,84 @@ class Ranking:
 					print "-"*53
 				self._calc_weekly_change(week, verbose_requested)
 
+	def _accelerated_fixed_point(self, max_iterations):
+		# finds the powers a season replay leaves unchanged, returning them with the number of replays and the last change
+		# Anderson acceleration steps to the combination of the last few replays whose changes best cancel out,
+		# Aitken's delta squared extrapolates the powers from three plain replays
+		# both keep the total power of every connected group the same, as the replay itself does
+		if self._packed is None:
+			self._pack_weeks()
+		power = np.array([self.teams[name].power for name in self._packed[0]], dtype=float)
+		replayed_history = []
+		change_history = []
+		aitken_points = [power]
+		best_change = None
+		change = None
+		for iteration in xrange(1, max_iterations + 1):
+			replayed = self._season_map(power)
+			power_change = replayed - power
+			change = float(np.abs(power_change).max())
+			if change < self.tolerance:
+				return replayed, iteration, change
+			if best_change is None or change < best_change:
+				best_change = change
+			elif change > 10*best_change:
+				# the extrapolation has overshot, start again from plain replays
+				replayed_history = []
+				change_history = []
+				aitken_points = [power]
+
+			if self.acceleration == 'anderson':
+				replayed_history = (replayed_history + [replayed])[-(self.anderson_depth + 1):]
+				change_history = (change_history + [power_change])[-(self.anderson_depth + 1):]
+				if len(replayed_history) > 1:
+					change_differences = np.diff(change_history, axis=0).T
+					replayed_differences = np.diff(replayed_history, axis=0).T
+					weights = np.linalg.lstsq(change_differences, power_change, rcond=None)[0]
+					power = replayed - replayed_differences.dot(weights)
+				else:
+					power = replayed
+			elif self.acceleration == 'aitken':
+				aitken_points.append(replayed)
+				if len(aitken_points) == 3:
+					# the vector form (Irons and Tuck), one step length for every team, as the teams' powers move together
+					first, second, third = aitken_points
+					curvature = third - 2*second + first
+					curvature_norm = curvature.dot(curvature)
+					if curvature_norm > 0:
+						power = third - (third - second).dot(curvature)/curvature_norm*(third - second)
+					else:
+						power = third
+					aitken_points = [power]
+				else:
+					power = replayed
+			else:
+				power = replayed
+		return power, max_iterations, change
+
+	@instrument.timed('calc_iterative_ranking')
 	def calc_iterative_ranking(self):
-		indicator_team = self.teams.keys()[3]
-		prev_power = 1 # ensures it enters the while loop at least once
-		while abs(self.teams[indicator_team].power - prev_power) > .001:
-			prev_power = copy.copy(self.teams[indicator_team].power)
+		start_time = time.time()
+		iterations = 0
+		change = None
+		# new teams get their powers during the first game by game replay, after that the replays can be accelerated
+		while any(team.is_new for team in self.teams.itervalues()) and iterations < self.max_iterations:
+			previous = dict((name, team.power) for name, team in self.teams.iteritems())
 			self._update_powers(False)
+			iterations += 1
+			change = max(abs(team.power - previous[name]) for name, team in self.teams.iteritems() if previous[name] is not None)
+		if iterations < self.max_iterations:
+			power, accelerated_iterations, change = self._accelerated_fixed_point(self.max_iterations - iterations)
+			iterations += accelerated_iterations
+			for name, team_power in zip(self._packed[0], power):
+				self.teams[name].power = float(team_power)
+		converged = change is not None and change < self.tolerance
+		# recorded the same way as the regression method's fsolve stages so the two can be compared on cost
+		# a season replay counts as one function evaluation and the largest power change stands in for the gradient norm
+		self.diagnostics.add_stage('fixed point', iterations, 0, change, 1 if converged else 5, "%s acceleration, largest change in the last replay %.2e" %(self.acceleration, change),
+			time.time() - start_time, converged)
+		if not converged:
+			raise ConvergenceError("%s failed to settle for the period %s to %s within %d season replays, the last moved a power by %.3g" %(self.__class__.__name__, self.start, self.end, iterations, change), self.diagnostics)
 
 		# find the team with the most unique opponents
 		most_connected_team = self.teams.values()[0]
@@ -261,8 +389,10 @@ class Ranking:
 			if len(team.opponents) > len(most_connected_team.opponents):
 				most_connected_team = team
 
-		self.determine_connectivity(most_connected_team)
+		with instrument.stage('determine_regions'):
+			self.determine_connectivity(most_connected_team)
 
+	@instrument.timed('print_rankings')
 	def print_rankings(self, only_active_teams=False):
 		print "\nRankings for period %s to %s" %(self.start, self.end)
 		if only_active_teams:
@@ -343,56 +473,60 @@ class Ranking:
 				self.connected_teams.append(opponent)
 				self.determine_connectivity(self.teams[opponent])
 
-ranking = Ranking(20160630,20170630)
-ranking.load_games('../Data/MRDAallgames.csv')
-ranking.load_teams()
-hiatus_leagues = ["Big O","Slaughter Squad", "Quads of War", "Death Quads", "Quadfathers", "Your Mom", "Mean Mountain"]
-disbanded_leagues = ["Rattleskates", "Jersey Boys", "Tulsa Derby Militia", "Bomberz"]
-for team in hiatus_leagues:
-	if team in ranking.teams:
-		ranking.teams[team].hiatus = True
-
-for team in disbanded_leagues:
-	if team in ranking.teams:
-		ranking.teams[team].disbanded = True
-# ranking.teams["ThunderQuads"].min_games_required=3
-# ranking.teams["Victoria Men's Roller Derby"].min_games_required=3
-# ranking.teams["Sydney City SMASH"].min_games_required=3
-# ranking.teams["Carnage"].min_games_required=3
-# ranking.teams["Scartel"].min_games_required=3
-ranking.print_games_by_week()
-ranking.calc_iterative_ranking()
-ranking.print_rankings(False)
-
-diff_list =[]
-win_score_list =[]
-lose_score_list = []
-for game in ranking.games:
-	diff = abs(game.home_score-game.away_score)
-	diff_list.append(diff)
-	if diff<20:
-		if game.home_score>game.away_score:
-			win_score_list.append(game.home_score)
-			lose_score_list.append(game.away_score)
-		else:
-			win_score_list.append(game.away_score)
-			lose_score_list.append(game.home_score)
-
-w_avg = np.mean(win_score_list)
-w_std = np.std(win_score_list)
-w_maxsc = max(win_score_list)
-w_minsc = min(win_score_list)
-w_perc1 = np.percentile(win_score_list,1)
-w_perc99 = np.percentile(win_score_list,99)
-print w_avg, w_std, w_maxsc, w_minsc, w_perc1, w_perc99
-
-l_avg = np.mean(lose_score_list)
-l_std = np.std(lose_score_list)
-l_maxsc = max(lose_score_list)
-l_minsc = min(lose_score_list)
-l_perc1 = np.percentile(lose_score_list,1)
-l_perc99 = np.percentile(lose_score_list,99)
-print l_avg, l_std, l_maxsc, l_minsc,l_perc1, l_perc99
-
-
-#print np.histogram(diff_list, bins="fd")
\ No newline at end of file
+def main():
+	ranking = Ranking(20160630,20170630)
+	ranking.load_games('../Data/MRDAallgames.csv')
+	ranking.load_teams()
+	hiatus_leagues = ["Big O","Slaughter Squad", "Quads of War", "Death Quads", "Quadfathers", "Your Mom", "Mean Mountain"]
+	disbanded_leagues = ["Rattleskates", "Jersey Boys", "Tulsa Derby Militia", "Bomberz"]
+	for team in hiatus_leagues:
+		if team in ranking.teams:
+			ranking.teams[team].hiatus = True
+
+	for team in disbanded_leagues:
+		if team in ranking.teams:
+			ranking.teams[team].disbanded = True
+	# ranking.teams["ThunderQuads"].min_games_required=3
+	# ranking.teams["Victoria Men's Roller Derby"].min_games_required=3
+	# ranking.teams["Sydney City SMASH"].min_games_required=3
+	# ranking.teams["Carnage"].min_games_required=3
+	# ranking.teams["Scartel"].min_games_required=3
+	ranking.print_games_by_week()
+	ranking.calc_iterative_ranking()
+	ranking.print_rankings(False)
+
+	diff_list =[]
+	win_score_list =[]
+	lose_score_list = []
+	for game in ranking.games:
+		diff = abs(game.home_score-game.away_score)
+		diff_list.append(diff)
+		if diff<20:
+			if game.home_score>game.away_score:
+				win_score_list.append(game.home_score)
+				lose_score_list.append(game.away_score)
+			else:
+				win_score_list.append(game.away_score)
+				lose_score_list.append(game.home_score)
+
+	w_avg = np.mean(win_score_list)
+	w_std = np.std(win_score_list)
+	w_maxsc = max(win_score_list)
+	w_minsc = min(win_score_list)
+	w_perc1 = np.percentile(win_score_list,1)
+	w_perc99 = np.percentile(win_score_list,99)
+	print w_avg, w_std, w_maxsc, w_minsc, w_perc1, w_perc99
+
+	l_avg = np.mean(lose_score_list)
+	l_std = np.std(lose_score_list)
+	l_maxsc = max(lose_score_list)
+	l_minsc = min(lose_score_list)
+	l_perc1 = np.percentile(lose_score_list,1)
+	l_perc99 = np.percentile(lose_score_list,99)
+	print l_avg, l_std, l_maxsc, l_minsc,l_perc1, l_perc99
+
+
+	#print np.histogram(diff_list, bins="fd")
+
+if __name__ == "__main__":
+	main()
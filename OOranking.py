@@ -1,11 +1,86 @@
 # a object oriented approach to the ranking system
 
+import os
 import csv
+import json
+import hashlib
 import operator
 import copy
-from scipy import log, cosh, tanh, exp
+from numpy import log, cosh, tanh, exp
+import numpy as np
 from fractions import Fraction
-from scipy.optimize import bisect
+import instrument
+
+def initial_powers(results, low = 0, high = 2000, tolerance = 1e-9, max_iterations = 100):
+	# results has a row for each new team, holding [opponent power, DOS] for each of its first games
+	# returns the power in [low, high] that best fits each team's results, the root of the least squares gradient
+	# in make_reg_function, for every team at once
+	# contradictory results (beating a strong team and losing to a weak one) can give more than one root, so the
+	# brackets are first halved down to a single power point the way scipy's bisect would, keeping the root it picks.
+	# Newton's method then finishes each one, falling back to bisection whenever a step would leave the bracket
+	results = np.asarray(results, dtype=float)
+	opponent_power = results[:, :, 0]
+	DOS = results[:, :, 1]
+
+	def gradient(power):
+		# make_reg_function's reg_function with the sign flipped, and its slope
+		x = (power[:, None] - opponent_power)/200
+		t = tanh(x)
+		s = 1/cosh(x)**2
+		return ((t + DOS)*s).sum(axis=1), (s*(s - 2*t*(t + DOS))).sum(axis=1)/200
+
+	low = np.zeros(len(results)) + low
+	high = np.zeros(len(results)) + high
+	low_value = gradient(low)[0]
+	if (low_value*gradient(high)[0] > 0).any():
+		raise ValueError("The initial power is not between %s and %s for every new team" %(low[0], high[0]))
+	power = (low + high)/2
+	for iteration in xrange(max_iterations):
+		value, slope = gradient(power)
+		# move whichever end of the bracket is on the same side of the root as power
+		above_low = value*low_value > 0
+		low = np.where(above_low, power, low)
+		low_value = np.where(above_low, value, low_value)
+		high = np.where(above_low, high, power)
+		previous = power
+		if (high - low > 1).any():
+			power = (low + high)/2
+			continue
+		with np.errstate(divide='ignore', invalid='ignore'):
+			step = power - value/slope
+		inside = np.isfinite(step) & (step >= low) & (step <= high)
+		power = np.where(value == 0, power, np.where(inside, step, (low + high)/2))
+		if (np.abs(power - previous) < tolerance).all():
+			break
+	return power
+
+class InitialPowers:
+	# new teams get a power once they have three results against teams that have one
+	# teams that reach three results wait in pending until a power is needed, then every waiting team is solved in one go
+	# solved powers are kept against the team and the results they came from, so a replay of the same games reuses them
+	def __init__(self):
+		self.pending = {} # team name -> Team
+		self.cache = {} # (team name, results) -> power
+
+	def add(self, team):
+		team.is_new = False
+		team.power = None
+		self.pending[team.name] = team
+
+	def resolve(self, verbose_requested=False):
+		if not self.pending:
+			return
+		teams = self.pending.values()
+		keys = [(team.name, tuple(tuple(result) for result in team.data_for_initial_power[:3])) for team in teams]
+		unsolved = [key for key in set(keys) if key not in self.cache]
+		if unsolved:
+			for key, power in zip(unsolved, initial_powers([key[1] for key in unsolved])):
+				self.cache[key] = float(power)
+		for team, key in zip(teams, keys):
+			team.power = self.cache[key]
+			if verbose_requested:
+				print "         " + team.name + " has initial power rating %.1f"  %(team.power)
+		self.pending = {}
 
 class Team:
 	def __init__(self, name):
@@ -85,6 +160,10 @@ class Season:
 		self.games = []
 		self.teams = {}
 		self.connected_teams = [] # a list of teams that are part of the 'main group'
+		self.initial_powers = InitialPowers()
+		self.max_replays = 1000 # seed_ranking_for_next_year stops here even if the powers haven't settled
+		self.replays = 0 # how many replays the last seed_ranking_for_next_year took
+		self.last_change = None # how far the indicator team's power moved in the last replay
 
 	def _make_calender(self):
 		# the goal of this function is to produce a list of Week objects that start on a Thursday and end on a Wednesday
@@ -119,17 +198,26 @@ class Season:
 		if self.weeks[-1].end != self._date_list[-1]:
 			self.weeks.append(Week(self.weeks[-1].end+1,self._date_list[-1]))
 
+	@instrument.timed('load_games')
 	def load_games(self, games_file):
-		with open(games_file, 'rU') as csvfile:
-			games_reader = csv.reader(csvfile, dialect='excel')
-			for game in games_reader:
-				self.games.append(Game(game))
+		# a file can hold several years of games, only this season's are kept
+		# games_file can also be a gamestore.GameStore shared with other rankings
+		if not isinstance(games_file, basestring):
+			for i in games_file.rows(self.year*10000 + 101, self.year*10000 + 1231):
+				self.games.append(Game(games_file.row(i)))
+		else:
+			with open(games_file, 'rU') as csvfile:
+				games_reader = csv.reader(csvfile, dialect='excel')
+				for game in games_reader:
+					if int(game[0])//10000 == self.year:
+						self.games.append(Game(game))
 
 		for game in self.games:
 			for week in self.weeks:
 				if week.start <= game.date <= week.end:
 					week.add_game(game)
 
+	@instrument.timed('load_seeded_teams')
 	def load_seeded_teams(self, seed_teams):
 		# use this to load seed data from previous season
 		for team in seed_teams:
@@ -142,6 +230,7 @@ class Season:
 				self.teams[team].is_new = True
 				print self.teams[team].name + " is not connected to the main region so can't be ranked globally"
 
+	@instrument.timed('load_teams_for_seeding')
 	def load_teams_for_seeding(self):
 		#use this to load teams for iterative method
 		# if using immediately after a previous season, need to remove teams with no games
@@ -162,16 +251,21 @@ class Season:
 				self.teams[away] = Team(away)
 				self.teams[away].power = 700
 
+	@instrument.timed('current_ranking')
 	def current_ranking(self, verbose_requested=False):
 		self._update_powers(verbose_requested)
 		#runs the algorithm on the current years games
 
+	@instrument.timed('seed_ranking_for_next_year')
 	def seed_ranking_for_next_year(self, verbose_requested=False):
 		indicator_team = self.teams.keys()[3]
 		prev_power = 1 # ensures it enters the while loop at least once
-		while abs(self.teams[indicator_team].power - prev_power) > .001:
+		self.replays = 0
+		while abs(self.teams[indicator_team].power - prev_power) > .001 and self.replays < self.max_replays:
 			prev_power = copy.copy(self.teams[indicator_team].power)
 			self._update_powers(verbose_requested)
+			self.replays += 1
+		self.last_change = abs(self.teams[indicator_team].power - prev_power)
 
 		# find the team with the most unique opponents
 		most_connected_team = self.teams.values()[0]
@@ -179,7 +273,8 @@ class Season:
 			if len(team.opponents) > len(most_connected_team.opponents):
 				most_connected_team = team
 
-		self.determine_connectivity(most_connected_team)
+		with instrument.stage('determine_regions'):
+			self.determine_connectivity(most_connected_team)
 
 	def _calc_power_change(self, game, verbose_requested=False):
 		scaling_factor = 100
@@ -192,6 +287,8 @@ class Season:
 
 		home = self.teams[game.home_team]
 		away = self.teams[game.away_team]
+		if home.name in self.initial_powers.pending or away.name in self.initial_powers.pending:
+			self.initial_powers.resolve(verbose_requested)
 
 		home.add_opponent(away.name)
 		away.add_opponent(home.name)
@@ -232,19 +329,12 @@ class Season:
 				print "%d  %s %6.1f    %6.1f  || %s %6.1f   %6.1f   %6.3f" %(game.date, home.name.ljust(35), home.power, power_change, away.name.ljust(35), away.power, -power_change, game.DOS)
 
 
+		# the power is worked out when it is first needed, along with any other team waiting for one
 		if home.is_new and len(home.data_for_initial_power) >= 3:
-			reg_func = self.make_reg_function(home.data_for_initial_power)
-			home.power = bisect(reg_func,0,2000)
-			home.is_new = False
-			if verbose_requested:
-				print "         " + home.name + " has initial power rating %.1f"  %(home.power)
+			self.initial_powers.add(home)
 
 		if away.is_new and len(away.data_for_initial_power) >= 3:
-			reg_func = self.make_reg_function(away.data_for_initial_power)
-			away.power = bisect(reg_func,0,2000)
-			away.is_new = False
-			if verbose_requested:
-				print "         " + away.name + " has initial power rating %.1f"  %(away.power)
+			self.initial_powers.add(away)
 
 		return power_change
 
@@ -260,6 +350,7 @@ class Season:
 			week_change[game.home_team] += power_change
 			week_change[game.away_team] -= power_change
 
+		self.initial_powers.resolve(verbose_requested)
 		for team, change in week_change.iteritems():
 			if not self.teams[team].is_new:
 				self.teams[team].power += change
@@ -281,6 +372,7 @@ class Season:
 		for week in self.weeks:
 			week.print_week()
 
+	@instrument.timed('print_rankings')
 	def print_rankings(self, only_active_teams):
 		print "\nRankings for Season %d" %(self.year)
 		if only_active_teams:
@@ -354,33 +446,107 @@ class Season:
 				self.connected_teams.append(opponent)
 				self.determine_connectivity(self.teams[opponent])
 
-#boolean static variables for printing rankings
-only_active_teams = True
-all_teams = False
-verbose = True
-quiet = False
-
-# do this to get the iterative initial power ratings from last season
-season2015 = Season(2015)
-season2015.load_games('../Data/MRDA2015games.csv')
-season2015.load_teams_for_seeding()
-season2015.seed_ranking_for_next_year() #seed ranking is iterative, verbose is a BAD idea
-#season2015.print_rankings(all_teams)
-
-season2016 = Season(2016)
-season2016.load_games('../Data/MRDA2016games2.csv')
-season2016.load_seeded_teams(season2015.teams)
-season2016.current_ranking(verbose)
-season2016.print_rankings(only_active_teams)
-
-season2016.load_teams_for_seeding()
-season2016.seed_ranking_for_next_year()
-season2016.print_rankings(all_teams)
-
-# #if a team is not connected from previous season, it is currently treated as a new team in load_seeded_teams
-
-season2017 = Season(2017)
-season2017.load_games('../Data/MRDA2017games2.csv')
-season2017.load_seeded_teams(season2016.teams)
-season2017.current_ranking(verbose)
-season2017.print_rankings(all_teams)
+class SeasonPipeline:
+	# runs a chain of seasons, each one seeded with the powers the season before ends on
+	# seeds are saved in cache_directory under a hash of the games of that season and every season before it,
+	# so a season is only replayed when its games or an earlier season's games change.
+	# Adding results to the latest season replays that season alone
+	# A latest season with no season before it is ranked by the iterative method, as a seed season is
+	#
+	# pipeline = SeasonPipeline([(2015, 'MRDA2015games.csv'), (2016, 'MRDA2016games.csv'), (2017, 'MRDA2017games.csv')])
+	# season2017 = pipeline.run()
+	def __init__(self, seasons, cache_directory = 'season_seeds'):
+		self.seasons = seasons # (year, games file) in order, several years can share a games file
+		self.cache_directory = cache_directory
+		self.replayed = [] # the years the last run had to replay rather than take from the cache
+		self.season_list = {} # year -> Season for every season of the last run, one taken from the cache has its teams but not its games
+
+	def _season_hash(self, previous_hash, year, games_file):
+		data_hash = hashlib.sha1(previous_hash + str(year))
+		with open(games_file, 'rU') as csvfile:
+			for game in csv.reader(csvfile, dialect='excel'):
+				if int(game[0])//10000 == year:
+					data_hash.update(",".join(game) + "\n")
+		return data_hash.hexdigest()
+
+	def _seed_file(self, year, season_hash):
+		return os.path.join(self.cache_directory, "season_%d_%s.json" %(year, season_hash[:16]))
+
+	def _load_seeds(self, year, season_hash):
+		seed_file = self._seed_file(year, season_hash)
+		if not os.path.exists(seed_file):
+			return None
+		with open(seed_file, 'r') as sfile:
+			saved = json.load(sfile)
+		seeds = {}
+		for name, (power, is_connected, num_games, num_wins, opponents) in saved.items():
+			name = name.encode('utf-8')
+			seeds[name] = Team(name)
+			seeds[name].power = power
+			seeds[name].is_connected = is_connected
+			seeds[name].num_games = num_games
+			seeds[name].num_wins = num_wins
+			seeds[name].opponents = [opponent.encode('utf-8') for opponent in opponents]
+		return seeds
+
+	def _save_seeds(self, year, season_hash, teams):
+		if not os.path.isdir(self.cache_directory):
+			os.makedirs(self.cache_directory)
+		seed_file = self._seed_file(year, season_hash)
+		with open(seed_file + '.tmp', 'w') as sfile:
+			# the game counts and opponents as well as the seeds, so a cached season prints as a replayed one does
+			json.dump(dict((name, [team.power, team.is_connected, team.num_games, team.num_wins, team.opponents]) for name, team in teams.items()), sfile)
+		os.rename(seed_file + '.tmp', seed_file)
+
+	def run(self, verbose_requested=False):
+		# returns the latest season, ranked from the seeds of the season before it
+		self.replayed = []
+		self.season_list = {}
+		seeds = None
+		season_hash = ''
+		for i, (year, games_file) in enumerate(self.seasons):
+			season_hash = self._season_hash(season_hash, year, games_file)
+			latest = i == len(self.seasons) - 1
+			if not latest:
+				cached = self._load_seeds(year, season_hash)
+				if cached is not None:
+					seeds = cached
+					self.season_list[year] = Season(year)
+					self.season_list[year].teams = cached
+					continue
+
+			season = Season(year)
+			season.load_games(games_file)
+			self.replayed.append(year)
+			self.season_list[year] = season
+			if seeds is not None:
+				season.load_seeded_teams(seeds)
+				season.current_ranking(verbose_requested and latest)
+			if seeds is None or not latest:
+				season.load_teams_for_seeding()
+				season.seed_ranking_for_next_year() #seed ranking is iterative, verbose is a BAD idea
+			if latest:
+				return season
+
+			self._save_seeds(year, season_hash, season.teams)
+			seeds = season.teams
+
+def main():
+	#boolean static variables for printing rankings
+	only_active_teams = True
+	all_teams = False
+	verbose = True
+	quiet = False
+
+	# each season is seeded with the iterative power ratings from the season before
+	# seeds are cached, so only seasons whose games have changed since the last run are replayed
+	pipeline = SeasonPipeline([(2015, '../Data/MRDA2015games.csv'), (2016, '../Data/MRDA2016games2.csv'), (2017, '../Data/MRDA2017games2.csv')])
+	season2017 = pipeline.run(verbose)
+	pipeline.season_list[2016].print_rankings(all_teams)
+
+	# #if a team is not connected from previous season, it is currently treated as a new team in load_seeded_teams
+
+	season2017.print_rankings(all_teams)
+
+if __name__ == "__main__":
+	main()
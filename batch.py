@@ -0,0 +1,200 @@
+# Runs many rankings from a single job file in one process
+# Each games file is parsed once into a GameStore and shared by every job that uses it,
+# so adding another ranking window costs a solve rather than another interpreter start and CSV parse
+#
+# python batch.py jobs_march.json
+# python batch.py jobs.json --jobs 4
+# python batch.py backfill.json --stacked      solves every regression job's equations together, see regression.solve_rankings
+#
+# The job file is JSON with an optional "defaults" object, whose keys apply to every job unless the job
+# sets them itself, and a list of "jobs":
+#   name              label used in the summary (defaults to the engine and window)
+#   engine            regression, improved, dynamic or wftda (default regression)
+#   start, end        the ranking window as YYYYMMDD
+#   games             games file in the clean format, the official .xlsx export, a directory of games files,
+#                     or a list of files that are merged with duplicate games dropped
+#   teams, hiatus, disbanded    team list files, all optional except teams for the improved engine
+#   previous_ranking_dates      ranking dates file, improved engine only
+#   team_overrides    {"team name": {"min_games_required": 3}} sets attributes on those teams before solving
+#   region_anchors    {"team name": power} used by anchor_regions instead of prompting, a region without one is left unranked
+#   outputs           which files output_ranking_data writes, e.g. ["ranking_detailed", "powers_ranks"]
+#   print             "active", "all" or false - print the ranking to the screen once it is solved
+#   directory         where the output files go (and where the improved engine finds previous powers_ranks files)
+# File names are relative to the job file
+#
+# Jobs run in the order they are listed, so one job can read the powers_ranks file written by an earlier one
+# With --jobs N they are spread over N processes instead and should not depend on each other, the teams their games
+# bring in are added to their teams files before the processes start, so no two of them write to one file
+# With --stacked the regression jobs are solved first, all in one system, and then finished in order as usual
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import regression
+from gamestore import GameStore
+
+engines = {
+	'regression': regression.Ranking,
+	'improved': regression.ImprovedRanking,
+	'dynamic': regression.DynamicRanking,
+	'wftda': regression.WFTDARanking,
+}
+
+_stores = {} # games file -> GameStore, filled before any worker starts so forked workers share it
+
+def load_jobs(job_file):
+	with open(job_file, 'r') as jfile:
+		job_data = json.load(jfile)
+	if isinstance(job_data, list):
+		job_data = {'jobs': job_data}
+
+	base = os.path.dirname(os.path.abspath(job_file))
+	jobs = []
+	for i, job_settings in enumerate(job_data['jobs']):
+		job = dict(job_data.get('defaults', {}))
+		job.update(job_settings)
+		job.setdefault('engine', 'regression')
+		job.setdefault('name', "%s %s-%s" %(job['engine'], job['start'], job['end']))
+		job.setdefault('directory', '.')
+		if job['engine'] not in engines:
+			raise ValueError("Job %d (%s) has unknown engine %s, expected one of %s" %(i + 1, job['name'], job['engine'], ", ".join(sorted(engines))))
+		for key in ['games', 'teams', 'hiatus', 'disbanded', 'previous_ranking_dates', 'directory']:
+			if isinstance(job.get(key), list):
+				job[key] = tuple(os.path.join(base, path) for path in job[key]) # a tuple so it can key _stores
+			elif job.get(key):
+				job[key] = os.path.join(base, job[key])
+		jobs.append(job)
+	return jobs
+
+def load_stores(jobs, reload = False):
+	for job in jobs:
+		if reload or job['games'] not in _stores:
+			_stores[job['games']] = GameStore(job['games'])
+	return _stores
+
+def register_teams(jobs):
+	# appends the teams a job's games bring in to its teams file, as Ranking.load_teams would, so that
+	# jobs spread over processes find every team already listed and none of them writes to a shared file
+	# jobs are taken in order and each team once, so the file ends up as a run of the jobs one by one leaves it
+	listed = {}
+	for job in jobs:
+		teams_file = job.get('teams')
+		if not teams_file:
+			continue
+		if teams_file not in listed:
+			listed[teams_file] = set()
+			if os.path.exists(teams_file):
+				with open(teams_file, 'r') as teams_in:
+					listed[teams_file].update(row.rstrip('\n') for row in teams_in)
+		unseen = []
+		for game in _stores[job['games']].games(regression.str2dt(job['start']), regression.str2dt(job['end'])):
+			for team in [game.home_team, game.away_team]:
+				if team not in listed[teams_file]:
+					listed[teams_file].add(team)
+					unseen.append(team)
+		if unseen:
+			with open(teams_file, 'a') as teams_out:
+				teams_out.write("".join(team + "\n" for team in unseen))
+
+def make_ranking(job):
+	store = _stores[job['games']]
+	if job['engine'] == 'improved':
+		ranking = regression.ImprovedRanking(job['start'], job['end'], store, job['previous_ranking_dates'], job['teams'], job.get('hiatus'), job.get('disbanded'))
+	else:
+		ranking = engines[job['engine']](job['start'], job['end'], store, job.get('teams'), job.get('hiatus'), job.get('disbanded'))
+
+	for team, overrides in job.get('team_overrides', {}).items():
+		for attribute, value in overrides.items():
+			if not hasattr(ranking.teams[team], attribute):
+				raise ValueError("Job %s tries to override %s, which teams do not have" %(job['name'], attribute))
+			setattr(ranking.teams[team], attribute, value)
+	ranking.region_anchors.update(job.get('region_anchors', {}))
+	ranking.interactive = False # nobody is waiting at a prompt in a batch
+	if 'outputs' in job:
+		ranking.outputs = job['outputs']
+	return ranking
+
+def run_job(job, ranking = None):
+	# returns a small summary rather than the ranking, so results can come back from a worker process
+	# a ranking already solved by regression.solve_rankings is finished without solving it again,
+	# and an error from making it there is reported as this job's
+	summary = {'name': job['name'], 'engine': job['engine'], 'teams': 0, 'active': 0, 'time': 0.0, 'error': None}
+	if isinstance(ranking, basestring):
+		summary['error'] = ranking
+		return summary
+	start_time = time.time()
+	cwd = os.getcwd()
+	try:
+		if not os.path.isdir(job['directory']):
+			os.makedirs(job['directory'])
+		os.chdir(job['directory'])
+		if ranking is None:
+			ranking = make_ranking(job)
+			ranking.create_ranking()
+		else:
+			ranking.create_ranking(solve=False)
+		if job.get('print'):
+			ranking.print_rankings(job['print'] != 'all')
+		summary['teams'] = len(ranking.ranked_list_full)
+		summary['active'] = len(ranking.ranked_list_active)
+	except (regression.ConvergenceError, KeyError, ValueError, IOError) as error:
+		summary['error'] = "%s: %s" %(error.__class__.__name__, error)
+	finally:
+		os.chdir(cwd)
+	summary['time'] = time.time() - start_time
+	return summary
+
+def solve_stacked(jobs):
+	# the regression jobs' rankings with their powers found by one regression.solve_rankings call,
+	# the error for a regression job whose ranking couldn't be made, and None for the other jobs, which run_job then deals with as usual
+	rankings = []
+	for job in jobs:
+		ranking = None
+		if job['engine'] == 'regression':
+			try:
+				ranking = make_ranking(job)
+			except (KeyError, ValueError, IOError) as error:
+				ranking = "%s: %s" %(error.__class__.__name__, error)
+		rankings.append(ranking)
+	regression.solve_rankings([ranking for ranking in rankings if isinstance(ranking, regression.Ranking)])
+	return rankings
+
+def run_jobs(jobs, processes = 1, stacked = False):
+	load_stores(jobs)
+	if stacked:
+		return [run_job(job, ranking) for job, ranking in zip(jobs, solve_stacked(jobs))]
+	if processes > 1:
+		register_teams(jobs)
+		pool = multiprocessing.Pool(processes)
+		try:
+			return pool.map(run_job, jobs, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+	return [run_job(job) for job in jobs]
+
+def print_summary(summaries):
+	width = max([len("Job")] + [len(summary['name']) for summary in summaries])
+	print "\n%s  %-10s  %5s  %6s  %8s  %s" %("Job".ljust(width), "Engine", "Teams", "Active", "Time (s)", "Result")
+	for summary in summaries:
+		result = summary['error'] if summary['error'] else "ok"
+		print "%s  %-10s  %5d  %6d  %8.2f  %s" %(summary['name'].ljust(width), summary['engine'], summary['teams'], summary['active'], summary['time'], result)
+
+def main():
+	parser = argparse.ArgumentParser(description="Run every ranking listed in a job file")
+	parser.add_argument('job_file')
+	parser.add_argument('--jobs', type=int, default=1, help="number of processes to spread the jobs over")
+	parser.add_argument('--stacked', action='store_true', help="solve the regression jobs together in one system")
+	args = parser.parse_args()
+
+	summaries = run_jobs(load_jobs(args.job_file), args.jobs, args.stacked)
+	print_summary(summaries)
+	if any(summary['error'] for summary in summaries):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
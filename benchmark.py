@@ -0,0 +1,325 @@
+# Scaling benchmarks for the ranking engines
+# The real data only has a few hundred games, so this generates synthetic leagues of any size
+# (teams play round robin tournaments with nearby teams, optionally split into disconnected regions)
+# and times each stage of each engine on them: load, solve, region detection, anchoring, ranking and output
+# Every case runs in its own process so the memory high-water mark belongs to that case alone
+# Results are saved as JSON along with the git commit, so runs from different commits can be compared
+#
+# python benchmark.py --teams 50 200 1000 --regions 1 3 --output bench_new.json
+# python benchmark.py --compare bench_old.json bench_new.json
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import resource
+import datetime as dt
+import subprocess
+import threading
+import multiprocessing
+
+import instrument
+
+engine_names = ['ranking', 'improved', 'iterative', 'season', 'wftda']
+stage_names = ['load', 'solve', 'regions', 'anchor', 'rank', 'output']
+
+# which benchmark stage each instrumented stage belongs to
+# time spent in an instrumented stage counts towards its closest ancestor in this table
+stage_map = {
+	'load_games': 'load',
+	'load_teams': 'load',
+	'load_hiatus_teams': 'load',
+	'load_disbanded_teams': 'load',
+	'load_previous_powers_ranks': 'load',
+	'load_teams_for_seeding': 'load',
+	'determine_regions': 'regions',
+	'regression_ranking': 'solve',
+	'calc_iterative_ranking': 'solve',
+	'seed_ranking_for_next_year': 'solve',
+	'sort': 'rank',
+	'activity_filter': 'rank',
+	'anchor_regions': 'anchor',
+	'output_ranking_data': 'output',
+	'print_rankings': 'output',
+}
+
+def synthetic_league(games_file, num_teams, games_per_team=10, tournament_size=4, num_regions=1, year=2017, seed=1):
+	# writes a games file in the clean format (YYYYMMDD,Team 1,XXX,Team 2,YYY) and returns the true powers
+	# teams within a region sit along a line and tournaments draw teams that are close together,
+	# so the schedule is clustered like real travel-limited derby rather than uniformly random
+	# regions never play each other, so each one is a separate component of the game graph
+	rng = random.Random(seed)
+	true_powers = {}
+	games = []
+	first_saturday = dt.date(year, 1, 1) + dt.timedelta((5 - dt.date(year, 1, 1).weekday()) % 7)
+
+	for region in xrange(num_regions):
+		region_size = num_teams//num_regions + (1 if region < num_teams % num_regions else 0)
+		if region_size < 2:
+			continue
+		teams = ["Region %d Team %05d" %(region + 1, i + 1) for i in xrange(region_size)]
+		for team in teams:
+			true_powers[team] = rng.gauss(700, 150)
+
+		size = min(tournament_size, region_size)
+		# each round robin gives every entrant size-1 games
+		num_tournaments = int(math.ceil(float(region_size*games_per_team)/(size*(size - 1))))
+		for t in xrange(num_tournaments):
+			centre = rng.randrange(region_size)
+			neighbourhood = [(centre + offset) % region_size for offset in xrange(-2*size, 2*size + 1)]
+			entrants = rng.sample(sorted(set(neighbourhood)), size)
+			date = first_saturday + dt.timedelta(7*rng.randrange(52))
+			for a in xrange(size):
+				for b in xrange(a + 1, size):
+					games.append(_synthetic_game(rng, date, teams[entrants[a]], teams[entrants[b]], true_powers))
+
+	games.sort(key=lambda game: game[0])
+	with open(games_file, 'wb') as csvfile:
+		game_writer = csv.writer(csvfile, delimiter=',')
+		for game in games:
+			game_writer.writerow(game)
+
+	return true_powers
+
+def _synthetic_game(rng, date, home, away, true_powers):
+	# the score line follows the same logistic curve the regression fits, plus some noise
+	total = max(100, int(rng.gauss(350, 70)))
+	DOS = math.tanh((true_powers[home] - true_powers[away])/200) + rng.gauss(0, 0.08)
+	DOS = min(max(DOS, -0.98), 0.98)
+	home_score = int(round(total*(1 + DOS)/2))
+	away_score = total - home_score
+	if home_score == away_score:
+		home_score += 1 # no draws in derby
+	return [date.strftime('%Y%m%d'), home, home_score, away, away_score]
+
+def _run_ranking(games_file, year):
+	import regression
+	ranking = regression.Ranking(year*10000 + 101, year*10000 + 1231, games_file)
+	ranking.interactive = False
+	ranking.create_ranking()
+
+def _run_wftda(games_file, year):
+	import regression
+	ranking = regression.WFTDARanking(year*10000 + 101, year*10000 + 1231, games_file)
+	ranking.interactive = False
+	ranking.create_ranking()
+
+def _run_improved(games_file, year):
+	import regression
+	# ImprovedRanking builds on a previous ranking, so make one for the first half of the year first (not timed)
+	instrument.disable()
+	previous = regression.Ranking(year*10000 + 101, year*10000 + 630, games_file)
+	previous.interactive = False
+	previous.create_ranking()
+	with open('ranking_dates.csv', 'w') as dates:
+		dates.write("%d\n" %(year*10000 + 630))
+	instrument.enable()
+
+	ranking = regression.ImprovedRanking(year*10000 + 101, year*10000 + 1231, games_file, 'ranking_dates.csv', None)
+	ranking.interactive = False
+	ranking.create_ranking()
+
+def _run_iterative(games_file, year):
+	import OOiterative
+	ranking = OOiterative.Ranking(year*10000 + 101, year*10000 + 1231)
+	ranking.load_games(games_file)
+	ranking.load_teams()
+	ranking.calc_iterative_ranking()
+	ranking.print_rankings(False)
+
+def _run_season(games_file, year):
+	import OOranking
+	season = OOranking.Season(year)
+	season.load_games(games_file)
+	season.load_teams_for_seeding()
+	season.seed_ranking_for_next_year()
+	season.print_rankings(False)
+
+engine_runners = {
+	'ranking': _run_ranking,
+	'improved': _run_improved,
+	'iterative': _run_iterative,
+	'season': _run_season,
+	'wftda': _run_wftda,
+}
+
+def _stage_times():
+	# splits the instrumented self times into the benchmark stages
+	times = dict((stage, 0.0) for stage in stage_names)
+	for record in instrument.report()['stages']:
+		for name in reversed(record['stage'].split(';')):
+			if name in stage_map:
+				times[stage_map[name]] += record['self_time']
+				break
+	return times
+
+def _case_worker(engine, games_file, year, results):
+	# runs in a fresh process - output files land in a scratch directory and printing is thrown away
+	work_dir = tempfile.mkdtemp(prefix='roborank_bench_')
+	os.chdir(work_dir)
+	sys.stdout = open(os.devnull, 'w')
+	# region detection and connectivity are recursive, big leagues need a deep stack
+	sys.setrecursionlimit(100000)
+	threading.stack_size(512*1024*1024)
+	outcome = {}
+
+	def run():
+		try:
+			instrument.reset()
+			instrument.enable()
+			start_time = time.time()
+			engine_runners[engine](games_file, year)
+			outcome['total'] = time.time() - start_time
+			outcome['stages'] = _stage_times()
+			outcome['status'] = 'ok'
+		except Exception as e:
+			outcome['status'] = 'error: %s: %s' %(e.__class__.__name__, e)
+
+	thread = threading.Thread(target=run)
+	thread.start()
+	thread.join()
+	# ru_maxrss is in kilobytes on Linux
+	outcome['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	shutil.rmtree(work_dir, ignore_errors=True)
+	results.put(outcome)
+
+def run_case(engine, games_file, year, timeout):
+	results = multiprocessing.Queue()
+	worker = multiprocessing.Process(target=_case_worker, args=(engine, os.path.abspath(games_file), year, results))
+	worker.start()
+	worker.join(timeout)
+	if worker.is_alive():
+		worker.terminate()
+		worker.join()
+		return {'status': 'timeout', 'total': None, 'stages': {}, 'peak_memory_kb': None}
+	if results.empty():
+		return {'status': 'crashed (exit code %s)' %(worker.exitcode), 'total': None, 'stages': {}, 'peak_memory_kb': None}
+	return results.get()
+
+def git_commit():
+	try:
+		here = os.path.dirname(os.path.abspath(__file__))
+		commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).strip()
+		dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here).strip()
+		return commit + ('-dirty' if dirty else '')
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+
+def run_benchmarks(team_counts, engines, games_per_team=10, tournament_size=4, region_counts=(1,), repeats=1, timeout=600, seed=1):
+	year = 2017
+	league_dir = tempfile.mkdtemp(prefix='roborank_leagues_')
+	results = {
+		'commit': git_commit(),
+		'date': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+		'python': sys.version.split()[0],
+		'cases': [],
+	}
+	try:
+		for num_regions in region_counts:
+			for num_teams in team_counts:
+				games_file = os.path.join(league_dir, 'league_%d_%d.csv' %(num_teams, num_regions))
+				synthetic_league(games_file, num_teams, games_per_team, tournament_size, num_regions, year, seed)
+				with open(games_file) as f:
+					num_games = sum(1 for row in f)
+				for engine in engines:
+					for repeat in xrange(repeats):
+						outcome = run_case(engine, games_file, year, timeout)
+						outcome.update({'engine': engine, 'teams': num_teams, 'games': num_games, 'regions': num_regions,
+							'games_per_team': games_per_team, 'tournament_size': tournament_size, 'repeat': repeat})
+						results['cases'].append(outcome)
+						_print_case(outcome)
+	finally:
+		shutil.rmtree(league_dir, ignore_errors=True)
+	return results
+
+def _print_case(case):
+	if case['status'] == 'ok':
+		stages = "  ".join("%s %8.3f" %(stage, case['stages'].get(stage, 0.0)) for stage in stage_names)
+		print "%-10s %6d teams %7d games %2d regions  total %9.3f  %s  peak %8.1f MB" %(case['engine'], case['teams'], case['games'], case['regions'], case['total'], stages, case['peak_memory_kb']/1024.0)
+	else:
+		print "%-10s %6d teams %7d games %2d regions  %s" %(case['engine'], case['teams'], case['games'], case['regions'], case['status'])
+	sys.stdout.flush()
+
+def _case_key(case):
+	return (case['engine'], case['teams'], case['regions'], case['games_per_team'], case['tournament_size'])
+
+def _best_cases(results):
+	# keeps the fastest successful repeat of each case
+	best = {}
+	for case in results['cases']:
+		if case['status'] != 'ok':
+			continue
+		key = _case_key(case)
+		if key not in best or case['total'] < best[key]['total']:
+			best[key] = case
+	return best
+
+def compare(old_file, new_file, threshold=0.2):
+	# prints the change in each stage between two result files and flags anything more than threshold slower
+	with open(old_file) as f:
+		old = json.load(f)
+	with open(new_file) as f:
+		new = json.load(f)
+	old_cases = _best_cases(old)
+	new_cases = _best_cases(new)
+	regressions = 0
+
+	print "Comparing %s (%s) with %s (%s)" %(old_file, old['commit'], new_file, new['commit'])
+	print "%-10s %6s %7s  %-7s %10s %10s %8s" %("Engine", "Teams", "Regions", "Stage", "Old (s)", "New (s)", "Change")
+	for key in sorted(set(old_cases) & set(new_cases)):
+		for stage in stage_names + ['total']:
+			if stage == 'total':
+				old_time = old_cases[key]['total']
+				new_time = new_cases[key]['total']
+			else:
+				old_time = old_cases[key]['stages'].get(stage, 0.0)
+				new_time = new_cases[key]['stages'].get(stage, 0.0)
+			if old_time < 1e-3 and new_time < 1e-3:
+				continue # too quick to measure reliably
+			change = (new_time - old_time)/max(old_time, 1e-3)
+			flag = ""
+			if change > threshold:
+				flag = "  <-- slower"
+				regressions += 1
+			print "%-10s %6d %7d  %-7s %10.3f %10.3f %+7.1f%%%s" %(key[0], key[1], key[2], stage, old_time, new_time, 100*change, flag)
+		old_memory = old_cases[key]['peak_memory_kb']
+		new_memory = new_cases[key]['peak_memory_kb']
+		print "%-10s %6d %7d  %-7s %8.1fMB %8.1fMB %+7.1f%%" %(key[0], key[1], key[2], "memory", old_memory/1024.0, new_memory/1024.0, 100.0*(new_memory - old_memory)/old_memory)
+
+	for key in sorted(set(old_cases) ^ set(new_cases)):
+		print "%-10s %6d %7d  only in %s" %(key[0], key[1], key[2], old_file if key in old_cases else new_file)
+
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Time the ranking engines on synthetic leagues")
+	parser.add_argument('--teams', type=int, nargs='+', default=[50, 200, 1000], help="league sizes to generate (50 to 10000)")
+	parser.add_argument('--games-per-team', type=int, default=10)
+	parser.add_argument('--tournament-size', type=int, default=4, help="teams in each round robin tournament")
+	parser.add_argument('--regions', type=int, nargs='+', default=[1], help="numbers of disconnected regions to try")
+	parser.add_argument('--engines', nargs='+', choices=engine_names, default=engine_names)
+	parser.add_argument('--repeats', type=int, default=1, help="the fastest repeat is used when comparing")
+	parser.add_argument('--timeout', type=float, default=600, help="seconds before a case is abandoned")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', default='bench_results.json')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files instead of running")
+	parser.add_argument('--threshold', type=float, default=0.2, help="fractional slowdown flagged as a regression")
+	args = parser.parse_args()
+
+	if args.compare:
+		regressions = compare(args.compare[0], args.compare[1], args.threshold)
+		sys.exit(1 if regressions else 0)
+
+	results = run_benchmarks(args.teams, args.engines, args.games_per_team, args.tournament_size, args.regions, args.repeats, args.timeout, args.seed)
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=2, sort_keys=True)
+	print "Results for commit %s written to %s" %(results['commit'], args.output)
+
+if __name__ == "__main__":
+	main()
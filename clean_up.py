@@ -1,62 +1,189 @@
+# Turns raw result exports into the clean games file the rankings read: YYYYMMDD,Team 1 Name,XXX,Team 2 name,YYY
+# Rows are read and written one at a time, so files of any size clean in constant memory
+# Each game is keyed by its date and the two teams in alphabetical order, so the same game listed from
+# either team's side is caught as a duplicate with a dict lookup. Only a listing with the same scores is a
+# duplicate, the second game of a double-header is kept, see gamestore.GameMeetings
+# The date order (day first or US month first) and the layout (raw export or already clean) are worked out
+# separately for each file
+#
+# python clean_up.py march.csv                      writes clean_march.csv
+# python clean_up.py june.csv march.csv -o clean_games.csv      merges both, dropping games listed in both
+# python clean_up.py june.csv --date-order mdy      when a file's dates can't tell you
+# python clean_up.py Official_june.xlsx            reads the 'By Date' sheet of the official spreadsheet directly
+
+import os
 import csv
-import sys
-import copy
-from scipy import log, cosh, tanh, exp, floor
-from scipy.optimize import fsolve
-import datetime as dt
-
-games_list = []
-
-if len(sys.argv) >1:
-	raw_file = str(sys.argv[1])
-	normal_date = bool(sys.argv[2])
-else:
-	raw_file = "march.csv"
-
-with open(raw_file, 'rU') as csvfile:
-	games_reader = csv.reader(csvfile, dialect='excel')
-	for game in games_reader:
-		if game[0]!='':
-			raw_date = game[0]
-			raw_split = raw_date.split("/")
-			
-			# Need to account for normal or US date format
-			if normal_date:
-				day = raw_split[0]
-				if len(day)!= 2:
-					day = "0" + day
-				month = raw_split[1]
-				if len(month) != 2:
-					month = "0" + month
-				year = raw_split[2]
-				if len(year) != 4:
-					year = "20" + year
-			else:
-				day = raw_split[1]
-				if len(day)!= 2:
-					day = "0" + day
-				month = raw_split[0]
-				if len(month) != 2:
-					month = "0" + month
-				year = raw_split[2]
-				if len(year) != 4:
-					year = "20" + year
-
-			clean_date = year + month + day
-			game_data = [clean_date, game[2],game[3],game[4],game[5]]
-			print game_data
-			games_list.append(game_data)
-
-clean_game_list = []
-
-for game in games_list:
-	swapped = [game[0], game[3],game[4], game[1],game[2]]
-	if game not in clean_game_list and swapped not in clean_game_list:
-		clean_game_list.append(game)
-
-
-clean_file = 'clean_' + raw_file
-with open(clean_file, 'wb') as csvfile:
-	game_writer = csv.writer(csvfile, delimiter=',')
-	for game in clean_game_list:
-		game_writer.writerow(game)
\ No newline at end of file
+import heapq
+import argparse
+
+from gamestore import normalise_row, game_key, GameMeetings, as_text, read_xlsx_rows
+
+def detect_layout(raw_file):
+	# 'clean' if the first row is already YYYYMMDD,team,score,team,score, otherwise the official export layout
+	with open(raw_file, 'rU') as csvfile:
+		for row in csv.reader(csvfile, dialect='excel'):
+			if any(field.strip() for field in row):
+				return 'clean' if len(row) == 5 and row[0].strip().isdigit() and len(row[0].strip()) == 8 else 'export'
+	return 'export'
+
+def detect_date_order(raw_file):
+	# 'dmy' if some date has a day above 12 in the first place, 'mdy' if one has it in the second place
+	# None if no date settles it, e.g. a file with only early-month games
+	with open(raw_file, 'rU') as csvfile:
+		for row in csv.reader(csvfile, dialect='excel'):
+			if not row:
+				continue
+			parts = row[0].strip().split("/")
+			if len(parts) != 3 or not (parts[0].isdigit() and parts[1].isdigit()):
+				continue
+			if int(parts[0]) > 12:
+				return 'dmy'
+			if int(parts[1]) > 12:
+				return 'mdy'
+	return None
+
+def _csv_rows(raw_file):
+	with open(raw_file, 'rU') as csvfile:
+		for row in csv.reader(csvfile, dialect='excel'):
+			yield row
+
+def _read_games(raw_file, layout = None, date_order = None, sheet = 'By Date'):
+	# the report entry for the file, and a generator of (line, raw row as text, clean row) for each complete game in it
+	# rows that can't be a game are counted in the report entry as the generator passes them
+	if raw_file.endswith('.xlsx'):
+		# the spreadsheet holds real dates, so there is no order to detect, a date typed in as text is taken as day first
+		rows = read_xlsx_rows(raw_file, sheet)
+		layout = 'export'
+		order = date_order or 'dmy'
+		detected = 'date cells'
+	else:
+		rows = _csv_rows(raw_file)
+		layout = layout or detect_layout(raw_file)
+		detected = detect_date_order(raw_file)
+		order = date_order or detected or 'dmy'
+	counts = {'file': raw_file, 'layout': layout, 'date_order': order, 'detected': detected, 'rows': 0, 'kept': 0, 'fixed': 0, 'duplicate': 0, 'conflict': 0, 'dropped': 0, 'problems': []}
+
+	def games():
+		for line, raw_row in enumerate(rows, 1):
+			text = [as_text(field) for field in raw_row[:6]] # spreadsheet cells can be dates, numbers or empty
+			if not any(field.strip() for field in text):
+				continue # blank lines are not worth reporting
+			counts['rows'] += 1
+			row = normalise_row(raw_row, layout, order)
+			if row is None:
+				counts['dropped'] += 1
+				counts['problems'].append("line %d dropped, not a complete game: %s" %(line, ",".join(text)))
+				continue
+			yield line, text, row
+	return counts, games()
+
+def _dated(index, games):
+	# sort keys for the merge, the file's place in the list settles games on the same date
+	for line, text, row in games:
+		yield row[0], index, line, text, row
+
+def _in_date_order(raw_file, layout = None, date_order = None, sheet = 'By Date'):
+	last = None
+	for line, text, row in _read_games(raw_file, layout, date_order, sheet)[1]:
+		if last is not None and row[0] < last:
+			return False
+		last = row[0]
+	return True
+
+class Cleaner:
+	# passes each new game to write as it is read and keeps a tally of every row it doesn't pass on
+	# write takes a clean row, e.g. a csv writer's writerow or GameStore.add
+	def __init__(self, write):
+		self.write = write
+		self.seen = GameMeetings()
+		self.first_seen = {} # game key -> where its first game was found
+		self.report = []
+
+	def _keep(self, counts, line, text, row):
+		key = game_key(row)
+		found = self.seen.check(row, counts['file'])
+		if found == 'duplicate':
+			counts['duplicate'] += 1
+			return
+		if found == 'conflict':
+			counts['conflict'] += 1
+			counts['problems'].append("line %d conflicts with %s, kept the first: %s" %(line, self.first_seen[key], ",".join(row)))
+			return
+		self.first_seen.setdefault(key, "%s line %d" %(counts['file'], line))
+		raw_teams = [text[2], text[4]] if counts['layout'] == 'export' else [text[1], text[3]]
+		if raw_teams != [row[1], row[3]]:
+			counts['fixed'] += 1 # stray spaces in a team name
+		self.write(row)
+		counts['kept'] += 1
+
+	def clean_file(self, raw_file, layout = None, date_order = None, sheet = 'By Date'):
+		counts, games = _read_games(raw_file, layout, date_order, sheet)
+		for line, text, row in games:
+			self._keep(counts, line, text, row)
+		self.report.append(counts)
+		return counts
+
+	def merge_files(self, raw_files, layout = None, date_order = None, sheet = 'By Date'):
+		# cleans overlapping files together, passing on every game from all of them in date order
+		# the files are streamed side by side and merged a row at a time, so each should be in date order already,
+		# one that isn't is checked with a first pass and sorted in memory
+		# when files disagree about a game, the one listed first in raw_files wins for games on the same date
+		streams = []
+		reports = []
+		for index, raw_file in enumerate(raw_files):
+			counts, games = _read_games(raw_file, layout, date_order, sheet)
+			stream = _dated(index, games)
+			if not _in_date_order(raw_file, layout, date_order, sheet):
+				stream = iter(sorted(stream))
+			streams.append(stream)
+			reports.append(counts)
+		for date, index, line, text, row in heapq.merge(*streams):
+			self._keep(reports[index], line, text, row)
+		self.report.extend(reports)
+		return reports
+
+def print_report(report, verbose = False):
+	for counts in report:
+		order = counts['date_order']
+		if counts['layout'] == 'clean':
+			order = "YYYYMMDD"
+		elif counts['file'].endswith('.xlsx'):
+			order = "from the date cells"
+		elif counts['detected'] is None:
+			order += " (assumed, the dates could be either)"
+		print "%s: %d rows, %d kept, %d duplicates, %d conflicting, %d dropped, %d team names tidied, dates %s" %(counts['file'], counts['rows'],
+			counts['kept'], counts['duplicate'], counts['conflict'], counts['dropped'], counts['fixed'], order)
+		problems = counts['problems'] if verbose else [problem for problem in counts['problems'] if 'conflicts' in problem]
+		for problem in problems:
+			print "    " + problem
+
+def clean_files(raw_files, output_file = None, layout = None, date_order = None):
+	# with an output file every game goes into it once, otherwise each file is cleaned to clean_<file> on its own
+	if output_file:
+		with open(output_file, 'wb') as output:
+			cleaner = Cleaner(csv.writer(output, delimiter=',').writerow)
+			for raw_file in raw_files:
+				cleaner.clean_file(raw_file, layout, date_order)
+		return cleaner.report
+
+	report = []
+	for raw_file in raw_files:
+		directory, name = os.path.split(raw_file)
+		with open(os.path.join(directory, 'clean_' + name), 'wb') as output:
+			report.append(Cleaner(csv.writer(output, delimiter=',').writerow).clean_file(raw_file, layout, date_order))
+	return report
+
+def main():
+	parser = argparse.ArgumentParser(description="Clean raw result exports into a games file")
+	parser.add_argument('raw_files', nargs='*', default=['march.csv'])
+	parser.add_argument('-o', '--output', help="merge every file into this games file")
+	parser.add_argument('--date-order', choices=['dmy', 'mdy'], help="skip the date detection")
+	parser.add_argument('--layout', choices=['export', 'clean'], help="skip the layout detection. export: date,event,team,score,opponent,score  clean: date,team,score,opponent,score")
+	parser.add_argument('-v', '--verbose', action='store_true', help="list every dropped row too")
+	args = parser.parse_args()
+
+	report = clean_files(args.raw_files, args.output, args.layout, args.date_order)
+	print_report(report, args.verbose)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,259 @@
+# One way to drive every ranking method, and a harness that runs them side by side
+# Each engine loads a ranking window from a shared gamestore.GameStore, solves it and returns a
+# regression.RankingSnapshot with its SolverDiagnostics, whichever module the method lives in:
+#
+# store = GameStore('clean_june_official.csv')
+# snapshot = engines['iterative'].rank(store, 20170601, 20180531)
+# snapshot.top(10)
+#
+# compare() ranks the same windows with several engines and reports how far their active rankings agree
+# (Kendall's tau on the teams both rank), how well each predicts the games played in the weeks after the
+# window (DOS error and winners called), and how long each took
+#
+# python engines.py clean_june_official.csv --windows 20170101-20171231 20180101-20180930
+# the season engine only ranks windows within one calendar year, it reports a ValueError for any other
+# python engines.py MRDAallgames.csv --windows 20160101-20161231 --engines regression iterative --horizon 60 --output compare.json
+
+import sys
+import json
+import time
+import argparse
+import datetime as dt
+import numpy as np
+
+import regression
+import OOiterative
+import OOranking
+from gamestore import GameStore, date2int
+
+class Engine:
+	# what compare needs from an engine: a name, and rank(store, start, end) returning a RankingSnapshot of the window,
+	# start and end as YYYYMMDD, which each engine below defines
+	# expected_DOS is the engine's prediction for a game between two teams in that snapshot
+	name = None
+
+	def expected_DOS(self, snapshot, home_team, away_team):
+		return snapshot.expected_DOS(home_team, away_team)
+
+class RegressionEngine(Engine):
+	# any regression.Ranking subclass that takes (start, end, games, teams, hiatus, disbanded)
+	def __init__(self, name, ranking_class, teams_file = None, hiatus_file = None, disbanded_file = None):
+		self.name = name
+		self.ranking_class = ranking_class
+		self.teams_file = teams_file
+		self.hiatus_file = hiatus_file
+		self.disbanded_file = disbanded_file
+
+	def make_ranking(self, store, start, end):
+		return self.ranking_class(start, end, store, self.teams_file, self.hiatus_file, self.disbanded_file)
+
+	def rank(self, store, start, end):
+		ranking = self.make_ranking(store, start, end)
+		ranking.interactive = False
+		ranking.outputs = []
+		ranking.create_ranking()
+		return ranking.snapshot
+
+class WFTDAEngine(RegressionEngine):
+	def __init__(self, name, teams_file = None, hiatus_file = None, disbanded_file = None):
+		RegressionEngine.__init__(self, name, regression.WFTDARanking, teams_file, hiatus_file, disbanded_file)
+
+	def expected_DOS(self, snapshot, home_team, away_team):
+		# the method has no score model, so each team's share of the ranking points is taken as its expected share of the score
+		home_power = snapshot.power_of(home_team)
+		away_power = snapshot.power_of(away_team)
+		if home_power + away_power <= 0:
+			return 0.0
+		return (home_power - away_power)/(home_power + away_power)
+
+class _Result:
+	# what RankingSnapshot reads from a ranking, filled in from one of the OO methods' teams
+	# the OO methods predict with -1 + 2/(1 + exp((away - home)/100)), which is the snapshot's tanh curve with s = 100
+	def __init__(self, engine_name, start, end, store, teams, diagnostics):
+		self.engine_name = engine_name
+		self.start = start
+		self.end = end
+		self.s = OOiterative.scaling_factor
+		self.diagnostics = diagnostics
+		self.games = store.games(start, end)
+		self.fixed_order = sorted(teams)
+		self.teams = {}
+		for name in self.fixed_order:
+			team = regression.Team(name)
+			team.power = teams[name].power if teams[name].power is not None else float('nan')
+			team.min_games_required = teams[name].min_games_required
+			team.min_unique_opponents = teams[name].min_unique_opponents
+			self.teams[name] = team
+		# counted from the window's games, Season adds to num_games on every replay
+		for game in self.games:
+			for name, opponent in [(game.home_team, game.away_team), (game.away_team, game.home_team)]:
+				if name in self.teams:
+					self.teams[name].increment_games()
+					self.teams[name].add_opponent(opponent)
+
+		# ranked as the OO methods' print_rankings decide it
+		ranked = [self.teams[name] for name in self.fixed_order if teams[name].power is not None and not teams[name].hiatus
+			and not getattr(teams[name], 'disbanded', False) and teams[name].is_connected]
+		ranked.sort(key=lambda team: team.power, reverse=True)
+		self.ranked_list_full = ranked
+		self.ranked_list_active = [team for team in ranked if team.is_active()]
+		for rank, team in enumerate(self.ranked_list_active, 1):
+			team.rank = rank
+
+class IterativeEngine(Engine):
+	# OOiterative.Ranking, season replays until the powers settle
+	def __init__(self, name):
+		self.name = name
+
+	def rank(self, store, start, end):
+		ranking = OOiterative.Ranking(start, end)
+		ranking.load_games(store)
+		ranking.load_teams()
+		ranking.calc_iterative_ranking()
+		return regression.RankingSnapshot(_Result(self.name, ranking.start, ranking.end, store, ranking.teams, ranking.diagnostics))
+
+class _SeasonWindow:
+	# the store as OOranking.Season.load_games reads it, holding only the games between start and end
+	def __init__(self, store, start, end):
+		self.store = store
+		self.start = start
+		self.end = end
+
+	def rows(self, start, end):
+		return self.store.rows(max(start, self.start), min(end, self.end))
+
+	def row(self, i):
+		return self.store.row(i)
+
+class SeasonEngine(Engine):
+	# OOranking.Season works on one calendar year, so a window must fall within a year and the season is given only the
+	# window's games, with the season's own iterated powers as there is no earlier season to seed it from
+	def __init__(self, name):
+		self.name = name
+
+	def rank(self, store, start, end):
+		start_time = time.time()
+		start = regression.str2dt(start)
+		end = regression.str2dt(end)
+		if start.year != end.year:
+			raise ValueError("The season engine ranks within one calendar year, %s to %s spans %d to %d" %(start, end, start.year, end.year))
+		season = OOranking.Season(start.year)
+		season.load_games(_SeasonWindow(store, date2int(start), date2int(end)))
+		season.load_teams_for_seeding()
+		season.seed_ranking_for_next_year()
+		diagnostics = regression.SolverDiagnostics()
+		# a season replay counts as one function evaluation and the indicator team's last change stands in for the gradient norm
+		converged = season.last_change <= .001
+		diagnostics.add_stage('season replay', season.replays, 0, season.last_change, 1 if converged else 5,
+			"%d replays, the indicator team's power moved %.2e in the last" %(season.replays, season.last_change), time.time() - start_time, converged)
+		return regression.RankingSnapshot(_Result(self.name, start, end, store, season.teams, diagnostics))
+
+engines = {
+	'regression': RegressionEngine('regression', regression.Ranking),
+	'dynamic': RegressionEngine('dynamic', regression.DynamicRanking),
+	'wftda': WFTDAEngine('wftda'),
+	'iterative': IterativeEngine('iterative'),
+	'season': SeasonEngine('season'),
+}
+
+def prediction_error(engine, snapshot, store, horizon_days = 90):
+	# how well the snapshot predicts the games in the horizon_days after its window, between teams it has a power for
+	first = snapshot.end + dt.timedelta(1)
+	last = snapshot.end + dt.timedelta(horizon_days)
+	errors = []
+	winners = 0
+	for game in store.games(first, last):
+		if game.home_team not in snapshot.index or game.away_team not in snapshot.index:
+			continue
+		predicted = engine.expected_DOS(snapshot, game.home_team, game.away_team)
+		if np.isnan(predicted):
+			continue
+		errors.append(abs(predicted - game.DOS))
+		if (predicted > 0) == (game.DOS > 0):
+			winners += 1
+	if not errors:
+		return {'games_predicted': 0, 'DOS_error': None, 'winners_called': None}
+	return {'games_predicted': len(errors), 'DOS_error': float(np.mean(errors)), 'winners_called': float(winners)/len(errors)}
+
+def rank_agreement(first, second):
+	# Kendall's tau between two snapshots' powers over the teams active in both, None with fewer than two such teams
+	from scipy.stats import kendalltau
+	common = [name for name in first.names if name in second.index and first.rank_of(name) and second.rank_of(name)]
+	if len(common) < 2:
+		return None, len(common)
+	tau = kendalltau([first.power_of(name) for name in common], [second.power_of(name) for name in common])[0]
+	return float(tau), len(common)
+
+def compare(engine_list, store, windows, horizon_days = 90):
+	# ranks every window with every engine, returns a report that json can write out
+	report = {'horizon_days': horizon_days, 'windows': []}
+	for start, end in windows:
+		window = {'start': str(start), 'end': str(end), 'engines': {}, 'kendall_tau': []}
+		snapshots = []
+		for engine in engine_list:
+			result = {'status': 'ok', 'time': None, 'teams': 0, 'active': 0, 'converged': None}
+			start_time = time.time()
+			try:
+				snapshot = engine.rank(store, start, end)
+			except (regression.ConvergenceError, ValueError, KeyError, IndexError) as error:
+				result['status'] = "%s: %s" %(error.__class__.__name__, error)
+				result['time'] = time.time() - start_time
+				window['engines'][engine.name] = result
+				continue
+			result['time'] = time.time() - start_time
+			result['teams'] = len(snapshot.order)
+			result['active'] = len(snapshot.active_order)
+			result['converged'] = snapshot.diagnostics.converged()
+			result.update(prediction_error(engine, snapshot, store, horizon_days))
+			window['engines'][engine.name] = result
+			snapshots.append((engine.name, snapshot))
+		for i, (first_name, first) in enumerate(snapshots):
+			for second_name, second in snapshots[i + 1:]:
+				tau, num_teams = rank_agreement(first, second)
+				window['kendall_tau'].append({'engines': [first_name, second_name], 'tau': tau, 'teams': num_teams})
+		report['windows'].append(window)
+	return report
+
+def print_report(report):
+	for window in report['windows']:
+		print "\nWindow %s to %s, predicting the next %d days" %(window['start'], window['end'], report['horizon_days'])
+		print "%-12s %6s %7s %9s %6s %10s %8s  %s" %("Engine", "Teams", "Active", "Time (s)", "Games", "DOS error", "Winners", "Result")
+		for name in sorted(window['engines']):
+			result = window['engines'][name]
+			if result['status'] != 'ok':
+				print "%-12s %6s %7s %9.2f %6s %10s %8s  %s" %(name, "", "", result['time'], "", "", "", result['status'])
+			elif result['games_predicted']:
+				print "%-12s %6d %7d %9.2f %6d %10.3f %7.1f%%  ok" %(name, result['teams'], result['active'], result['time'], result['games_predicted'],
+					result['DOS_error'], 100*result['winners_called'])
+			else:
+				print "%-12s %6d %7d %9.2f %6d %10s %8s  ok" %(name, result['teams'], result['active'], result['time'], 0, "-", "-")
+		if window['kendall_tau']:
+			print "\nRank agreement (Kendall's tau over the teams active in both)"
+			for pair in window['kendall_tau']:
+				tau = "%.3f" %(pair['tau']) if pair['tau'] is not None else "-"
+				print "%-12s %-12s %6s  %d teams" %(pair['engines'][0], pair['engines'][1], tau, pair['teams'])
+
+def _window(text):
+	start, end = text.split('-')
+	return int(start), int(end)
+
+def main():
+	parser = argparse.ArgumentParser(description="Rank the same windows with several engines and compare them")
+	parser.add_argument('games', nargs='+', help="games files, merged into one store if there are several")
+	parser.add_argument('--windows', type=_window, nargs='+', required=True, metavar='START-END', help="ranking windows as YYYYMMDD-YYYYMMDD")
+	parser.add_argument('--engines', nargs='+', choices=sorted(engines), default=['regression', 'iterative', 'season', 'wftda'])
+	parser.add_argument('--horizon', type=int, default=90, help="days after each window whose games are predicted")
+	parser.add_argument('--output', help="also write the report to this JSON file")
+	args = parser.parse_args()
+
+	# region detection and connectivity are recursive
+	sys.setrecursionlimit(100000)
+	store = GameStore(args.games[0] if len(args.games) == 1 else args.games)
+	report = compare([engines[name] for name in args.engines], store, args.windows, args.horizon)
+	print_report(report)
+	if args.output:
+		with open(args.output, 'w') as output:
+			json.dump(report, output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,242 @@
+# A parsed copy of a games file that many rankings can share
+# Games are kept column by column in compact arrays (dates as YYYYMMDD integers, teams as indices into
+# a team registry) so a large history costs a few bytes per game rather than a full object per game
+# The Game objects the rankings need are only built when a ranking window first asks for them,
+# and are then reused by every later window, so parsing happens once however many rankings run
+#
+# store = GameStore('clean_june_official.csv')
+# ranking = regression.Ranking(20171205, 20181205, store, 'teams.csv')
+#
+# A list of files, or a directory of them, is merged into one store in date order with each game kept once,
+# see clean_up.Cleaner.merge_files
+# store = GameStore(['MRDAallgames.csv', 'march_clean.csv', 'clean_june_official.csv', 'june_test.csv'])
+
+import os
+import csv
+import datetime as dt
+from array import array
+
+import regression
+
+def date2int(date):
+	# the inverse of regression.str2dt, YYYYMMDD as an integer
+	return date.year*10000 + date.month*100 + date.day
+
+def normalise_date(value, date_order = 'dmy'):
+	# returns the date as a YYYYMMDD string
+	# accepts a date or datetime (as spreadsheets give), YYYYMMDD, or a d/m/y or m/d/y date as found in the raw exports
+	if isinstance(value, (dt.date, dt.datetime)):
+		return "%04d%02d%02d" %(value.year, value.month, value.day)
+	value = str(value).strip()
+	if value.isdigit() and len(value) == 8:
+		date = regression.str2dt(value)
+	else:
+		parts = value.split("/")
+		if len(parts) != 3:
+			raise ValueError("Can't read the date %s" %(value))
+		if date_order == 'dmy':
+			day, month, year = [int(part) for part in parts]
+		else:
+			month, day, year = [int(part) for part in parts]
+		if year < 100:
+			year += 2000
+		date = dt.date(year, month, day)
+	return "%04d%02d%02d" %(date.year, date.month, date.day)
+
+def as_text(value):
+	# spreadsheet cells come back as unicode, numbers, dates or None, everything else here uses utf-8 byte strings
+	if value is None:
+		return ''
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return str(value)
+
+def _team_name(value):
+	return " ".join(as_text(value).split())
+
+def normalise_row(row, layout = 'clean', date_order = 'dmy'):
+	# turns a row from any of the result sources into the clean format: YYYYMMDD,Team 1 Name,XXX,Team 2 name,YYY
+	# layout 'clean' is that format already, 'export' is the official export: date,event,team,score,opponent,score,...
+	# as either a csv row or a spreadsheet row
+	# returns None for rows that can't be a game: headers, blank rows, missing or 0-0 scores, a team playing itself
+	if layout == 'export':
+		row = [row[0], row[2], row[3], row[4], row[5]] if len(row) >= 6 else []
+	if len(row) < 5 or not row[1] or not row[3]:
+		return None
+	try:
+		date = normalise_date(row[0], date_order)
+		home_score = int(row[2])
+		away_score = int(row[4])
+	except (ValueError, TypeError):
+		return None
+	home_team = _team_name(row[1])
+	away_team = _team_name(row[3])
+	if home_team == away_team or home_score < 0 or away_score < 0 or home_score + away_score == 0:
+		return None
+	return [date, home_team, str(home_score), away_team, str(away_score)]
+
+def game_key(row):
+	# identifies a game whichever team is listed first: the date and the two teams in alphabetical order
+	return (row[0],) + tuple(sorted([row[1], row[3]]))
+
+def game_scores(row):
+	# the scores as {team: score}, so two listings of a game can be compared whichever team is listed first
+	return {row[1]: int(row[2]), row[3]: int(row[4])}
+
+class GameMeetings:
+	# the games seen so far under each game_key, telling a second game on the same day from the same game listed again
+	# a row is the same game as one already seen only if its scores match. The raw export lists every game from both
+	# teams' sides, so listings are counted by the team listed first: a source that lists more differently scored games
+	# from one side than are known has found another meeting that day, e.g. a double-header.
+	# A row that matches none of the known games but doesn't add a meeting from its side disagrees with one of them,
+	# like a typo in one side's listing of a game. So a file listing each game once has to list both games of a
+	# double-header with the same team first for the second to be kept, otherwise it is reported as a conflict
+	def __init__(self):
+		self.scores = {} # game key -> [scores by team], one for each game the two teams played that day
+		self.listed = {} # (source, game key, team listed first) -> [scores by team], the different games listed that way
+
+	def __contains__(self, key):
+		return key in self.scores
+
+	def __len__(self):
+		return sum(len(scores) for scores in self.scores.values())
+
+	def check(self, row, source = None):
+		# 'duplicate', 'new' (recorded as another game on that day) or 'conflict' (not recorded)
+		key = game_key(row)
+		scores = game_scores(row)
+		listed = self.listed.setdefault((source, key, row[1]), [])
+		if scores not in listed:
+			listed.append(scores)
+		known = self.scores.setdefault(key, [])
+		if scores in known:
+			return 'duplicate'
+		if len(listed) > len(known):
+			known.append(scores)
+			return 'new'
+		return 'conflict'
+
+	def add(self, row):
+		# records row as a game of its own unless a game with its scores is known, for rows already known to be separate games
+		known = self.scores.setdefault(game_key(row), [])
+		if game_scores(row) not in known:
+			known.append(game_scores(row))
+
+	def correct(self, row):
+		# takes row's scores as the only game on its day, for a source trusted over the others
+		key = game_key(row)
+		self.scores[key] = [game_scores(row)]
+
+	def rows(self):
+		# every game as a row in the clean format, in key order
+		return [[key[0], key[1], str(scores[key[1]]), key[2], str(scores[key[2]])] for key in sorted(self.scores) for scores in self.scores[key]]
+
+def read_xlsx_rows(xlsx_file, sheet = 'By Date'):
+	# yields the rows of a sheet one at a time as lists of cell values
+	# read only mode streams the sheet from the file rather than loading the whole workbook,
+	# data_only gives the last calculated value of formula cells rather than the formula
+	import openpyxl # only needed for spreadsheets
+	workbook = openpyxl.load_workbook(xlsx_file, read_only=True, data_only=True)
+	try:
+		for row in workbook[sheet].iter_rows(values_only=True):
+			yield list(row)
+	finally:
+		workbook.close()
+
+def source_files(sources):
+	# the games files named by a file, a directory of .csv and .xlsx files, or a list of either
+	# a directory's files are taken in name order
+	if isinstance(sources, basestring):
+		if not os.path.isdir(sources):
+			return [sources]
+		return sorted(os.path.join(sources, name) for name in os.listdir(sources) if name.endswith(('.csv', '.xlsx')))
+	files = []
+	for source in sources:
+		files.extend(source_files(source))
+	return files
+
+class GameStore:
+	def __init__(self, games_file = None):
+		self.dates = array('l') # YYYYMMDD
+		self.home_teams = array('i') # indices into team_names
+		self.home_scores = array('i')
+		self.away_teams = array('i')
+		self.away_scores = array('i')
+		self.team_names = []
+		self.team_index = {}
+		self._games = [] # Game objects, None until a ranking asks for them
+		self.load_report = [] # what clean_up.Cleaner made of each spreadsheet or merged file loaded
+		if games_file is not None:
+			self.load(games_file)
+
+	def __len__(self):
+		return len(self.dates)
+
+	def team_id(self, name):
+		# index of the team in the registry, registering it if it is new
+		if name not in self.team_index:
+			self.team_index[name] = len(self.team_names)
+			self.team_names.append(name)
+		return self.team_index[name]
+
+	def add(self, game_data):
+		# game_data is a row in the clean format: YYYYMMDD,Team 1 Name,XXX,Team 2 name,YYY
+		self.dates.append(int(game_data[0]))
+		self.home_teams.append(self.team_id(game_data[1]))
+		self.home_scores.append(int(game_data[2]))
+		self.away_teams.append(self.team_id(game_data[3]))
+		self.away_scores.append(int(game_data[4]))
+		self._games.append(None)
+
+	def load(self, games_file):
+		# games_file can also be a list of files or a directory, see load_sources
+		if not isinstance(games_file, basestring) or os.path.isdir(games_file):
+			self.load_sources(source_files(games_file))
+			return
+		if games_file.endswith('.xlsx'):
+			self.load_xlsx(games_file)
+			return
+		with open(games_file, 'rU') as csvfile:
+			for game in csv.reader(csvfile, dialect='excel'):
+				self.add(game)
+
+	def load_xlsx(self, xlsx_file, sheet = 'By Date'):
+		# reads the official export straight into the store, cleaned and deduped the same way clean_up.py does it
+		from clean_up import Cleaner # clean_up imports this module
+		self.load_report.append(Cleaner(self.add).clean_file(xlsx_file, sheet=sheet))
+
+	def load_sources(self, games_files):
+		# merges overlapping files in date order, a game listed in several files is stored once
+		# and a game given different scores in two files is kept as first found and reported in conflicts()
+		from clean_up import Cleaner
+		self.load_report.extend(Cleaner(self.add).merge_files(games_files))
+
+	def conflicts(self):
+		# the games the loaded files disagree about
+		return [counts['file'] + ": " + problem for counts in self.load_report for problem in counts['problems'] if 'conflicts' in problem]
+
+	def row(self, i):
+		# the i-th game as it would appear in a games file
+		return [str(self.dates[i]), self.team_names[self.home_teams[i]], str(self.home_scores[i]), self.team_names[self.away_teams[i]], str(self.away_scores[i])]
+
+	def rows(self, start = None, end = None):
+		# indices of the games played between start and end inclusive, in file order
+		# start and end may be datetime.date objects or YYYYMMDD integers
+		if isinstance(start, dt.date):
+			start = date2int(start)
+		if isinstance(end, dt.date):
+			end = date2int(end)
+		dates = self.dates
+		return [i for i in xrange(len(dates)) if (start is None or start <= dates[i]) and (end is None or dates[i] <= end)]
+
+	def game(self, i):
+		if self._games[i] is None:
+			self._games[i] = regression.Game(self.row(i))
+		return self._games[i]
+
+	def games(self, start = None, end = None):
+		# the Game objects for a ranking window, shared between every ranking that uses this store
+		return [self.game(i) for i in self.rows(start, end)]
+
+	def columns(self):
+		return {'date': self.dates, 'home_team': self.home_teams, 'home_score': self.home_scores, 'away_team': self.away_teams, 'away_score': self.away_scores}
@@ -0,0 +1,455 @@
+# Follows a games file as results are appended to it, reading only the rows added since the last look
+# The follower remembers how many bytes it has parsed and a hash of those bytes. Each time the file
+# changes, it checks the hash still matches. If an earlier row was edited or the file was replaced, it
+# reports a rewrite so the caller can reload everything. Otherwise it parses only the bytes past the offset
+# New rows are held until the file has been quiet for the debounce period. A weekend's worth of results
+# appended one at a time then arrive as a single batch, and cause one re-solve rather than one each
+#
+# follower = GamesFileFollower('clean_june_official.csv', on_games, on_reload)
+# follower.start()
+
+import os
+import csv
+import json
+import time
+import Queue
+import hashlib
+import threading
+
+from gamestore import normalise_row, game_key, game_scores, GameMeetings, read_xlsx_rows
+from clean_up import detect_layout, detect_date_order
+
+class GamesFileFollower:
+	def __init__(self, games_file, on_games, on_reload = None, interval = 1.0, debounce = 5.0):
+		self.games_file = games_file
+		self.on_games = on_games # called with a list of new rows, once per burst
+		self.on_reload = on_reload # called with every row in the file after a rewrite
+		self.interval = interval # seconds between looks at the file
+		self.debounce = debounce # seconds the file must be quiet before a burst is passed on
+		self.offset = 0 # bytes parsed so far, at the end of a line unless open_line is set
+		self.prefix_hash = hashlib.sha1() # hash of those bytes
+		self.open_line = False # the parsed bytes stop part way through a row, only after skip_existing
+		self.last_change = None # (size, modification time) when the file was last read
+		self.held = [] # new rows waiting for the file to go quiet
+		self.last_new_rows = 0.0
+		self.reloads = 0
+		self.running = False
+
+	def _prefix_unchanged(self, games):
+		# re-hashes the bytes that were already parsed, reading is far cheaper than parsing
+		check = hashlib.sha1()
+		remaining = self.offset
+		while remaining > 0:
+			block = games.read(min(remaining, 1 << 16))
+			if not block:
+				return False
+			check.update(block)
+			remaining -= len(block)
+		return check.digest() == self.prefix_hash.digest()
+
+	def _parse(self, data):
+		return [row for row in csv.reader(data.splitlines(), dialect='excel') if row]
+
+	def read_new_rows(self, whole_file = False):
+		# returns (rewritten, rows). rows are every game in the file if it was rewritten, otherwise only the new ones
+		status = os.stat(self.games_file)
+		change = (status.st_size, status.st_mtime)
+		if change == self.last_change and not (whole_file and status.st_size > self.offset):
+			return False, []
+		self.last_change = change
+
+		with open(self.games_file, 'rb') as games:
+			rewritten = status.st_size < self.offset or not self._prefix_unchanged(games)
+			data = games.read()
+			if self.open_line and data and data[0] not in '\r\n':
+				# the last row that was already parsed has been written onto, so it has changed
+				rewritten = True
+			if rewritten:
+				self.offset = 0
+				self.prefix_hash = hashlib.sha1()
+				games.seek(0)
+				data = games.read()
+
+		if whole_file:
+			complete = len(data)
+		else:
+			# a row still being written has no newline yet, leave it for the next look
+			# the raw exports end their lines with a bare carriage return
+			complete = max(data.rfind('\n'), data.rfind('\r')) + 1
+		data = data[:complete]
+		if complete:
+			self.open_line = data[-1] not in '\r\n'
+		self.offset += complete
+		self.prefix_hash.update(data)
+		return rewritten, self._parse(data)
+
+	def poll(self):
+		# one look at the file, passes on a burst of rows once the file has gone quiet
+		rewritten, rows = self.read_new_rows()
+		now = time.time()
+		if rewritten:
+			self.held = []
+			self.reloads += 1
+			if self.on_reload is not None:
+				self.on_reload(rows)
+			return
+		if rows:
+			self.held.extend(rows)
+			self.last_new_rows = now
+		if self.held and now - self.last_new_rows >= self.debounce:
+			rows, self.held = self.held, []
+			self.on_games(rows)
+
+	def position(self):
+		# enough to carry on from the same place after a restart, see restore
+		return {'offset': self.offset, 'sha1': self.prefix_hash.hexdigest()}
+
+	def restore(self, position):
+		# picks up from a saved position if the file still starts with the bytes that were parsed, otherwise starts again
+		self.offset = 0
+		self.prefix_hash = hashlib.sha1()
+		self.open_line = False
+		self.last_change = None
+		if not os.path.exists(self.games_file) or os.path.getsize(self.games_file) < position['offset']:
+			return False
+		with open(self.games_file, 'rb') as games:
+			data = games.read(position['offset'])
+		if hashlib.sha1(data).hexdigest() != position['sha1']:
+			return False
+		self.offset = position['offset']
+		self.prefix_hash.update(data)
+		return True
+
+	def skip_existing(self):
+		# treats everything already in the file as seen, for callers that have just loaded it some other way
+		# csv.reader reads a last row with no newline, so that row counts as seen too
+		self.read_new_rows(whole_file=True)
+
+	def _follow(self):
+		while self.running:
+			self.poll()
+			time.sleep(self.interval)
+
+	def start(self):
+		self.running = True
+		self.follower = threading.Thread(target=self._follow)
+		self.follower.daemon = True
+		self.follower.start()
+
+	def stop(self):
+		self.running = False
+		self.follower.join()
+
+# Several result feeds at once
+# Each source is watched by its own thread, which puts any new rows on a bounded queue. A full queue makes
+# the watchers wait, so a slow consumer holds the sources back rather than piling rows up in memory.
+# A single consumer thread normalises each row to the clean format, drops rows it can't use, and dedupes by
+# game (date, the two teams whichever is listed first, and the scores, so a double-header is two games,
+# see gamestore.GameMeetings). It then hands new games and corrected scores
+# to a sink such as service.RankingService, which does the solving on its own thread. Once a batch has
+# been processed, the source's position is saved to a state file, so a restart carries on where it left off.
+# The games handed over are saved with the positions, and start passes them to the sink again, as a sink
+# rebuilt from its games file after a restart won't have them. A game is dropped from the state file once
+# mark_seen says the sink's own files have it. If the sink fails, the games are kept in the state file
+# and handed over again with the next batch, or after a short wait when nothing else arrives
+#
+# pipeline = IngestionPipeline([CsvSource('June_official.csv'), XlsxSource('Official_june.xlsx'),
+#	CsvSource('corrections.csv', authoritative=True)], service, 'ingest_state.json')
+# pipeline.start()
+
+class CsvSource:
+	# a csv file of results that grows at the end, read with a GamesFileFollower
+	# layout is 'clean' or 'export' as in gamestore.normalise_row
+	# left as None, the layout and date order are worked out from the file the same way clean_up.py does it
+	# rows from an authoritative source (manual corrections) replace a game already seen with different scores
+	def __init__(self, path, name = None, layout = None, date_order = None, authoritative = False):
+		self.name = name or os.path.basename(path)
+		self.path = path
+		self.layout = layout
+		self.date_order = date_order
+		self.fixed_date_order = date_order is not None
+		self.authoritative = authoritative
+		self.follower = GamesFileFollower(path, None)
+
+	def read_new(self):
+		# a rewritten file is read again from the top, rows already seen are dropped by the pipeline
+		if not os.path.exists(self.path):
+			return []
+		last_change = self.follower.last_change
+		rewritten, rows = self.follower.read_new_rows()
+		if not rows and self.follower.last_change == last_change:
+			# nothing has been written since the last look, so a last row without a newline is complete
+			rewritten, rows = self.follower.read_new_rows(whole_file=True)
+		if rows:
+			if self.layout is None:
+				self.layout = detect_layout(self.path)
+			if not self.fixed_date_order:
+				# until a date settles it, day first is assumed
+				detected = detect_date_order(self.path)
+				self.date_order = detected or 'dmy'
+				self.fixed_date_order = detected is not None
+		return rows
+
+	def position(self):
+		return self.follower.position()
+
+	def restore(self, position):
+		return self.follower.restore(position)
+
+class XlsxSource:
+	# a spreadsheet in the layout of the official export, re-read whenever it is saved
+	# a spreadsheet can't be read from an offset, so the position is the number of rows read and a hash of them
+	def __init__(self, path, name = None, sheet = 'By Date', authoritative = False):
+		self.name = name or os.path.basename(path)
+		self.path = path
+		self.sheet = sheet
+		self.layout = 'export'
+		self.date_order = 'dmy'
+		self.authoritative = authoritative
+		self.rows_read = 0
+		self.rows_hash = hashlib.sha1().hexdigest()
+		self.last_change = None
+
+	def read_new(self):
+		if not os.path.exists(self.path):
+			return []
+		status = os.stat(self.path)
+		change = (status.st_size, status.st_mtime)
+		if change == self.last_change:
+			return []
+		self.last_change = change
+		rows = list(read_xlsx_rows(self.path, self.sheet))
+		if hashlib.sha1(repr(rows[:self.rows_read])).hexdigest() == self.rows_hash:
+			new_rows = rows[self.rows_read:]
+		else:
+			new_rows = rows # an earlier row was edited
+		self.rows_read = len(rows)
+		self.rows_hash = hashlib.sha1(repr(rows)).hexdigest()
+		return new_rows
+
+	def position(self):
+		return {'rows': self.rows_read, 'sha1': self.rows_hash}
+
+	def restore(self, position):
+		self.rows_read = position['rows']
+		self.rows_hash = position['sha1']
+		self.last_change = None
+		return True
+
+def load_sources(config_file):
+	# reads a JSON list of sources, or {"sources": [...]}, each like
+	# {"path": "june.csv", "type": "csv", "layout": "export", "date_order": "dmy", "authoritative": false, "name": "june"}
+	# layout and date_order are optional for csv sources, they are detected from the file if left out
+	# {"path": "Official_june.xlsx", "type": "xlsx", "sheet": "By Date"}
+	# paths are relative to the config file
+	with open(config_file, 'r') as cfile:
+		config = json.load(cfile)
+	if isinstance(config, list):
+		config = {'sources': config}
+	base = os.path.dirname(os.path.abspath(config_file))
+	sources = []
+	for settings in config['sources']:
+		path = os.path.join(base, settings['path'])
+		if settings.get('type', 'csv') == 'xlsx':
+			sources.append(XlsxSource(path, settings.get('name'), settings.get('sheet', 'By Date'), settings.get('authoritative', False)))
+		else:
+			sources.append(CsvSource(path, settings.get('name'), settings.get('layout'), settings.get('date_order'), settings.get('authoritative', False)))
+	return sources
+
+class IngestionPipeline:
+	def __init__(self, sources, sink, state_file = None, queue_size = 100, interval = 1.0):
+		self.sources = sources
+		self.sink = sink # needs add_games(rows) and correct_games(rows), in_period(rows) is used if it has one
+		self.state_file = state_file
+		self.queue = Queue.Queue(queue_size) # (source, rows, position) waiting to be processed
+		self.interval = interval
+		self.seen = GameMeetings() # every game passed on so far
+		self.sink_games = GameMeetings() # the games mark_seen says the sink already has
+		self.positions = {}
+		self.delivered = [] # [action, row] for every game handed to the sink, 'add' or 'correct', kept in the state file
+		self.undelivered = [] # [action, row] for the games the sink failed to take, handed over again by _flush
+		self.last_error = None # the last error the sink raised
+		self.retry_delay = 10.0 # seconds before the games the sink failed to take are handed over again, if no batch comes first
+		self.last_attempt = 0.0
+		self.replayed = False
+		self.counts = {'new': 0, 'duplicate': 0, 'corrected': 0, 'conflict': 0, 'rejected': 0}
+		self.conflicts = [] # (source name, row, [scores already seen]) for rows that disagree with the games already seen that day
+		self.running = False
+		self.threads = []
+		self._load_state()
+
+	def _load_state(self):
+		if self.state_file and os.path.exists(self.state_file):
+			with open(self.state_file, 'r') as sfile:
+				state = json.load(sfile)
+			if 'positions' not in state:
+				state = {'positions': state} # a state file from before the games were kept in it
+			self.positions = state['positions']
+			self.delivered = [[action, [item.encode('utf-8') for item in row]] for action, row in state.get('games', [])]
+			self.undelivered = [[action, [item.encode('utf-8') for item in row]] for action, row in state.get('undelivered', [])]
+			for row in state.get('seen', []):
+				# a state file from before seen was rebuilt from the games
+				self.seen.add([item.encode('utf-8') for item in row])
+			# the games the sink already has are added by mark_seen, so seen only needs the ones passed on from here
+			for action, row in self.delivered + self.undelivered:
+				if action == 'correct':
+					self.seen.correct(row)
+				else:
+					self.seen.add(row)
+			for source in self.sources:
+				if source.name in self.positions and not source.restore(self.positions[source.name]):
+					print "%s has changed since it was last read, reading it from the start" %(source.name)
+
+	def _save_state(self):
+		if self.state_file:
+			# written to the side and renamed, so a crash never leaves a half written state file
+			with open(self.state_file + '.tmp', 'w') as sfile:
+				json.dump({'positions': self.positions, 'games': self.delivered, 'undelivered': self.undelivered}, sfile, indent=2, sort_keys=True)
+			os.rename(self.state_file + '.tmp', self.state_file)
+
+	def mark_seen(self, rows):
+		# games that are already in the ranking, e.g. from its games file, so they aren't passed on again
+		# the games handed over before that the sink now has with the same scores don't need keeping any more
+		for row in rows:
+			self.seen.add(row)
+			self.sink_games.add(row)
+		kept = [[action, row] for action, row in self.delivered
+			if not (game_key(row) in self.sink_games and game_scores(row) in self.sink_games.scores[game_key(row)])]
+		if len(kept) < len(self.delivered):
+			self.delivered = kept
+			self._save_state()
+
+	def replay(self):
+		# hands the sink the games it was given before a restart, the sink only has the games in its own files
+		# a game the sink's files now have with the same scores is left out, with other scores it is sent as a correction
+		# the games the sink failed to take before the restart are handed over with them
+		if self.replayed:
+			return
+		self.replayed = True
+		new_games = []
+		corrections = []
+		for action, row in self.delivered + self.undelivered:
+			key = game_key(row)
+			if action == 'correct' and key in self.sink_games:
+				# a correction replaces the game the sink has rather than being another game on the day
+				found = 'duplicate' if game_scores(row) in self.sink_games.scores[key] else 'conflict'
+			else:
+				found = self.sink_games.check(row, 'replay')
+			if found == 'new':
+				new_games.append(row)
+			elif found == 'conflict':
+				self.sink_games.correct(row)
+				corrections.append(row)
+		# the games left out are in the sink's files, the rest are recorded again as the sink takes them
+		self.delivered = []
+		self.undelivered = []
+		self._send(new_games, corrections)
+		self._save_state()
+
+	def process(self, source, rows):
+		# returns the new games and the corrected games found in rows
+		new_games = []
+		corrections = []
+		for raw_row in rows:
+			row = normalise_row(raw_row, source.layout, source.date_order)
+			if row is None:
+				self.counts['rejected'] += 1
+				continue
+			found = self.seen.check(row, source.name)
+			if found == 'new':
+				new_games.append(row)
+				self.counts['new'] += 1
+			elif found == 'duplicate':
+				self.counts['duplicate'] += 1
+			elif source.authoritative and len(self.seen.scores[game_key(row)]) == 1:
+				# with a double-header on the day there is no telling which game it corrects, so it is a conflict
+				self.seen.correct(row)
+				corrections.append(row)
+				self.counts['corrected'] += 1
+			else:
+				self.conflicts.append((source.name, row, self.seen.scores[game_key(row)]))
+				self.counts['conflict'] += 1
+		return new_games, corrections
+
+	def _send(self, new_games, corrections):
+		# queues the games for the sink and hands over everything waiting
+		if hasattr(self.sink, 'in_period'):
+			new_games = self.sink.in_period(new_games)
+			corrections = self.sink.in_period(corrections)
+		self.undelivered.extend([['add', row] for row in new_games] + [['correct', row] for row in corrections])
+		self._flush()
+
+	def _flush(self):
+		# hands the sink the games waiting for it, new games before corrections as they were found
+		# whatever the sink raises is kept in last_error and the games it didn't take wait for the next call
+		self.last_attempt = time.time()
+		for action, send in [('add', self.sink.add_games), ('correct', self.sink.correct_games)]:
+			rows = [row for waiting_action, row in self.undelivered if waiting_action == action]
+			if not rows:
+				continue
+			try:
+				send(rows)
+			except Exception as error:
+				self.last_error = "%s: %s" %(error.__class__.__name__, error)
+				print "The sink failed to take %d games, they will be handed over again: %s" %(len(rows), self.last_error)
+				return False
+			self.undelivered = [[waiting_action, row] for waiting_action, row in self.undelivered if waiting_action != action]
+			if action == 'correct':
+				# a correction replaces every game the teams played that day, so the games it replaces aren't kept
+				corrected = set(game_key(row) for row in rows)
+				self.delivered = [[done_action, row] for done_action, row in self.delivered if game_key(row) not in corrected]
+			self.delivered.extend([action, row] for row in rows)
+		self.last_error = None
+		return True
+
+	def _deliver(self, source, rows, position):
+		# the position moves on even if the sink fails, the games it didn't take are in the state file
+		new_games, corrections = self.process(source, rows)
+		self._send(new_games, corrections)
+		self.positions[source.name] = position
+		self._save_state()
+
+	def _watch(self, source):
+		while self.running:
+			rows = source.read_new()
+			if rows:
+				self.queue.put((source, rows, source.position())) # waits here while the queue is full
+			time.sleep(self.interval)
+
+	def _consume(self):
+		while self.running or not self.queue.empty():
+			try:
+				source, rows, position = self.queue.get(timeout=0.5)
+			except Queue.Empty:
+				if self.undelivered and time.time() - self.last_attempt >= self.retry_delay and self._flush():
+					self._save_state()
+				continue
+			try:
+				self._deliver(source, rows, position)
+			except Exception as error:
+				# the consumer has to keep going, or the watchers would wait on a full queue for ever
+				print "Processing %d rows from %s failed: %s: %s" %(len(rows), source.name, error.__class__.__name__, error)
+			finally:
+				self.queue.task_done()
+
+	def run_once(self):
+		# reads every source once and processes what it found, without any threads
+		self.replay()
+		for source in self.sources:
+			rows = source.read_new()
+			if rows:
+				self._deliver(source, rows, source.position())
+
+	def start(self):
+		self.replay()
+		self.running = True
+		self.threads = [threading.Thread(target=self._watch, args=(source,)) for source in self.sources]
+		self.threads.append(threading.Thread(target=self._consume))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def stop(self):
+		self.running = False
+		for thread in self.threads:
+			thread.join()
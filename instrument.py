@@ -0,0 +1,131 @@
+# Lightweight timing for the ranking pipeline
+# Switched off by default - while off, timed functions and stages only check a flag
+# Switch it on with instrument.enable() (or set ROBORANK_INSTRUMENT=1 in the environment) and
+# every timed stage records its wall time and call count, along with any counters bumped inside it
+# Stages nest, so a stage is identified by its path e.g. "create_ranking;regression_ranking;fsolve"
+# The results can be written as JSON, or as folded stacks that flamegraph.pl and speedscope understand
+
+import os
+import time
+import json
+
+enabled = os.environ.get('ROBORANK_INSTRUMENT', '') not in ('', '0')
+
+_stack = [] # names of the stages currently running, outermost first
+_stages = {} # stage path -> [calls, total time, time spent in child stages]
+_counters = {} # (stage path, counter name) -> count
+
+def enable():
+	global enabled
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+def reset():
+	del _stack[:]
+	_stages.clear()
+	_counters.clear()
+
+class _NullStage:
+	# handed out while instrumentation is off so "with stage(...)" costs next to nothing
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_null_stage = _NullStage()
+
+class _Stage:
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		_stack.append(self.name)
+		self.path = ";".join(_stack)
+		self.start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		elapsed = time.time() - self.start
+		_stack.pop()
+		record = _stages.setdefault(self.path, [0, 0.0, 0.0])
+		record[0] += 1
+		record[1] += elapsed
+		if _stack:
+			_stages.setdefault(";".join(_stack), [0, 0.0, 0.0])[2] += elapsed
+		return False
+
+def stage(name):
+	# use as "with instrument.stage('sort'):" around a block of code
+	if not enabled:
+		return _null_stage
+	return _Stage(name)
+
+def timed(name):
+	# decorator that times every call to a function as the stage name
+	def decorator(func):
+		def timed_func(*args, **kwargs):
+			if not enabled:
+				return func(*args, **kwargs)
+			with _Stage(name):
+				return func(*args, **kwargs)
+		timed_func.__name__ = func.__name__
+		timed_func.__doc__ = func.__doc__
+		return timed_func
+	return decorator
+
+def count(name, amount=1):
+	# bumps a counter against whichever stage is currently running
+	if enabled:
+		key = (";".join(_stack), name)
+		_counters[key] = _counters.get(key, 0) + amount
+
+def report():
+	# returns the recorded data as plain dictionaries and lists, ready for json
+	stages = []
+	for path in sorted(_stages):
+		calls, total, children = _stages[path]
+		counters = dict((name, value) for (stage_path, name), value in _counters.items() if stage_path == path)
+		stages.append({'stage': path, 'calls': calls, 'total_time': total, 'self_time': total - children, 'counters': counters})
+	return {'stages': stages}
+
+def print_report():
+	records = report()['stages']
+	width = max([len("Stage")] + [len(record['stage']) for record in records])
+	print "\n%s  %6s  %10s  %10s  %s" %("Stage".ljust(width), "Calls", "Total (s)", "Self (s)", "Counters")
+	for record in records:
+		counters = ", ".join("%s %d" %(name, value) for name, value in sorted(record['counters'].items()))
+		print "%s  %6d  %10.4f  %10.4f  %s" %(record['stage'].ljust(width), record['calls'], record['total_time'], record['self_time'], counters)
+
+def write_json(filename):
+	with open(filename, 'w') as output:
+		json.dump(report(), output, indent=2, sort_keys=True)
+
+def write_folded(filename):
+	# one line per stage path with its self time in microseconds - the input format for flamegraph.pl
+	with open(filename, 'w') as output:
+		for record in report()['stages']:
+			microseconds = int(round(record['self_time']*1e6))
+			if microseconds > 0:
+				output.write("%s %d\n" %(record['stage'], microseconds))
+
+class profile:
+	# runs cProfile over a block of code and dumps the stats for pstats, snakeviz or gprof2dot
+	# with instrument.profile('ranking.prof'):
+	#     ranking.create_ranking()
+	def __init__(self, filename):
+		self.filename = filename
+
+	def __enter__(self):
+		import cProfile
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+		return self.profiler
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.profiler.disable()
+		self.profiler.dump_stats(self.filename)
+		return False
@@ -0,0 +1,118 @@
+# Draws Ranking.plot_team's plot for many teams at once, without a display
+# Each worker process draws on a single Agg figure made when it starts, and only swaps the curve, points and title
+# for each team rather than building a new figure through pyplot. The teams are shared out over a process pool
+# A manifest in the plot directory records a digest of what each plot was drawn from, so a plot whose
+# team has the same games and power as last time is not drawn again
+#
+# renderer = PlotRenderer('Plots')
+# renderer.render(ranking)                        every team with games
+# renderer.render(ranking, ['Austin Anarchy'])
+#
+# or add 'team_plots' to ranking.outputs and create_ranking draws them with ranking.plot_renderer
+
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+
+powers = np.arange(300, 1200, 1) # the opponent powers plot_team draws the predicted DOS over
+
+_canvas = None # (figure, curve, points) for this worker, made by _start_worker
+
+def _start_worker():
+	# the Agg canvas is attached to the figure directly, so no pyplot backend or window is ever involved
+	global _canvas
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	figure = Figure()
+	FigureCanvasAgg(figure)
+	axes = figure.add_subplot(111)
+	curve = axes.plot(powers, np.zeros(len(powers)), 'b')[0]
+	points = axes.scatter([0], [0], c=[0.0], marker='o', s=[0])
+	axes.set_xlim([300,1200])
+	axes.set_ylim([-1,1])
+	_canvas = (figure, curve, points)
+
+def _draw(task):
+	directory, data = task
+	if _canvas is None:
+		_start_worker()
+	figure, curve, points = _canvas
+	curve.set_ydata(np.tanh((data['power'] - powers)/200))
+	points.set_offsets(np.column_stack([data['opponent_powers'], data['DOS']]) if data['DOS'] else np.zeros((0, 2)))
+	points.set_sizes(np.array(data['sizes'], dtype=float))
+	points.set_array(np.array(data['colours'], dtype=float))
+	if data['colours']:
+		points.set_clim(min(data['colours']), max(data['colours'])) # as pyplot scales the colours of a new scatter
+	# team names are utf-8 byte strings, and matplotlib only draws byte strings that are plain ascii
+	figure.axes[0].set_title(data['team'].decode('utf-8') + u" predicted DOS with actual game data\nStrength = %.1f" %(data['power']))
+	figure.savefig(os.path.join(directory, data['fig_name']))
+	return data['fig_name']
+
+def _digest(data):
+	return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+class PlotRenderer:
+	def __init__(self, directory = 'Plots', processes = None):
+		self.directory = directory
+		self.processes = processes # worker processes, None for one per CPU
+		self.manifest_file = os.path.join(directory, 'plot_manifest.json')
+		self.manifest = None # plot file -> digest of the data it was drawn from, read on first use
+		self.drawn = [] # the plot files the last render drew
+		self.skipped = [] # the plot files the last render left as they were
+
+	def _load_manifest(self):
+		if self.manifest is None:
+			self.manifest = {}
+			if os.path.exists(self.manifest_file):
+				with open(self.manifest_file, 'r') as mfile:
+					self.manifest = dict((name.encode('utf-8'), digest) for name, digest in json.load(mfile).items())
+
+	def _save_manifest(self):
+		with open(self.manifest_file + '.tmp', 'w') as mfile:
+			json.dump(self.manifest, mfile, indent=1, sort_keys=True)
+		os.rename(self.manifest_file + '.tmp', self.manifest_file)
+
+	def render(self, ranking, teams = None):
+		# draws the plots of the named teams (every team with games if not given) whose data has changed
+		# returns the plot files drawn
+		if teams is None:
+			teams = [name for name in ranking.fixed_order if ranking.teams[name].num_games != 0]
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		self._load_manifest()
+
+		tasks = []
+		digests = {}
+		self.skipped = []
+		names = {}
+		for team in teams:
+			data = ranking.plot_data(team)
+			if data['fig_name'] in names:
+				# two workers would draw over each other's plot and the manifest could only remember one of them
+				raise ValueError("%s and %s would both be plotted to %s" %(names[data['fig_name']], team, data['fig_name']))
+			names[data['fig_name']] = team
+			digest = _digest(data)
+			if self.manifest.get(data['fig_name']) == digest and os.path.exists(os.path.join(self.directory, data['fig_name'])):
+				self.skipped.append(data['fig_name'])
+				continue
+			digests[data['fig_name']] = digest
+			tasks.append((self.directory, data))
+
+		processes = self.processes or multiprocessing.cpu_count()
+		if processes == 1 or len(tasks) < 2:
+			self.drawn = [_draw(task) for task in tasks]
+		else:
+			pool = multiprocessing.Pool(min(processes, len(tasks)), _start_worker)
+			try:
+				self.drawn = pool.map(_draw, tasks, chunksize=max(1, len(tasks)//(4*processes)))
+			finally:
+				pool.close()
+				pool.join()
+
+		for fig_name in self.drawn:
+			self.manifest[fig_name] = digests[fig_name]
+		if self.drawn:
+			self._save_manifest()
+		return self.drawn
@@ -1,11 +1,12 @@
 import csv
 import sys
-import copy
-from scipy import log, cosh, tanh, exp, floor
-from scipy.optimize import fsolve
+import os
+import time
+import multiprocessing
+from numpy import log, cosh, tanh, exp, floor
 import datetime as dt
-import matplotlib.pyplot as plt
 import numpy as np
+import instrument
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 #shuts up the warning when colour and point size are given to plot as vectors - this occurs because python and numpy can't agree on things
@@ -36,7 +37,437 @@ def weight(game_date,window_start, window_end):
 	else:
 		return 0
 
-class Team:
+# why scipy's lsqr stopped, by its istop
+_lsqr_stops = {
+	0: "the guess is zero",
+	1: "solved exactly",
+	2: "solved in the least squares sense",
+	3: "stopped, the system is too ill conditioned",
+	4: "solved exactly to machine precision",
+	5: "solved in the least squares sense to machine precision",
+	6: "stopped, the system is too ill conditioned for machine precision",
+	7: "stopped at the iteration limit",
+}
+
+def _regression_residuals(x, home, away, DOS, weight, s):
+	# the derivative of the weighted sum of squares with respect to each power, every game at once
+	# home and away index into x, a game adds the same term to the home team's derivative as it takes from the away team's
+	u = (x[away] - x[home])/(2*s)
+	t = tanh(u)
+	term = -(DOS + t)*(1 - t*t)/s*weight # 1 - tanh^2 = 1/cosh^2
+	return np.bincount(home, term, len(x)) - np.bincount(away, term, len(x))
+
+def _game_errors(x, home, away, DOS, weight, s):
+	# each game's weighted prediction error, the regression minimises the sum of their squares
+	return np.sqrt(weight)*(DOS + tanh((x[away] - x[home])/(2*s)))
+
+def _stuck_games(x, home, away, DOS, weight, s):
+	# games predicted so far apart that the tanh curve is flat, yet still not fitting their result
+	# the derivative of the sum of squares vanishes there without it being a minimum, moving a team a little changes nothing
+	t = tanh((x[away] - x[home])/(2*s))
+	return (weight > 0) & (1 - t*t < 1e-8) & (np.abs(DOS + t) > 1e-3)
+
+def _descend(x0, home, away, DOS, weight, s, max_iterations, tolerance):
+	# Levenberg-Marquardt steps from x0 with the first team held where it is, for _solve_region
+	# returns the powers, the sum of squares and Jacobian evaluations, and a status and message
+	from scipy.sparse import coo_matrix, diags
+	from scipy.sparse.linalg import spsolve
+	x = np.array(x0, dtype=float)
+	num_teams = len(x)
+
+	# columns of the free teams, -1 for the held one
+	column = np.arange(num_teams) - 1
+	home_column, away_column = column[home], column[away]
+	games = np.arange(len(home))
+	rows = np.concatenate([games[away_column >= 0], games[home_column >= 0]])
+	cols = np.concatenate([away_column[away_column >= 0], home_column[home_column >= 0]])
+	root_weight = np.sqrt(weight)
+
+	errors = _game_errors(x, home, away, DOS, weight, s)
+	sum_squares = errors.dot(errors)
+	damping = 1e-3
+	evaluations, jacobians = 1, 0
+	status, message = 2, "stopped after %d steps" %(max_iterations)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore') # spsolve warns about the held team's empty column when a region is a single game
+		for iteration in xrange(max_iterations):
+			t = tanh((x[away] - x[home])/(2*s))
+			slope = root_weight*(1 - t*t)/(2*s) # d error/d x_away, the home team's is its negative
+			values = np.concatenate([slope[away_column >= 0], -slope[home_column >= 0]])
+			jacobian = coo_matrix((values, (rows, cols)), shape=(len(home), num_teams - 1)).tocsr()
+			jacobians += 1
+			normal = (jacobian.T*jacobian).tocsc()
+			gradient = jacobian.T.dot(errors)
+			scale = np.maximum(normal.diagonal(), 1e-12*max(normal.diagonal().max(), 1e-300))
+			while True:
+				step = spsolve(normal + diags(damping*scale, 0, format='csc'), -gradient)
+				trial = x.copy()
+				trial[1:] += step
+				trial_errors = _game_errors(trial, home, away, DOS, weight, s)
+				evaluations += 1
+				if np.all(np.isfinite(step)) and trial_errors.dot(trial_errors) <= sum_squares:
+					damping = max(damping/3, 1e-12)
+					break
+				damping *= 4
+				if damping > 1e12:
+					break
+			if damping > 1e12:
+				status, message = 5, "no step lowers the sum of squares"
+				break
+			x, errors, sum_squares = trial, trial_errors, trial_errors.dot(trial_errors)
+			if np.max(np.abs(step)) < tolerance:
+				status, message = 1, "converged in %d steps" %(iteration + 1)
+				break
+	return x, sum_squares, evaluations, jacobians, status, message
+
+def _solve_region(block, max_iterations = 200, tolerance = 1e-6):
+	# minimises the weighted sum of squares of one disconnected region, a module level function so a worker process can run it
+	# returns the powers with how the solve went, as the diagnostics need it
+	# Each step is a damped Gauss-Newton (Levenberg-Marquardt) step on the games' errors. The Jacobian has two entries per game,
+	# so it is kept sparse and a step is one sparse solve however many teams the region has, and a step is only taken
+	# if it lowers the sum of squares, so the solve can't be drawn to a point that merely zeroes the derivative.
+	# Only power differences matter, so the first team is held at its starting power, anchor_regions sets the offset afterwards
+	# A start far enough out can still leave a team where its games are predicted as certain and don't fit, see _stuck_games,
+	# so a solve that ends like that is done again from every team level with the held one, where the tanh curve is steepest
+	home, away, DOS, weight, x0, s = block
+	start_time = time.time()
+	x0 = np.array(x0, dtype=float)
+	if len(x0) < 2:
+		return x0, 0, 0, 0.0, 1, "a single team", time.time() - start_time
+	x, sum_squares, evaluations, jacobians, status, message = _descend(x0, home, away, DOS, weight, s, max_iterations, tolerance)
+	if _stuck_games(x, home, away, DOS, weight, s).any():
+		level = _descend(np.repeat(x0[0], len(x0)), home, away, DOS, weight, s, max_iterations, tolerance)
+		evaluations += level[2]
+		jacobians += level[3]
+		if level[1] <= sum_squares or not _stuck_games(level[0], home, away, DOS, weight, s).any():
+			x, sum_squares, status, message = level[0], level[1], level[4], "from level powers, " + level[5]
+	stuck = _stuck_games(x, home, away, DOS, weight, s)
+	if stuck.any():
+		status, message = 4, "%d games are predicted as certain and don't fit, the powers are on a flat stretch and not at the minimum" %(stuck.sum())
+	gradient_norm = float(np.linalg.norm(_regression_residuals(x, home, away, DOS, weight, s)[1:]))
+	return x, evaluations, jacobians, gradient_norm, status, message, time.time() - start_time
+
+@instrument.timed('solve_rankings')
+def solve_rankings(rankings, max_iterations = 200, tolerance = 1e-10):
+	# Solves many Ranking windows together, for backfills and parameter studies where hundreds of small solves
+	# would each pay for their own scipy calls. Every window's teams and games are stacked into one system
+	# whose Jacobian is block diagonal, and each damped Gauss-Newton step, as in _descend, is a single sparse solve for all of them.
+	# Each window has its own damping and only takes a step that lowers its own sum of squares, and it drops out of the
+	# system once the derivative of its sum of squares vanishes, so the slow ones don't hold up the rest.
+	# A window that stops on a flat stretch or doesn't converge is solved again on its own with _fsolve_regions.
+	# Sets the powers and diagnostics of each ranking, then ranking.create_ranking(solve=False) finishes it,
+	# raising ConvergenceError for a window that didn't converge.
+	# Only plain Ranking windows can be stacked, the other methods solve different equations
+	from scipy.sparse import coo_matrix, diags
+	from scipy.sparse.csgraph import connected_components
+	from scipy.sparse.linalg import spsolve, lsqr
+	start_time = time.time()
+	for ranking in rankings:
+		if ranking.__class__.regression_ranking.im_func is not Ranking.regression_ranking.im_func:
+			raise ValueError("%s solves its own equations and can't be stacked" %(ranking.__class__.__name__))
+	num_blocks = len(rankings)
+	if not num_blocks:
+		return
+
+	# the stacked unknowns, each window's teams in its fixed_order one after another
+	sizes = np.array([len(ranking.fixed_order) for ranking in rankings], dtype=int)
+	offsets = np.concatenate([[0], np.cumsum(sizes)])
+	team_block = np.repeat(np.arange(num_blocks), sizes)
+	home_list, away_list, DOS_list, weight_list, s_list = [], [], [], [], []
+	for k, ranking in enumerate(rankings):
+		ranking.diagnostics = SolverDiagnostics()
+		home, away, DOS, weights = ranking._regression_arrays()
+		home_list.append(home + offsets[k])
+		away_list.append(away + offsets[k])
+		DOS_list.append(DOS)
+		weight_list.append(weights)
+		s_list.append(np.repeat(float(ranking.s), len(DOS)))
+	home, away, DOS, weights, s = [np.concatenate(parts) for parts in (home_list, away_list, DOS_list, weight_list, s_list)]
+	game_block = team_block[home]
+	num_unknowns = offsets[-1]
+
+	# starting powers: an earlier solve where a window has one, otherwise the linearised powers of every window from one lsqr
+	x = np.zeros(num_unknowns)
+	rows, cols, vals, rhs = [], [], [], []
+	guessed = []
+	for k, ranking in enumerate(rankings):
+		if ranking.initial_guess is not None and all(team in ranking.initial_guess for team in ranking.fixed_order):
+			x[offsets[k]:offsets[k + 1]] = [ranking.initial_guess[team] for team in ranking.fixed_order]
+			continue
+		guessed.append(k)
+		team_index = dict((team, i) for i, team in enumerate(ranking.fixed_order))
+		for i, j, target, w in ranking._linearised_rows(team_index):
+			root_w = w**0.5
+			rows.append(len(rhs))
+			cols.append(offsets[k] + i)
+			vals.append(root_w)
+			if j is not None:
+				rows.append(len(rhs))
+				cols.append(offsets[k] + j)
+				vals.append(-root_w)
+			rhs.append(root_w*target)
+	if rhs:
+		lsqr_start = time.time()
+		A = coo_matrix((vals, (rows, cols)), shape=(len(rhs), num_unknowns)).tocsr()
+		adjustment, istop, itn, r1norm, r2norm, anorm, acond, arnorm = lsqr(A, np.array(rhs), atol=1e-10, btol=1e-10)[:8]
+		guessed_teams = np.in1d(team_block, guessed)
+		x[guessed_teams] = np.where(np.isfinite(adjustment), adjustment, 0.0)[guessed_teams] # zero, the prior, where lsqr broke down
+		for k in guessed:
+			# only a starting point, an imprecise one is left to the solve that follows, as Ranking.linearised_powers does
+			rankings[k].diagnostics.add_stage('initial guess', itn, 0, arnorm, istop, "stacked with %d windows, %s" %(len(guessed), _lsqr_stops.get(istop, '')),
+				time.time() - lsqr_start, True)
+
+	# only power differences matter, so the first team of each group connected by games is held where it starts,
+	# as _solve_region does, and teams with no games have no equation at all
+	num_components, component = connected_components(coo_matrix((np.ones(len(home)), (home, away)), shape=(num_unknowns, num_unknowns)), directed=False)
+	played = np.bincount(home, minlength=num_unknowns) + np.bincount(away, minlength=num_unknowns) > 0
+	free = played.copy()
+	free[np.unique(component, return_index=True)[1]] = False
+
+	# the stacked Jacobian of the games' errors, a column for each free team, as _descend builds it for one region
+	free_teams = np.flatnonzero(free)
+	free_block = team_block[free_teams]
+	column = -np.ones(num_unknowns, dtype=int)
+	column[free_teams] = np.arange(len(free_teams))
+	home_column, away_column = column[home], column[away]
+	game_index = np.arange(len(home))
+	J_rows = np.concatenate([game_index[away_column >= 0], game_index[home_column >= 0]])
+	J_cols = np.concatenate([away_column[away_column >= 0], home_column[home_column >= 0]])
+	root_weights = np.sqrt(weights)
+
+	def block_squares(errors):
+		return np.bincount(game_block, errors*errors, num_blocks)
+
+	def gradient_norms(x):
+		return np.sqrt(np.bincount(free_block, _regression_residuals(x, home, away, DOS, weights, s)[free_teams]**2, num_blocks))
+
+	# a window with no team left free to move is solved already, the others are done once their derivatives vanish
+	start = x.copy()
+	errors = _game_errors(x, home, away, DOS, weights, s)
+	squares = block_squares(errors)
+	norms = gradient_norms(x)
+	active = np.bincount(free_block, minlength=num_blocks) > 0
+	converged = ~active | (norms < tolerance)
+	active &= ~converged
+	damping = np.repeat(1e-3, num_blocks)
+	iterations = np.zeros(num_blocks, dtype=int)
+	evaluations = np.ones(num_blocks, dtype=int)
+	messages = ["stopped after %d steps" %(max_iterations)]*num_blocks
+	for iteration in xrange(max_iterations):
+		if not active.any():
+			break
+		# the damped Gauss-Newton step of every active window from one sparse solve, the matrix is block diagonal so the windows don't mix
+		t = tanh((x[away] - x[home])/(2*s))
+		slope = root_weights*(1 - t*t)/(2*s)
+		values = np.concatenate([slope[away_column >= 0], -slope[home_column >= 0]])
+		jacobian = coo_matrix((values, (J_rows, J_cols)), shape=(len(home), len(free_teams))).tocsr()
+		columns = np.flatnonzero(active[free_block])
+		jacobian = jacobian[:, columns]
+		normal = (jacobian.T*jacobian).tocsc()
+		gradient = jacobian.T.dot(errors)
+		scale = np.maximum(normal.diagonal(), 1e-12*max(normal.diagonal().max(), 1e-300))
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')
+			step = spsolve(normal + diags(damping[free_block[columns]]*scale, 0, format='csc'), -gradient)
+
+		# a window keeps its step only if it lowers that window's sum of squares, otherwise it is damped harder and tries again
+		trial = x.copy()
+		trial[free_teams[columns]] += step
+		trial_errors = _game_errors(trial, home, away, DOS, weights, s)
+		trial_squares = block_squares(trial_errors)
+		finite = np.bincount(free_block[columns], ~np.isfinite(step), num_blocks) == 0
+		better = active & finite & (trial_squares <= squares)
+		x[better[team_block]] = trial[better[team_block]]
+		errors[better[game_block]] = trial_errors[better[game_block]]
+		squares[better] = trial_squares[better]
+		damping[better] = np.maximum(damping[better]/3, 1e-12)
+		damping[active & ~better] *= 4
+		evaluations[active] += 1
+		iterations[active] += 1
+		for k in np.flatnonzero(active & (damping > 1e12)):
+			messages[k] = "no step lowers the sum of squares after %d steps" %(iterations[k])
+		active &= damping <= 1e12
+
+		norms = gradient_norms(x)
+		done = active & (norms < tolerance)
+		converged |= done
+		active &= ~done
+
+	# a vanishing derivative isn't enough, a window whose steps stopped where the tanh curve is flat hasn't found its minimum,
+	# so it is solved again on its own, where _solve_region refits from level powers, as is a window that didn't converge
+	stuck = np.bincount(game_block, _stuck_games(x, home, away, DOS, weights, s), num_blocks)
+	status = np.where(converged, 1, 5)
+	for k in np.flatnonzero(stuck > 0):
+		converged[k] = False
+		status[k] = 4
+		messages[k] = "%d games are predicted as certain and don't fit" %(stuck[k])
+	wall_time = time.time() - start_time
+	for k, ranking in enumerate(rankings):
+		if converged[k]:
+			message = "stacked solve of %d windows, converged in %d steps" %(num_blocks, iterations[k])
+		else:
+			message = "stacked solve of %d windows, %s, solved on its own instead" %(num_blocks, messages[k])
+		ranking.diagnostics.add_stage('regression', evaluations[k], iterations[k], float(norms[k]), status[k], message, wall_time, True)
+		powers = x[offsets[k]:offsets[k + 1]]
+		if not converged[k]:
+			try:
+				powers = ranking._fsolve_regions(start[offsets[k]:offsets[k + 1]])
+			except ConvergenceError:
+				pass # recorded in the ranking's diagnostics, create_ranking(solve=False) raises it
+		for team, power in zip(ranking.fixed_order, powers):
+			if ranking.teams[team].num_games != 0:
+				ranking.teams[team].power = float(power)
+
+class ConvergenceError(RuntimeError):
+	# raised when a solver gives up before finding the powers
+	# the diagnostics for the failed solve are attached so they can be inspected or logged
+	def __init__(self, message, diagnostics):
+		RuntimeError.__init__(self, message)
+		self.diagnostics = diagnostics
+
+class SolverDiagnostics:
+	# a record of what each stage of a ranking solve cost and whether it converged
+	def __init__(self):
+		self.stages = [] # one dictionary per stage, in the order they ran
+
+	def add_stage(self, stage, function_evaluations, jacobian_evaluations, gradient_norm, status, message, wall_time, converged):
+		self.stages.append({
+			'stage': stage,
+			'function_evaluations': function_evaluations,
+			'jacobian_evaluations': jacobian_evaluations,
+			'gradient_norm': gradient_norm,
+			'status': status,
+			'message': message,
+			'wall_time': wall_time,
+			'converged': converged})
+
+	def converged(self):
+		for stage in self.stages:
+			if not stage['converged']:
+				return False
+		return True
+
+	def failures(self):
+		return [stage for stage in self.stages if not stage['converged']]
+
+	def total_time(self):
+		return sum(stage['wall_time'] for stage in self.stages)
+
+	def __str__(self):
+		lines = ["Stage            Evals  Jacobians   Grad norm  Status  Time (s)"]
+		for stage in self.stages:
+			lines.append("%s %6d     %6d  %10.3e  %6s  %8.3f" %(stage['stage'].ljust(15), stage['function_evaluations'], stage['jacobian_evaluations'], stage['gradient_norm'], stage['status'], stage['wall_time']))
+		return "\n".join(lines)
+
+class RankingSnapshot(object):
+	# A read-only copy of the result of one create_ranking call, held as compact arrays
+	# create_ranking builds a new snapshot once a ranking is complete and swaps it in as ranking.snapshot
+	# in a single assignment, so readers holding the old snapshot never see a half-updated ranking
+	# and never need a lock. The arrays follow the order of names
+	__slots__ = ['engine', 'start', 'end', 's', 'names', 'index', 'power', 'rank', 'num_games', 'active', 'order', 'active_order',
+		'game_home', 'game_away', 'game_DOS', 'game_weight', 'diagnostics', 'created']
+
+	def __init__(self, ranking):
+		set_value = lambda name, value: object.__setattr__(self, name, value)
+		listed = set(ranking.fixed_order)
+		names = tuple(ranking.fixed_order) + tuple(sorted(name for name in ranking.teams if name not in listed)) # ImprovedRanking can add teams from old rankings
+		teams = [ranking.teams[name] for name in names]
+		set_value('engine', getattr(ranking, 'engine_name', ranking.__class__.__name__)) # engines.py names the rankings it adapts
+		set_value('start', ranking.start)
+		set_value('end', ranking.end)
+		set_value('s', ranking.s)
+		set_value('names', names)
+		set_value('index', dict((name, i) for i, name in enumerate(names)))
+		set_value('power', self._frozen(np.array([team.power for team in teams], dtype=float)))
+		set_value('rank', self._frozen(np.array([team.rank if team.rank is not None else 0 for team in teams], dtype=np.int32))) # 0 for unranked
+		set_value('num_games', self._frozen(np.array([team.num_games for team in teams], dtype=np.int32)))
+		set_value('active', self._frozen(self.rank > 0))
+		set_value('order', self._frozen(np.array([self.index[team.name] for team in ranking.ranked_list_full], dtype=np.int32)))
+		set_value('active_order', self._frozen(np.array([self.index[team.name] for team in ranking.ranked_list_active], dtype=np.int32)))
+		# the games as index arrays, enough to re-fit a team's power without going back to the ranking
+		games = [game for game in ranking.games if game.home_team in self.index and game.away_team in self.index]
+		set_value('game_home', self._frozen(np.array([self.index[game.home_team] for game in games], dtype=np.int32)))
+		set_value('game_away', self._frozen(np.array([self.index[game.away_team] for game in games], dtype=np.int32)))
+		set_value('game_DOS', self._frozen(np.array([game.DOS for game in games], dtype=float)))
+		set_value('game_weight', self._frozen(np.array([game.weight(ranking.start, ranking.end) for game in games], dtype=float)))
+		set_value('diagnostics', ranking.diagnostics) # every solve starts a new SolverDiagnostics, so this one is never added to again
+		set_value('created', time.time())
+
+	def _frozen(self, array):
+		array.flags.writeable = False
+		return array
+
+	def __setattr__(self, name, value):
+		raise AttributeError("RankingSnapshot is read only")
+
+	def __len__(self):
+		return len(self.names)
+
+	def power_of(self, team):
+		return float(self.power[self.index[team]])
+
+	def rank_of(self, team):
+		# None if the team is not ranked (inactive, hiatus or disbanded)
+		rank = self.rank[self.index[team]]
+		return int(rank) if rank else None
+
+	def top(self, k = None, only_active_teams = True):
+		# list of (rank, team, power) for the k highest ranked teams
+		order = self.active_order if only_active_teams else self.order
+		return [(i + 1, self.names[t], float(self.power[t])) for i, t in enumerate(order[:k])]
+
+	def expected_DOS(self, home_team, away_team):
+		# the same logistic prediction as Ranking.expected_result
+		return float(tanh((self.power_of(home_team) - self.power_of(away_team))/(2*self.s)))
+
+	def expected_power(self, home_team, home_score, away_score):
+		# the power an opponent would need for the score line to match the prediction, as in Ranking.expected_power
+		# a shutout would need an infinite difference, so DOS is capped as Ranking._implied_difference caps it
+		DOS = np.clip(_score_DOS(home_score, away_score), -0.99, 0.99)
+		return self.power_of(home_team) + self.s * log(2/(DOS + 1) - 1)
+
+	def what_if(self, game_data, iterations = 20):
+		# refits the powers of the two teams in a hypothetical game, holding every other team's power fixed
+		# game_data is a row in the games file format, the date is ignored and the game gets full weight
+		# returns {team: power}, a team not in the ranking starts from the power the score line implies
+		home_team, away_team = game_data[1], game_data[3]
+		home_score, away_score = float(game_data[2]), float(game_data[4])
+		DOS = _score_DOS(home_score, away_score)
+		power = np.array(self.power)
+		names = list(self.names)
+		for team, opponent, sign in [(home_team, away_team, 1), (away_team, home_team, -1)]:
+			if team not in self.index:
+				known = self.power[self.index[opponent]] if opponent in self.index else 0.0
+				power = np.append(power, known + sign*2*self.s*np.arctanh(np.clip(DOS, -0.99, 0.99)))
+				names.append(team)
+		index = dict((name, i) for i, name in enumerate(names))
+		home = np.append(self.game_home, index[home_team])
+		away = np.append(self.game_away, index[away_team])
+		game_DOS = np.append(self.game_DOS, DOS)
+		game_weight = np.append(self.game_weight, 1.0)
+
+		moving = [index[home_team], index[away_team]]
+		involved = np.in1d(home, moving) | np.in1d(away, moving)
+		home, away, game_DOS, game_weight = home[involved], away[involved], game_DOS[involved], game_weight[involved]
+		for iteration in xrange(iterations):
+			# Gauss-Newton on the two moving powers
+			predicted = tanh((power[home] - power[away])/(2*self.s))
+			slope = (1 - predicted**2)/(2*self.s)
+			jacobian = np.zeros((len(home), 2))
+			for k, t in enumerate(moving):
+				jacobian[:, k] = slope*((home == t).astype(float) - (away == t))
+			weighted = jacobian*game_weight[:, np.newaxis]
+			step = np.linalg.lstsq(weighted.T.dot(jacobian), -weighted.T.dot(predicted - game_DOS), rcond=None)[0]
+			power[moving] += step
+			if np.max(np.abs(step)) < 1e-6:
+				break
+		return {home_team: float(power[index[home_team]]), away_team: float(power[index[away_team]])}
+
+class Team(object):
+	# __slots__ keeps each team to a fixed set of attributes with no per-instance __dict__
+	__slots__ = ['name', 'power', 'rank', 'num_games', 'num_wins', 'is_new', 'min_games_required', 'min_unique_opponents', 'opponents',
+		'is_connected', 'data_for_initial_power', 'hiatus', 'disbanded', 'games', 'previous_powers', 'previous_ranks']
+
 	def __init__(self, name):
 		self.name = name
 		self.power = 0.0
@@ -85,6 +516,16 @@ class Team:
 				if game.away_score > game.home_score:
 					self.increment_wins()
 
+	def remove_game(self, game):
+		# recounts games, wins and opponents from the games that are left
+		games = [kept for kept in self.games if kept is not game]
+		self.games = []
+		self.num_games = 0
+		self.num_wins = 0
+		self.opponents = []
+		for kept in games:
+			self.add_game(kept)
+
 
 	def print_team(self):
 		#prints useful information about a team
@@ -120,22 +561,32 @@ class Team:
 		return self.name
 
 	def __deepcopy__(self, memo):
-		copy_team = Team(self.name)
-		copy_team.power = copy.deepcopy(self.power)
-		copy_team.num_games = copy.deepcopy(self.num_games)
-		copy_team.num_wins = copy.deepcopy(self.num_wins)
-		copy_team.is_new = copy.deepcopy(self.is_new)
-		copy_team.min_games_required = copy.deepcopy(self.min_games_required)
-		copy_team.min_unique_opponents = copy.deepcopy(self.min_unique_opponents)
-		copy_team.opponents = copy.deepcopy(self.opponents)
-		copy_team.is_connected = copy.deepcopy(self.is_connected)
-		copy_team.data_for_initial_power = copy.deepcopy(self.data_for_initial_power)
-		copy_team.hiatus = copy.deepcopy(self.hiatus)
-		copy_team.disbanded = copy.deepcopy(self.disbanded)
-		copy_team.games = copy.deepcopy(self.games)
+		# the copy gets its own lists but shares the Game objects in them, games are never changed once loaded
+		copy_team = self.__class__(self.name)
+		copy_team.power = self.power
+		copy_team.num_games = self.num_games
+		copy_team.num_wins = self.num_wins
+		copy_team.is_new = self.is_new
+		copy_team.min_games_required = self.min_games_required
+		copy_team.min_unique_opponents = self.min_unique_opponents
+		copy_team.opponents = list(self.opponents)
+		copy_team.is_connected = self.is_connected
+		copy_team.data_for_initial_power = list(self.data_for_initial_power)
+		copy_team.hiatus = self.hiatus
+		copy_team.disbanded = self.disbanded
+		copy_team.games = list(self.games)
 		return copy_team
 
-class Game:
+def _score_DOS(home_score, away_score):
+	#difference over sum, a 0-0 score line has none so it can't be a game
+	if home_score < 0 or away_score < 0 or home_score + away_score == 0:
+		raise ValueError("A score line of %s to %s has no difference over sum" %(home_score, away_score))
+	return float(home_score - away_score)/float(home_score + away_score)
+
+class Game(object):
+	# a game is a fixed record once loaded, so copies of rankings and teams share the same Game objects
+	__slots__ = ['date', 'home_team', 'home_score', 'away_team', 'away_score', 'DOS']
+
 	def __init__(self, game_data):
 		#This class expects data directly from file so datetime conversion is needed
 		self.date = str2dt(game_data[0])
@@ -143,11 +594,17 @@ class Game:
 		self.home_score = int(game_data[2])
 		self.away_team = game_data[3]
 		self.away_score = int(game_data[4])
-		self.DOS = float(self.home_score - self.away_score)/float(self.home_score + self.away_score)
+		self.DOS = _score_DOS(self.home_score, self.away_score)
 
 	def __str__(self):
 		return "%s  %s  %3d  || %s  %3d  %.3f" %(self.date, self.home_team.ljust(33), self.home_score, self.away_team.ljust(33), self.away_score, self.DOS)
 
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
 	def weight(self,window_start, window_end):
 		diff = window_end - self.date
 		months_ago = floor(12*diff.days/365) #hence 364 day difference rounds down to 11 months
@@ -177,9 +634,11 @@ class Game:
 
 		return weight_age * weight_DOS
 
-class Week:
+class Week(object):
 	#This class is only used internally and so dates will already be in datetime format
 	#games are stored week by week purely to make printing the list of games clearer
+	__slots__ = ['start', 'end', 'games']
+
 	def __init__(self, start_date, end_date):
 		self.start = start_date
 		self.end = end_date
@@ -200,6 +659,8 @@ class Week:
 		return "%s - %s\n" %(self.start, self.end)
 
 class Ranking:
+	team_class = Team # what teams are made as, a ranking method that keeps more per team sets its own
+
 	def __init__(self, start_date, end_date, games_file, teams_file = None, hiatus_file = None, disbanded_file = None):
 		self.start = str2dt(start_date)
 		self.end = str2dt(end_date)
@@ -223,6 +684,18 @@ class Ranking:
 			self.load_disbanded_teams(disbanded_file)
 
 		self.s = 100 # The scaling factor for the logistic equation
+		self.diagnostics = SolverDiagnostics()
+		self.history_file = 'solver_history.csv' # every solve appends its diagnostics here
+		self.region_anchors = {} # power to give the strongest team of a disconnected region, skips the prompt in anchor_regions
+		self.interactive = True # set to False for unattended runs, unanchored regions are then left out of the ranking
+		self.unanchored = [] # teams of the disconnected regions left out of the ranking because nothing placed them, see anchor_regions
+		self.parallel_region_size = 200 # regions of this many teams are solved in worker processes when there are at least two of them
+		self.processes = None # worker processes for those regions, None for one per CPU
+		# the files written by output_ranking_data, each name is an _output_ method without the prefix
+		self.initial_guess = None # team name -> power, fsolve starts here instead of the linearised guess when every team has a value
+		self.snapshot = None # a RankingSnapshot of the latest completed ranking, replaced whole by each create_ranking
+		self.outputs = ['games_organised_by_team', 'games_organised_by_week', 'ranking_all', 'ranking_active', 'powers_ranks', 'inactive_teams', 'ranking_detailed', 'diagnostics']
+		self.plot_renderer = None # the plots.PlotRenderer used by the 'team_plots' output, made on first use if not set
 
 	def _make_weeks(self):
 		#weeks go from Thursday to Wednesday to make sure tournaments are captured in a single week
@@ -239,29 +712,45 @@ class Ranking:
 		if last_day != self.end:
 			self.weeks.append(Week(last_day -6*day, self.end))
 
+	@instrument.timed('load_games')
 	def load_games(self, games_file):
 		#game must be listed in format:
 		#YYYYMMDD,Team 1 Name,XXX,Team 2 name,YYY
 		#date is expected in format like 20160731, XXX and YYY are scores
 		#there are no spaces between commas
-		with open(games_file, 'rU') as csvfile:
-			games_reader = csv.reader(csvfile, dialect='excel')
-			for game in games_reader:
-				if self.start <= str2dt(game[0]) <= self.end:
-					self.games.append(Game(game))
+		#games_file can also be an already parsed gamestore.GameStore, which is shared rather than read again,
+		#the official .xlsx export, which is cleaned as it is read,
+		#or a list of files or a directory of them, which are merged with duplicates dropped
+		if isinstance(games_file, (list, tuple)) or (isinstance(games_file, basestring) and (games_file.endswith('.xlsx') or os.path.isdir(games_file))):
+			import gamestore # gamestore imports this module
+			games_file = gamestore.GameStore(games_file)
+			conflicts = games_file.conflicts()
+			if conflicts:
+				print "\nThe games files disagree about these games, the first listing was used:"
+				for conflict in conflicts:
+					print "    " + conflict
+		if not isinstance(games_file, basestring):
+			self.games = games_file.games(self.start, self.end)
+		else:
+			with open(games_file, 'rU') as csvfile:
+				games_reader = csv.reader(csvfile, dialect='excel')
+				for game in games_reader:
+					if self.start <= str2dt(game[0]) <= self.end:
+						self.games.append(Game(game))
 
 		for game in self.games:
 			for week in self.weeks:
 				if week.start <= game.date <= week.end:
 					week.add_game(game)
 
+	@instrument.timed('load_teams')
 	def load_teams(self, teams_file):
 		# Load the list of teams if given
 		if teams_file:
 			with open(teams_file, 'r') as teams_in:
 				for row in teams_in:
 					team = row.rstrip('\n')
-					self.teams[team] = Team(team)
+					self.teams[team] = self.team_class(team)
 					self.fixed_order.append(team)
 					# fixed_order is to force teams into a fixed order for later calculation, since dictionaries are not fixed
 
@@ -272,16 +761,18 @@ class Ranking:
 
 			# Add teams if they weren't loaded and append them to the teams_file
 			if home not in self.teams:
-				self.teams[home] = Team(home)
+				self.teams[home] = self.team_class(home)
 				self.fixed_order.append(home)
-				with open(teams_file, 'a') as teams_in:
-					teams_in.write(home + "\n")
+				if teams_file:
+					with open(teams_file, 'a') as teams_in:
+						teams_in.write(home + "\n")
 
 			if away not in self.teams:
-				self.teams[away] = Team(away)
+				self.teams[away] = self.team_class(away)
 				self.fixed_order.append(away)
-				with open(teams_file, 'a') as teams_in:
-					teams_in.write(away + "\n")
+				if teams_file:
+					with open(teams_file, 'a') as teams_in:
+						teams_in.write(away + "\n")
 
 			self.teams[home].add_game(game)
 			self.teams[away].add_game(game)
@@ -313,6 +804,11 @@ class Ranking:
 				print "%3d   %6.1f    %2d    %s" %(counter, team.power, team.num_games, team.name)
 				counter += 1
 
+		if self.unanchored:
+			print "\nThe following teams are not ranked because their region has no games against Region 1 and no region_anchors power:"
+			for team in self.unanchored:
+				print team
+
 		if self.inactive:
 			print "\nThe following teams played games, but did not meet minimum activity requirements:"
 			for team in self.inactive:
@@ -339,6 +835,7 @@ class Ranking:
 			if count == 0:
 				print "'None'\n"
 
+	@instrument.timed('determine_regions')
 	def determine_regions(self):
 		# used to determine regions
 		# creates a list for each isolated group of teams as a sublist in self.region_list
@@ -362,66 +859,238 @@ class Ranking:
 
 		return False
 
-	def _make_regression_function(self):
-		def reg_func(x):
-			# y is a vector of derivatives. the goal is solve y = 0
-			num_teams = len(self.fixed_order)
-			y = [0] * num_teams
-			# the loop assembles the sum of squares derivative for each team
-			# i is the team of interest
-			# j is the opponent
-			# x is a vector of powers, hence x[i] is the power for the team of interest and x[j] for the opponent
-			for team, i in zip(self.fixed_order, xrange(num_teams)):
-				for game in self.teams[team].games:
-					# derivative is slightly differenct if the team is home or away
-					if game.home_team == self.teams[team].name:
-						j = self.fixed_order.index(game.away_team)
-						y[i] += -(game.DOS + tanh((x[j]-x[i])/200))/(100*cosh((x[j]-x[i])/200)**2)*game.weight(self.start, self.end)
-					else:
-						j = self.fixed_order.index(game.home_team)
-						y[i] += (game.DOS + tanh((x[i]-x[j])/200))/(100*cosh((x[i]-x[j])/200)**2)*game.weight(self.start, self.end)
-
-			return y
-		return reg_func
+	def _regression_arrays(self):
+		# the games as index arrays into fixed_order with their DOS and weights, what _regression_residuals works on
+		team_index = dict((team, i) for i, team in enumerate(self.fixed_order))
+		home = np.array([team_index[game.home_team] for game in self.games], dtype=int)
+		away = np.array([team_index[game.away_team] for game in self.games], dtype=int)
+		DOS = np.array([game.DOS for game in self.games], dtype=float)
+		weights = np.array([game.weight(self.start, self.end) for game in self.games], dtype=float)
+		return home, away, DOS, weights
+
+	@instrument.timed('create_ranking')
+	def create_ranking(self, solve = True):
+		# the lists are rebuilt from scratch so create_ranking can be called again after games are added
+		# solve = False uses the powers solve_rankings has already found for this window
+		self._reset_ranked_lists()
 
-	def create_ranking(self):
 		# the following line is whichever ranking methodology has been chosen
-		self.regression_ranking()
+		if solve:
+			self.regression_ranking()
+		else:
+			self._check_convergence()
 
 		#sort the dictionary, then use list comprehension to only return the team object
-		self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
+		with instrument.stage('sort'):
+			self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
 
 		#normalise the powers and fix separate regions
 		self.anchor_regions()
 
 		#remove hiatus, disbanded, and non-minimum-requirements teams and populate inactive list
-		counter = 1
-		for team in self.ranked_list_full:
-			if team.is_active() and not team.hiatus and not team.disbanded:
-				self.ranked_list_active.append(team)
-				team.rank = counter
-				counter +=1
-			else:
-				if not team.disbanded:
-					self.inactive.append(team)
+		with instrument.stage('activity_filter'):
+			counter = 1
+			for team in self.ranked_list_full:
+				if team.is_active() and not team.hiatus and not team.disbanded:
+					self.ranked_list_active.append(team)
+					team.rank = counter
+					counter +=1
+				else:
+					if not team.disbanded:
+						self.inactive.append(team)
+
+		# publish the finished ranking to readers in one step
+		self.snapshot = RankingSnapshot(self)
 
 		# Finally, save the ranking data to file
 		self.output_ranking_data()
 
+	def _reset_ranked_lists(self):
+		self.ranked_list_full = []
+		self.ranked_list_active = []
+		self.inactive = []
+		self.unanchored = []
+		for team in self.teams.values():
+			team.rank = None
+
+	@instrument.timed('regression_ranking')
 	def regression_ranking(self):
 		#this uses least squares regression to find the most appropriate power rating for each team
 		#it solves power ratings simulatenously and then uses them to rank the teams
-		#to solve, we minimise the sum of least squares by taking a derivative and forcing it to zero
-		#this cannot be solved analytically, so a numerical method for nonlinear systems is used (fsolve)
-		regression = self._make_regression_function()
-		reg_input = [0] * len(self.fixed_order) #initial guess power
-		reg_result = fsolve(regression, reg_input) #magic happens here
+		#to solve, we minimise the sum of least squares, which can't be done analytically,
+		#so a damped Gauss-Newton method steps downhill until the powers stop moving, see _solve_region
+		#regions that never played each other don't affect each other's equations, so each is solved on its own, see _fsolve_regions
+		#a warm start from an earlier solve is only kept if it converged properly, see _warm_solve
+		self.diagnostics = SolverDiagnostics()
+		if self.initial_guess is not None and all(team in self.initial_guess for team in self.fixed_order):
+			reg_result = self._warm_solve(np.array([self.initial_guess[team] for team in self.fixed_order], dtype=float))
+		else:
+			reg_input = self.linearised_powers() #initial guess power
+			reg_result = self._fsolve_regions(reg_input) #magic happens here
 		#order the teams by power
 		#at this stage the powers have yet to be normalised to an appropriate range
 		for team,i in zip(self.fixed_order,xrange(len(reg_result))):
 			if self.teams[team].num_games !=0:
-				self.teams[team].power  = copy.deepcopy(reg_result[i])
+				self.teams[team].power = float(reg_result[i])
+
+	def _warm_solve(self, warm_input):
+		#an earlier solve's powers can sit a long way from where the new games put the minimum, so the warm result is only kept
+		#if it converged with no games left on a flat stretch of the tanh curve, see _solve_region, and its powers are finite.
+		#Otherwise the powers are solved again from the linearised guess, as they would have been without the warm start
+		try:
+			warm_result = self._fsolve_regions(warm_input)
+			if np.all(np.isfinite(warm_result)):
+				return warm_result
+			warm_message = "discarded, it gave powers that aren't finite"
+		except ConvergenceError as error:
+			warm_message = "discarded, %s" %(error)
+		self.diagnostics = SolverDiagnostics()
+		self.diagnostics.add_stage('warm start', 0, 0, 0.0, 1, warm_message, 0.0, True)
+		return self._fsolve_regions(self.linearised_powers())
+
+	@instrument.timed('initial_guess')
+	def linearised_powers(self, prior = None):
+		#a closed form starting point for the solvers
+		#inverting the logistic curve, DOS = tanh((x_home - x_away)/2s) turns each game into an implied power difference
+		#x_home - x_away = 2s*atanh(DOS), which is linear, so the whole game graph is a sparse linear least squares problem
+		#lsqr returns the smallest adjustment to the prior that fits, so teams without games stay at their prior
+		#and each disconnected region is centred on its prior rather than drifting off
+		if prior is None:
+			prior = np.zeros(len(self.fixed_order))
+		prior = np.asarray(prior, dtype=float)
+		team_index = dict((team, i) for i, team in enumerate(self.fixed_order))
+
+		rows = []
+		cols = []
+		vals = []
+		rhs = []
+		for r, (i, j, target, w) in enumerate(self._linearised_rows(team_index)):
+			#each row is x_i - x_j = target, or x_i = target when j is None, scaled by the square root of the weight
+			root_w = w**0.5
+			rows.append(r)
+			cols.append(i)
+			vals.append(root_w)
+			if j is not None:
+				rows.append(r)
+				cols.append(j)
+				vals.append(-root_w)
+			rhs.append(root_w*target)
+
+		if not rhs:
+			return prior.copy()
+
+		from scipy.sparse import coo_matrix
+		from scipy.sparse.linalg import lsqr
+		start_time = time.time()
+		A = coo_matrix((vals, (rows, cols)), shape=(len(rhs), len(self.fixed_order))).tocsr()
+		adjustment, istop, itn, r1norm, r2norm, anorm, acond, arnorm, xnorm, var = lsqr(A, np.array(rhs) - A.dot(prior), atol=1e-10, btol=1e-10)
+		#the guess is only a starting point, so an imprecise one (e.g. lsqr hit its iteration limit) is still used and
+		#recorded as converged with lsqr's reason for stopping, the solve that follows does the rest.
+		#If lsqr broke down altogether the guess is the prior
+		if not np.all(np.isfinite(adjustment)):
+			self.diagnostics.add_stage('initial guess', itn, 0, 0.0, istop, "%s, using the prior instead" %(_lsqr_stops.get(istop, "lsqr failed")), time.time() - start_time, True)
+			return prior.copy()
+		self.diagnostics.add_stage('initial guess', itn, 0, arnorm, istop, _lsqr_stops.get(istop, ''), time.time() - start_time, True)
+		return prior + adjustment
+
+	@instrument.timed('fsolve')
+	def _fsolve_regions(self, reg_input):
+		#splits the teams into the groups connected by games and runs _solve_region on each group's games,
+		#so a solve costs the sum of the regions' solves rather than one solve the size of all of them,
+		#and each region only has its own free offset rather than one per region in a single system.
+		#Regions of parallel_region_size teams or more are solved in worker processes when there are several.
+		#The pieces go back into one vector in fixed_order, so anchor_regions sees the same result as before
+		from scipy.sparse import coo_matrix
+		from scipy.sparse.csgraph import connected_components
+		start_time = time.time()
+		num_teams = len(self.fixed_order)
+		home, away, DOS, weights = self._regression_arrays()
+		graph = coo_matrix((np.ones(len(home)), (home, away)), shape=(num_teams, num_teams))
+		num_regions, region = connected_components(graph, directed=False)
+
+		# teams and games grouped by region, a team with no games is a region of its own and is left where it is
+		team_order = np.argsort(region, kind='mergesort')
+		team_starts = np.concatenate([[0], np.cumsum(np.bincount(region, minlength=num_regions))])
+		game_order = np.argsort(region[home], kind='mergesort')
+		game_starts = np.concatenate([[0], np.cumsum(np.bincount(region[home], minlength=num_regions))])
+		local = np.zeros(num_teams, dtype=int)
+		regions = []
+		blocks = []
+		for r in xrange(num_regions):
+			games = game_order[game_starts[r]:game_starts[r + 1]]
+			if len(games) == 0:
+				continue
+			members = team_order[team_starts[r]:team_starts[r + 1]]
+			local[members] = np.arange(len(members))
+			regions.append(members)
+			blocks.append((local[home[games]], local[away[games]], DOS[games], weights[games], reg_input[members], self.s))
+
+		results = [None]*len(blocks)
+		large = [i for i, members in enumerate(regions) if len(members) >= self.parallel_region_size]
+		processes = min(len(large), self.processes or multiprocessing.cpu_count())
+		if processes > 1:
+			pool = multiprocessing.Pool(processes)
+			try:
+				for i, result in zip(large, pool.map(_solve_region, [blocks[i] for i in large], chunksize=1)):
+					results[i] = result
+			finally:
+				pool.close()
+				pool.join()
+		for i, block in enumerate(blocks):
+			if results[i] is None:
+				results[i] = _solve_region(block)
+
+		reg_result = np.array(reg_input, dtype=float)
+		failed = None
+		for members, (x, nfev, njev, gradient_norm, ier, message, wall_time) in zip(regions, results):
+			reg_result[members] = x
+			if failed is None and ier != 1:
+				failed = (ier, "region of %d teams: %s" %(len(members), message))
+		#recorded as one stage, with the evaluations added up and the gradient norm over every region's equations
+		gradient_norm = float(np.sqrt(sum(result[3]**2 for result in results)))
+		largest = max([len(members) for members in regions] + [0])
+		if failed is None:
+			status, message = 1, "%d regions solved separately, the largest has %d teams" %(len(regions), largest)
+		else:
+			status, message = failed
+		self.diagnostics.add_stage('regression', sum(result[1] for result in results), sum(result[2] for result in results), gradient_norm, status, message,
+			time.time() - start_time, failed is None)
+		self._check_convergence()
+		return reg_result
+
+	@instrument.timed('fsolve')
+	def _fsolve(self, regression, reg_input):
+		#runs fsolve, records how it went and refuses to hand back powers that didn't converge
+		from scipy.optimize import fsolve
+		start_time = time.time()
+		reg_result, info, ier, message = fsolve(regression, reg_input, full_output=True)
+		#the regression function is the gradient of the sum of squares, so its norm says how close to the minimum we are
+		gradient_norm = float(np.linalg.norm(info['fvec']))
+		self.diagnostics.add_stage('regression', info['nfev'], info.get('njev', 0), gradient_norm, ier, message, time.time() - start_time, ier == 1)
+		self._check_convergence()
+		return reg_result
+
+	def _check_convergence(self):
+		if not self.diagnostics.converged():
+			#log the failure before giving up so scheduled runs leave a trace
+			self._output_diagnostics()
+			failed = self.diagnostics.failures()[0]
+			raise ConvergenceError("%s failed to converge for the period %s to %s at stage '%s' (status %s): %s" %(self.__class__.__name__, self.start, self.end, failed['stage'], failed['status'], failed['message']), self.diagnostics)
+
+	def _linearised_rows(self, team_index):
+		#one row per game, using the same weights as the regression
+		for game in self.games:
+			w = game.weight(self.start, self.end)
+			if w > 0:
+				yield team_index[game.home_team], team_index[game.away_team], self._implied_difference(game.DOS), w
+
+	def _implied_difference(self, DOS):
+		#a shutout has DOS = +/-1 and an infinite implied difference, so cap it
+		max_DOS = 0.99
+		DOS = min(max(DOS, -max_DOS), max_DOS)
+		return 2*self.s*np.arctanh(DOS)
 
+	@instrument.timed('anchor_regions')
 	def anchor_regions(self):
 		#if there are disconnected regions in the network of games
 		#this provides a means for giving the smaller regions a way to be subjectively anchored in
@@ -455,42 +1124,61 @@ class Ranking:
 							if self.teams[team].power > max_power:
 								max_power = self.teams[team].power
 						adjustment = max_power
-					print "\nRegion %d" %(region_number+1)#because python indexes from 0
-					print "========"
-					if region_number>0:
-						print "These powers only show how this region structured. They do not reflect global power"
-						print "A subjective rating for this region is required."
+					if self.interactive:
+						print "\nRegion %d" %(region_number+1)#because python indexes from 0
+						print "========"
+						if region_number>0:
+							print "These powers only show how this region structured. They do not reflect global power"
+							print "A subjective rating for this region is required."
 					for team in self.ranked_list_full:
 						if team.name in sublist:
 							if region_number>0:
 								self.teams[team.name].power -= adjustment
-							print "%7.1f    %2d    %s" %(team.power, team.num_games, team.name)
+							if self.interactive:
+								print "%7.1f    %2d    %s" %(team.power, team.num_games, team.name)
 							ranked_regions[region_number].append(team.name)
 
 			satisfied = False
 			adjust_to = []
 
 			while not satisfied:
+				prompted = False
 				for i in xrange(1,len(ranked_regions)):
-					print "\nPlease choose the power rating %s should have in Region 1" %(ranked_regions[i][0])
-					adjust_to.append(raw_input("Power = "))
+					if ranked_regions[i][0] in self.region_anchors:
+						#the anchor power was given ahead of time
+						adjust_to.append(self.region_anchors[ranked_regions[i][0]])
+					elif self.interactive:
+						print "\nPlease choose the power rating %s should have in Region 1" %(ranked_regions[i][0])
+						adjust_to.append(raw_input("Power = "))
+						prompted = True
+					else:
+						#nobody to ask, and nothing links the region's powers to Region 1's, so it is left out of the ranking
+						#its powers stay relative to its strongest team on 0
+						adjust_to.append(None)
+						self.unanchored.extend(ranked_regions[i])
 				#adjust powers and print full rankings
 				for i in xrange(1,len(ranked_regions)):
+					if adjust_to[i-1] is None:
+						continue
 					adjustment = float(adjust_to[i-1]) - self.teams[ranked_regions[i][0]].power
 					for team in ranked_regions[i]:
 						self.teams[team].power += adjustment
 
-				self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
-				self.print_rankings(False)
-
+				self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True) if key not in self.unanchored]
 
-				print "\nAre you happy with these rankings?"
-				response = raw_input("y or n: ")
-				if response == "y":
+				if not prompted:
 					satisfied = True
 				else:
-					adjust_to = []
+					self.print_rankings(False)
+
+					print "\nAre you happy with these rankings?"
+					response = raw_input("y or n: ")
+					if response == "y":
+						satisfied = True
+					else:
+						adjust_to = []
 
+	@instrument.timed('load_hiatus_teams')
 	def load_hiatus_teams(self, hiatus_file):
 		#determine hiatus teams
 		with open(hiatus_file, 'rU') as h:
@@ -500,6 +1188,7 @@ class Ranking:
 				if team in self.teams:
 					self.teams[team].hiatus = True
 		
+	@instrument.timed('load_disbanded_teams')
 	def load_disbanded_teams(self,disbanded_file):
 		#determine disbanded
 		with open(disbanded_file, 'rU') as d:
@@ -511,11 +1200,43 @@ class Ranking:
 	
 	def add_new_game(self, game_data):
 		new_game = Game(game_data)
+		if not self.start <= new_game.date <= self.end:
+			raise ValueError("The game %s is outside the ranking period %s - %s" %(new_game, self.start, self.end))
 		print "Adding the game:"
 		print new_game
 		self.games.append(new_game)
-		self.teams[new_game.home_team].add_game(new_game)
-		self.teams[new_game.away_team].add_game(new_game)
+		for team in [new_game.home_team, new_game.away_team]:
+			if team not in self.teams:
+				# a team playing its first game in this period, set up the same way as in load_teams
+				self.teams[team] = self.team_class(team)
+				self.fixed_order.append(team)
+				self.teams[team].hiatus = team in self.hiatus
+				self.teams[team].disbanded = team in self.disbanded
+			self.teams[team].add_game(new_game)
+		for week in self.weeks:
+			if week.start <= new_game.date <= week.end:
+				week.add_game(new_game)
+		# the new game may have joined two regions together
+		self.region_list = []
+		self.determine_regions()
+
+	def correct_game(self, game_data):
+		# replaces the game between the same two teams on the same date, e.g. after a score is corrected
+		# adds it as a new game if there is no such game
+		new_game = Game(game_data)
+		teams = set([new_game.home_team, new_game.away_team])
+		for old_game in self.games:
+			if old_game.date == new_game.date and set([old_game.home_team, old_game.away_team]) == teams:
+				print "Replacing the game:"
+				print old_game
+				self.games.remove(old_game)
+				for week in self.weeks:
+					if old_game in week.games:
+						week.games.remove(old_game)
+				for team in teams:
+					self.teams[team].remove_game(old_game)
+				break
+		self.add_new_game(game_data)
 
 	def expected_result(self, home_team, away_team):
 		#uses logistic regression to predict the DOS outcome for a matchup
@@ -609,7 +1330,8 @@ class Ranking:
 		# Might be useful
 		self.notes = note
 
-	def plot_team(self, team, display=False):
+	def plot_data(self, team):
+		# everything plot_team draws for a team, as plain values so it can be sent to a plots.PlotRenderer worker
 		opponent_powers = []
 		game_DOS = []
 		game_list = self.teams[team].games
@@ -627,13 +1349,22 @@ class Ranking:
 				opponent_powers.append(self.teams[game.home_team].power)
 				game_DOS.append(-game.DOS)
 
+		# the whole name without its spaces, teams that only share their first words get plots of their own
+		fig_name = "".join(team.replace("/", "-").split()) + "_" + str(self.end) + ".png"
+		return {'team': team, 'power': self.teams[team].power, 'opponent_powers': opponent_powers, 'DOS': game_DOS, 'colours': colours, 'sizes': sizes, 'fig_name': fig_name}
+
+	def plot_team(self, team, display=False):
+		# one plot through pyplot, plots.PlotRenderer draws many teams' plots without a display
+		import matplotlib.pyplot as plt
+		data = self.plot_data(team)
+
 		def f(t):
-			return tanh((self.teams[team].power - t)/200)
+			return tanh((data['power'] - t)/200)
 		powers = np.arange(300, 1200, 1)
-		title = team + " predicted DOS with actual game data\nStrength = %.1f" %(self.teams[team].power)
+		title = team.decode('utf-8') + u" predicted DOS with actual game data\nStrength = %.1f" %(data['power'])
 		plt.title(title)
 		plt.plot(powers, f(powers), 'b')
-		plt.scatter(opponent_powers,game_DOS, c= colours, marker = 'o', s=sizes)
+		plt.scatter(data['opponent_powers'], data['DOS'], c= data['colours'], marker = 'o', s=data['sizes'])
 		axes = plt.gca()
 		axes.set_xlim([300,1200])
 		axes.set_ylim([-1,1])
@@ -641,24 +1372,17 @@ class Ranking:
 		if display:
 			plt.show()
 		else:
-			name_parts = team.split(" ")
-			if len(name_parts) >1:
-				fig_name =  name_parts[0] + name_parts[1] + "_" + str(self.end) + ".png"
-			else:
-				fig_name =  name_parts[0] + "_" + str(self.end) + ".png"
-			plt.savefig("Plots/" + fig_name )
+			plt.savefig("Plots/" + data['fig_name'])
 		plt.close('all')
 
+	@instrument.timed('output_ranking_data')
 	def output_ranking_data(self):
 		# A function to write all the important data to file
-		self._output_games_organised_by_team()
-		self._output_games_organised_by_week()
-		self._output_ranking_all()
-		self._output_ranking_active()
-		self._output_powers_ranks()
-		self._output_inactive_teams()
-		self._output_ranking_detailed()
+		# self.outputs picks which of the _output_ methods run, in order
+		for output in self.outputs:
+			getattr(self, '_output_' + output)()
 
+	@instrument.timed('output_games_organised_by_team')
 	def _output_games_organised_by_team(self):
 		# This function writes a list of each team's games
 		# It is ordered by the ranking, so the create_ranking method must be called first
@@ -706,6 +1430,7 @@ class Ranking:
 
 				output.write(output_string)
 
+	@instrument.timed('output_games_organised_by_week')
 	def _output_games_organised_by_week(self):
 		# This function writes a list of each team's games
 		# It is ordered by date and grouped by week
@@ -731,6 +1456,7 @@ class Ranking:
 					output_string += "\n"
 					output.write(output_string)
 
+	@instrument.timed('output_ranking_all')
 	def _output_ranking_all(self):
 		output_file = 'ranking_all_' + str(self.start) + '_to_' + str(self.end) + '.csv'
 		with open(output_file, 'w') as output:
@@ -749,6 +1475,7 @@ class Ranking:
 				output.write(team_data)
 				counter += 1
 
+	@instrument.timed('output_ranking_active')
 	def _output_ranking_active(self):
 		output = 'ranking_active_' + str(self.start) + '_to_' + str(self.end) + '.csv'
 		with open(output, 'wb') as csvfile:
@@ -760,6 +1487,7 @@ class Ranking:
 				game_writer.writerow(team_data)
 				counter += 1
 
+	@instrument.timed('output_powers_ranks')
 	def _output_powers_ranks(self):
 		power_file = 'powers_ranks_' + str(self.end) + '.csv'
 		with open(power_file, 'wb') as pfile:
@@ -771,6 +1499,7 @@ class Ranking:
 				else:
 					power_writer.writerow([team.name, team.power, "None"])
 
+	@instrument.timed('output_inactive_teams')
 	def _output_inactive_teams(self):
 		output_file = "inactive_teams_" + str(self.start) + '_to_' + str(self.end) + '.txt'
 		with open(output_file,'w') as output:
@@ -781,6 +1510,7 @@ class Ranking:
 					output.write(" (hiatus)")
 				output.write("\n")
 
+	@instrument.timed('output_ranking_detailed')
 	def _output_ranking_detailed(self):
 		# Prints out a ranking ready to be distributed for public consumption
 		# Includes a section at the end listing inactive teams + hiatus/disbanded teams if their game data is used
@@ -798,6 +1528,31 @@ class Ranking:
 					output.write(" (hiatus)")
 				output.write("\n")
 
+	@instrument.timed('output_diagnostics')
+	def _output_diagnostics(self):
+		# Appends a row per solver stage to the history file, so the cost of each ranking can be tracked over time
+		new_file = not os.path.exists(self.history_file)
+		with open(self.history_file, 'ab') as hfile:
+			history_writer = csv.writer(hfile, delimiter=',')
+			if new_file:
+				history_writer.writerow(['run_time', 'engine', 'start', 'end', 'stage', 'function_evaluations', 'jacobian_evaluations', 'gradient_norm', 'status', 'wall_time', 'converged', 'message'])
+			run_time = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+			for stage in self.diagnostics.stages:
+				history_writer.writerow([run_time, self.__class__.__name__, self.start, self.end, stage['stage'], stage['function_evaluations'], stage['jacobian_evaluations'],
+					"%.6e" %(stage['gradient_norm']), stage['status'], "%.4f" %(stage['wall_time']), stage['converged'], " ".join(str(stage['message']).split())])
+
+	def _plotted_teams(self):
+		return [team.name for team in self.ranked_list_full if team.num_games != 0]
+
+	@instrument.timed('output_team_plots')
+	def _output_team_plots(self):
+		# A plot_team plot for each team, drawn in parallel and skipped for teams whose plot would not change
+		# Not in the default outputs, add 'team_plots' to self.outputs to have them drawn
+		if self.plot_renderer is None:
+			import plots
+			self.plot_renderer = plots.PlotRenderer()
+		self.plot_renderer.render(self, self._plotted_teams())
+
 	def __str__(self):
 		#number of teams includes inactive, disbanded and hiatus teams that are in the teams list
 		return "Ranking period: %s - %s\n%d games\n%d teams\nNotes: %s" %(str(self.start), str(self.end),len(self.games), len(self.teams),self.notes)
@@ -814,6 +1569,7 @@ class ImprovedRanking(Ranking):
 		self.teams_with_new_games = []
 		self.load_previous_powers_ranks(previous_ranking_dates_file)
 
+	@instrument.timed('load_previous_powers_ranks')
 	def load_previous_powers_ranks(self, prd_file):
 		with open(prd_file, 'r') as csvfile:
 			prd_reader = csv.reader(csvfile, dialect='excel')
@@ -826,7 +1582,7 @@ class ImprovedRanking(Ranking):
 				ppr_reader = csv.reader(ppr_file, delimiter=',')
 				for ppr in ppr_reader:
 					if ppr[0] not in self.teams:
-						self.teams[ppr[0]] = Team(ppr[0])
+						self.teams[ppr[0]] = self.team_class(ppr[0])
 						self.teams[ppr[0]].power = 700
 					if ppr[1] != "0.0":
 						self.teams[ppr[0]].previous_powers[date] = float(ppr[1])
@@ -844,6 +1600,7 @@ class ImprovedRanking(Ranking):
 	def _make_regression_function(self):
 		def reg_func(x):
 			# y is a vector of derivatives. the goal is solve y = 0
+			instrument.count('residual evaluations')
 			num_teams = len(self.fixed_order)
 			y = [0] * num_teams
 			# the loop assembles the sum of squares derivative for each team
@@ -872,47 +1629,49 @@ class ImprovedRanking(Ranking):
 			return y
 		return reg_func
 
+	@instrument.timed('regression_ranking')
 	def regression_ranking(self):
 		#this uses least squares regression to find the most appropriate power rating for each team
 		#it solves power ratings simulatenously and then uses them to rank the teams
 		#to solve, we minimise the sum of least squares by taking a derivative and forcing it to zero
 		#this cannot be solved analytically, so a numerical method for nonlinear systems is used (fsolve)
+		self.diagnostics = SolverDiagnostics()
 		regression = self._make_regression_function()
-		reg_input = []
+		#teams start from their previous power (or 700 if they weren't ranked last time) and the new games adjust from there
+		prior = []
 		for team in self.fixed_order:
 			if self.previous_ranking_dates[0] in self.teams[team].previous_powers:
-				
-				if team == "Manneken Beasts":
-					reg_input.append(700)
-				elif team == "San Diego Aftershocks":
-					reg_input.append(800)
-				elif team == "Toronto Men's Roller Derby":
-					reg_input.append(800)
-				elif team == "Tyne and Fear Roller Derby":
-					reg_input.append(800)
-				elif team == "Harm City Men's Derby":
-					reg_input.append(600)
-				elif team == "Pittsburgh Blue Streaks":
-					reg_input.append(500)
-				elif team == "Flour City Fear Men's Roller Derby":
-					reg_input.append(500)
-				elif team == "Cleveland Men's Roller Derby":
-					reg_input.append(500)
-				else:
-					reg_input.append(self.teams[team].previous_powers[self.previous_ranking_dates[0]])
-						
+				prior.append(self.teams[team].previous_powers[self.previous_ranking_dates[0]])
 			else:
-				 reg_input.append(700)#initial guess power
+				prior.append(700)
+		reg_input = self.linearised_powers(prior)
 
-		reg_result = fsolve(regression, reg_input) #magic happens here
+		reg_result = self._fsolve(regression, reg_input) #magic happens here
 
 		#order the teams by power
 		#at this stage the powers have yet to be normalised to an appropriate range
 		for team,i in zip(self.fixed_order,xrange(len(reg_result))):
 			if self.teams[team].num_games !=0:
-				self.teams[team].power  = copy.deepcopy(reg_result[i])
+				self.teams[team].power = float(reg_result[i])
+
+	def _linearised_rows(self, team_index):
+		#mirrors the regression function - new games link two unknown powers,
+		#older games link a team with new games to the power its opponent had when the game was first used
+		for game in self.games:
+			implied = self._implied_difference(game.DOS)
+			if game.date > self.previous_ranking_dates[0]:
+				yield team_index[game.home_team], team_index[game.away_team], implied, 1.0
+			else:
+				if game.home_team in self.teams_with_new_games:
+					yield team_index[game.home_team], None, float(self.get_previous_power(game.away_team, game.date)) + implied, 1.0
+				if game.away_team in self.teams_with_new_games:
+					yield team_index[game.away_team], None, float(self.get_previous_power(game.home_team, game.date)) - implied, 1.0
 
+	@instrument.timed('create_ranking')
 	def create_ranking(self):
+		# the lists are rebuilt from scratch so create_ranking can be called again after games are added
+		self._reset_ranked_lists()
+
 		# the following line is whichever ranking methodology has been chosen
 		self.regression_ranking()
 
@@ -936,25 +1695,34 @@ class ImprovedRanking(Ranking):
 					self.teams[team].power = self.teams[team].previous_powers[self.previous_ranking_dates[0]]
 
 		#sort the dictionary, then use list comprehension to only return the team object
-		self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
+		with instrument.stage('sort'):
+			self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
 
 		#normalise the powers and fix separate regions
 		#self.anchor_regions()
 
 		#remove hiatus, disbanded, and non-minimum-requirements teams and populate inactive list
-		counter = 1
-		for team in self.ranked_list_full:
-			if team.is_active() and not team.hiatus and not team.disbanded:
-				self.ranked_list_active.append(team)
-				team.rank = counter
-				counter +=1
-			else:
-				if not team.disbanded:
-					self.inactive.append(team)
+		with instrument.stage('activity_filter'):
+			counter = 1
+			for team in self.ranked_list_full:
+				if team.is_active() and not team.hiatus and not team.disbanded:
+					self.ranked_list_active.append(team)
+					team.rank = counter
+					counter +=1
+				else:
+					if not team.disbanded:
+						self.inactive.append(team)
+
+		# publish the finished ranking to readers in one step
+		self.snapshot = RankingSnapshot(self)
 
 		# Finally, save the ranking data to file
 		self.output_ranking_data()
 
+	def _plotted_teams(self):
+		# only the teams with new games have new plots
+		return list(self.teams_with_new_games)
+
 	def get_previous_power(self, team, game_date):
 
 		for date in self.previous_ranking_dates:
@@ -967,6 +1735,7 @@ class ImprovedRanking(Ranking):
 		# If the loop finishes without returning, then something has gone wrong, and need to throw an error
 		raise ValueError('Failed to get a date')
 
+	@instrument.timed('anchor_regions')
 	def anchor_regions(self):
 		#if there are disconnected regions in the network of games
 		#this provides a means for giving the smaller regions a way to be subjectively anchored in
@@ -1000,42 +1769,61 @@ class ImprovedRanking(Ranking):
 							if self.teams[team].power > max_power:
 								max_power = self.teams[team].power
 						adjustment = max_power
-					print "\nRegion %d" %(region_number+1)#because python indexes from 0
-					print "========"
-					if region_number>0:
-						print "These powers only show how this region structured. They do not reflect global power"
-						print "A subjective rating for this region is required."
+					if self.interactive:
+						print "\nRegion %d" %(region_number+1)#because python indexes from 0
+						print "========"
+						if region_number>0:
+							print "These powers only show how this region structured. They do not reflect global power"
+							print "A subjective rating for this region is required."
 					for team in self.ranked_list_full:
 						if team.name in sublist:
 							if region_number>0:
 								self.teams[team.name].power -= adjustment
-							print "%7.1f    %2d    %s" %(team.power, team.num_games, team.name)
+							if self.interactive:
+								print "%7.1f    %2d    %s" %(team.power, team.num_games, team.name)
 							ranked_regions[region_number].append(team.name)
 
 			satisfied = False
 			adjust_to = []
 
 			while not satisfied:
+				prompted = False
 				for i in xrange(1,len(ranked_regions)):
-					print "\nPlease choose the power rating %s should have in Region 1" %(ranked_regions[i][0])
-					adjust_to.append(raw_input("Power = "))
+					if ranked_regions[i][0] in self.region_anchors:
+						#the anchor power was given ahead of time
+						adjust_to.append(self.region_anchors[ranked_regions[i][0]])
+					elif self.interactive:
+						print "\nPlease choose the power rating %s should have in Region 1" %(ranked_regions[i][0])
+						adjust_to.append(raw_input("Power = "))
+						prompted = True
+					else:
+						#nobody to ask, and nothing links the region's powers to Region 1's, so it is left out of the ranking
+						#its powers stay relative to its strongest team on 0
+						adjust_to.append(None)
+						self.unanchored.extend(ranked_regions[i])
 				#adjust powers and print full rankings
 				for i in xrange(1,len(ranked_regions)):
+					if adjust_to[i-1] is None:
+						continue
 					adjustment = float(adjust_to[i-1]) - self.teams[ranked_regions[i][0]].power
 					for team in ranked_regions[i]:
 						self.teams[team].power += adjustment
 
-				self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True)]
-				self.print_rankings(False)
-
+				self.ranked_list_full = [value for key,value in sorted(self.teams.items(), key=lambda x: x[1].power, reverse = True) if key not in self.unanchored]
 
-				print "\nAre you happy with these rankings?"
-				response = raw_input("y or n: ")
-				if response == "y":
+				if not prompted:
 					satisfied = True
 				else:
-					adjust_to = []
+					self.print_rankings(False)
 
+					print "\nAre you happy with these rankings?"
+					response = raw_input("y or n: ")
+					if response == "y":
+						satisfied = True
+					else:
+						adjust_to = []
+
+	@instrument.timed('output_ranking_detailed')
 	def _output_ranking_detailed(self):
 		# Prints out a ranking ready to be distributed for public consumption
 		# Includes a section at the end listing inactive teams + hiatus/disbanded teams if their game data is used
@@ -1059,6 +1847,7 @@ class ImprovedRanking(Ranking):
 					output.write(" *")
 				output.write("\n")
 
+	@instrument.timed('output_ranking_comparison')
 	def _output_ranking_comparison(self):
 		output_file = 'ranking_comparison_' + str(self.start) + '_to_' + str(self.end) + '.csv'
 		with open(output_file, 'w') as output:
@@ -1086,37 +1875,258 @@ class ImprovedRanking(Ranking):
 					if team.power != previous_power and team.rank != previous_rank:
 						output.write("%3d   %3d   %6.1f  %6.1f     %2d    %s\n" %(team.rank, -team.rank + previous_rank, team.power, team.power - previous_power,team.num_games, team.name))
 
-	def output_ranking_data(self):
-		# A function to write all the important data to file
-		self._output_games_organised_by_team()
-		self._output_games_organised_by_week()
-		self._output_ranking_all()
-		self._output_ranking_active()
-		self._output_powers_ranks()
-		self._output_inactive_teams()
-		self._output_ranking_detailed()
-		# for team in self.teams_with_new_games:
-		# 	self.plot_team(team)
-
-class WFTDAGame(Game):
-	def __init__(self, game_data):
-		Game.__init__(self, game_data)
-		self.WLFactorHome = 3 * float(self.home_score)/float(self.home_score + self.away_score)
-		self.WLFactorAway = 3 * float(self.away_score)/float(self.home_score + self.away_score)
+class DynamicRanking(Ranking):
+	# Rather than re-solving a fresh window for every publication date and approximating the
+	# time decay with the step weights in Game.weight, this treats each team's power as a
+	# random walk from one Week to the next and estimates every week's power at once.
+	# The whole history is a single sparse least squares problem:
+	#   game terms     (tanh((x_home - x_away)/2s) - DOS)/game_sd   for the week the game was played
+	#   walk terms     (x[w+1] - x[w])/walk_sd                        for every team and week
+	#   prior terms    (x[0] - prior)/prior_sd                        keeps teams with no games yet in check
+	# Ordering the unknowns week by week makes the normal equations block tridiagonal (banded),
+	# so each Gauss-Newton iteration costs roughly O(weeks x teams) rather than a full solve per week
+	def __init__(self, start_date, end_date, games_file, teams_file = None, hiatus_file = None, disbanded_file = None):
+		Ranking.__init__(self, start_date, end_date, games_file, teams_file, hiatus_file, disbanded_file)
+		self.walk_sd = 15.0 # how far a team's power is expected to drift in a single week
+		self.game_sd = 0.25 # how far a game's DOS is expected to stray from the prediction
+		self.prior_sd = 400.0 # a very weak pull towards the starting power
+		self.max_iterations = 50
+		self.tolerance = 0.001 # largest power change allowed in the final iteration
+		self.weekly_powers = None # weeks x teams array, rows follow self.weeks and columns follow self.fixed_order
+
+	def _weekly_game_arrays(self):
+		# packs every game into index arrays so the residuals can be evaluated without looping
+		team_index = dict((team, i) for i, team in enumerate(self.fixed_order))
+		week_list = []
+		home_list = []
+		away_list = []
+		DOS_list = []
+		for w, week in enumerate(self.weeks):
+			for game in week.games:
+				week_list.append(w)
+				home_list.append(team_index[game.home_team])
+				away_list.append(team_index[game.away_team])
+				DOS_list.append(game.DOS)
+
+		return np.array(week_list, dtype=int), np.array(home_list, dtype=int), np.array(away_list, dtype=int), np.array(DOS_list)
+
+	@instrument.timed('regression_ranking')
+	def regression_ranking(self):
+		from scipy.sparse import coo_matrix
+		from scipy.sparse.linalg import spsolve
+		num_teams = len(self.fixed_order)
+		num_weeks = len(self.weeks)
+		week, home, away, DOS = self._weekly_game_arrays()
+		num_games = len(DOS)
+		# position of a team's power in a given week within the vector of unknowns
+		home_var = week*num_teams + home
+		away_var = week*num_teams + away
+
+		self.diagnostics = SolverDiagnostics()
+		prior = np.zeros(num_teams)
+		x = np.tile(self.linearised_powers(prior), num_weeks)
+		start_time = time.time()
+		evaluations = 1
+		status = 2 # 1 - the step fell below tolerance, 2 - ran out of iterations, 3 - no step could improve the fit
+
+		# the walk and prior rows are linear, so their part of the Jacobian never changes
+		walk_rows = np.arange((num_weeks - 1)*num_teams)
+		walk = coo_matrix((np.concatenate((-np.ones(len(walk_rows)), np.ones(len(walk_rows))))/self.walk_sd,
+			(np.concatenate((walk_rows, walk_rows)), np.concatenate((walk_rows, walk_rows + num_teams)))),
+			shape=(len(walk_rows), num_weeks*num_teams)).tocsr()
+		prior_rows = np.arange(num_teams)
+		prior_matrix = coo_matrix((np.ones(num_teams)/self.prior_sd, (prior_rows, prior_rows)), shape=(num_teams, num_weeks*num_teams)).tocsr()
+		fixed_normal = walk.T.dot(walk) + prior_matrix.T.dot(prior_matrix)
+
+		def residuals(x):
+			instrument.count('residual evaluations')
+			predicted = np.tanh((x[home_var] - x[away_var])/(2*self.s))
+			game_res = (predicted - DOS)/self.game_sd
+			walk_res = walk.dot(x)
+			prior_res = (x[:num_teams] - prior)/self.prior_sd
+			return game_res, walk_res, prior_res
+
+		def objective(res):
+			return sum(np.dot(r, r) for r in res)
+
+		def game_jacobian(x):
+			# d(game residual)/dx_home = sech^2/(2s*game_sd) and the opposite for away
+			u = (x[home_var] - x[away_var])/(2*self.s)
+			slope = 1/(np.cosh(u)**2*2*self.s*self.game_sd)
+			game_rows = np.arange(num_games)
+			return coo_matrix((np.concatenate((slope, -slope)), (np.concatenate((game_rows, game_rows)), np.concatenate((home_var, away_var)))),
+				shape=(num_games, num_weeks*num_teams)).tocsr()
+
+		def gradient(res, game_jac):
+			grad = game_jac.T.dot(res[0]) + walk.T.dot(res[1])
+			grad[:num_teams] += res[2]/self.prior_sd
+			return grad
+
+		res = residuals(x)
+		iteration = 0
+		for iteration in xrange(1, self.max_iterations + 1):
+			# Gauss-Newton step
+			game_jac = game_jacobian(x)
+			normal = (game_jac.T.dot(game_jac) + fixed_normal).tocsc()
+			step = spsolve(normal, -gradient(res, game_jac))
+
+			# halve the step until the fit improves, tanh saturates for lopsided games
+			current = objective(res)
+			scale = 1.0
+			improved = False
+			while scale > 1e-4:
+				trial = residuals(x + scale*step)
+				evaluations += 1
+				if objective(trial) <= current:
+					improved = True
+					break
+				scale /= 2
+			if not improved:
+				status = 3
+				break
+			x += scale*step
+			res = trial
+			if np.max(np.abs(scale*step)) < self.tolerance:
+				status = 1
+				break
+
+		messages = {1: "The largest change in power is below the tolerance", 2: "The iteration limit was reached", 3: "No step along the Gauss-Newton direction improved the fit"}
+		gradient_norm = float(np.linalg.norm(gradient(res, game_jacobian(x))))
+		self.diagnostics.add_stage('smoother', evaluations, iteration, gradient_norm, status, messages[status], time.time() - start_time, status == 1)
+		self._check_convergence()
+
+		self.weekly_powers = x.reshape((num_weeks, num_teams))
+
+		# the current power is the estimate for the final week, the earlier weeks become the team's history
+		# these are the raw powers, before anchor_regions normalises the strongest team to 1000
+		for i, team in enumerate(self.fixed_order):
+			if self.teams[team].num_games != 0:
+				self.teams[team].power = float(self.weekly_powers[-1, i])
+				for w, week in enumerate(self.weeks):
+					self.teams[team].previous_powers[week.end] = float(self.weekly_powers[w, i])
 
 class WFTDATeam(Team):
+	__slots__ = ['game_points']
+
 	def __init__(self, name):
 		Team.__init__(self,name)
-		self.game_points = []
+		self.game_points = [] # (game, game points) for each of the team's games in the last calculation
 
-
-		
 class WFTDARanking(Ranking):
-	def __init__(self, start_date, end_date, games_file, previous_ranking_dates_file, teams_file, hiatus_file = None, disbanded_file = None):
+	# The WFTDA game points method
+	# In every game each team earns game points: its WL factor (3 x its share of the points scored, see _game_arrays)
+	# times the opponent's strength factor x 100. A team's ranking points are the weighted average of its game points,
+	# and its strength factor is its ranking points over the average in its region, so the strength factors
+	# depend on each other, see calculate
+	# All the games are handled at once as arrays, so a WFTDA sized year (hundreds of teams, thousands of games)
+	# costs a sparse matrix and an eigen solve per region. The ranking points become the team powers, so sorting, the activity
+	# filter, snapshots and the output files work as they do for Ranking
+	team_class = WFTDATeam
+
+	def __init__(self, start_date, end_date, games_file, teams_file = None, hiatus_file = None, disbanded_file = None):
 		Ranking.__init__(self, start_date, end_date, games_file, teams_file, hiatus_file, disbanded_file)
+		self.tolerance = 1e-9 # largest change in any strength factor one more iteration could make
+		self.max_iterations = 1000 # for the sparse eigen solver on large regions
+		self.strength_factors = {} # team name -> strength factor from the last calculation
+
+	def _game_arrays(self):
+		# the games that count towards this window, as index arrays into fixed_order with their WL factors and weights
+		# a team's WL factor is 3 x its share of the points scored in the game
+		team_index = dict((team, i) for i, team in enumerate(self.fixed_order))
+		games = []
+		weights = []
+		for game in self.games:
+			w = game.weight(self.start, self.end)
+			if w > 0:
+				games.append(game)
+				weights.append(w)
+		home = np.array([team_index[game.home_team] for game in games], dtype=int)
+		away = np.array([team_index[game.away_team] for game in games], dtype=int)
+		home_score = np.array([game.home_score for game in games], dtype=float)
+		away_score = np.array([game.away_score for game in games], dtype=float)
+		total = home_score + away_score
+		return games, home, away, 3*home_score/total, 3*away_score/total, np.array(weights, dtype=float)
 
 	def calculate(self):
-		pass
+		# returns the ranking points of each team in fixed_order
+		from scipy.sparse import coo_matrix
+		from scipy.sparse.csgraph import connected_components
+		from scipy.sparse.linalg import eigs, ArpackNoConvergence
+		start_time = time.time()
+		num_teams = len(self.fixed_order)
+		games, home, away, WL_home, WL_away, weight = self._game_arrays()
+		weight_total = np.bincount(home, weight, num_teams) + np.bincount(away, weight, num_teams)
+		played = weight_total > 0
+		weight_total[~played] = 1
+
+		# ranking points are linear in the strength factors: ranking_points = points_matrix . strength, where
+		# points_matrix[i, j] is 100 x i's WL factor against j, weighted and averaged over i's games
+		points_matrix = coo_matrix((np.concatenate([100*weight*WL_home/weight_total[home], 100*weight*WL_away/weight_total[away]]),
+			(np.concatenate([home, away]), np.concatenate([away, home]))), shape=(num_teams, num_teams)).tocsr()
+
+		def points(strength):
+			# game points for the home and away team of each game, and each team's ranking points
+			return 100*WL_home*strength[away], 100*WL_away*strength[home], points_matrix.dot(strength)
+
+		# strength = ranking points/region average is then an eigenvector of the region's block of points_matrix,
+		# the one with no negative entries, scaled to average 1 as regions that never meet can't be compared.
+		# Solving for it directly gives the limit of the usual iteration without the thousands of
+		# iterations it takes when a region is made of loosely linked groups of teams
+		num_regions, region = connected_components(points_matrix, directed=False)
+		strength = np.ones(num_teams)
+		average = np.ones(num_teams) # each team's region average of ranking points
+		status = 1
+		message = "solved %d regions" %(num_regions)
+		for r in xrange(num_regions):
+			members = np.flatnonzero((region == r) & played)
+			if len(members) == 0:
+				continue
+			block = points_matrix[members][:, members]
+			try:
+				if len(members) <= 100:
+					values, vectors = np.linalg.eig(block.toarray())
+				else:
+					values, vectors = eigs(block, k=1, which='LR', tol=self.tolerance*1e-3, maxiter=self.max_iterations)
+			except ArpackNoConvergence:
+				status = 5
+				message = "the strength factors of a region of %d teams did not converge in %d iterations" %(len(members), self.max_iterations)
+				continue
+			largest = np.argmax(values.real)
+			vector = np.abs(vectors[:, largest].real)
+			strength[members] = vector/vector.mean()
+			average[members] = max(values[largest].real, 0) or 1
+
+		# how far the strength factors are from reproducing themselves, the change the iteration would still make
+		change = float(np.abs(points_matrix.dot(strength)/average - strength)[played].max()) if played.any() else 0.0
+		converged = status == 1 and change < self.tolerance
+		if status == 1 and not converged:
+			status = 5
+		self.diagnostics.add_stage('strength factors', num_regions, 0, change, status,
+			message + ", largest change in a strength factor %.2e" %(change), time.time() - start_time, converged)
+		self._check_convergence()
+
+		home_points, away_points, ranking_points = points(strength)
+		self.strength_factors = dict((team, float(strength[i])) for i, team in enumerate(self.fixed_order) if played[i])
+		for team in self.teams.values():
+			team.game_points = []
+		for game, home_points, away_points in zip(games, home_points, away_points):
+			self.teams[game.home_team].game_points.append((game, float(home_points)))
+			self.teams[game.away_team].game_points.append((game, float(away_points)))
+		return ranking_points
+
+	@instrument.timed('regression_ranking')
+	def regression_ranking(self):
+		# create_ranking calls this for every method, here it is the game points calculation
+		self.diagnostics = SolverDiagnostics()
+		ranking_points = self.calculate()
+		for team, i in zip(self.fixed_order, xrange(len(ranking_points))):
+			if self.teams[team].num_games != 0:
+				self.teams[team].power = float(ranking_points[i])
+
+	@instrument.timed('anchor_regions')
+	def anchor_regions(self):
+		# ranking points are already on a common scale, each region's strength factors average 1
+		self.determine_regions()
 
 
 
@@ -0,0 +1,345 @@
+# Keeps a solved ranking in memory and answers questions about it over a local HTTP JSON API
+# Queries are answered from the latest RankingSnapshot, so they never wait on a solve.
+# New games are queued and a background thread adds them to the ranking and re-solves it,
+# starting from the current powers, then publishes a new snapshot once its powers have been checked
+#
+# python service.py jobs_march.json --job march --port 8642
+#
+# GET  /status
+# GET  /rank?team=Austin+Anarchy
+# GET  /top?k=10                        add &all=1 to include inactive teams
+# GET  /expected_result?home=...&away=...
+# GET  /expected_power?home=...&home_score=150&away_score=100
+# GET  /what_if?home=...&home_score=150&away=...&away_score=100
+# POST /games                           body is a JSON list of games, each [YYYYMMDD, home, home score, away, away score]
+#
+# With --follow the service also watches the games file, see ingest.py, and ranks rows as they are appended to it.
+# If the file is rewritten rather than appended to, the ranking is rebuilt from scratch
+# With --ingest sources.json it watches several result feeds instead, through an ingest.IngestionPipeline
+#
+# Everything binds to 127.0.0.1 only
+
+import os
+import sys
+import json
+import time
+import urlparse
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+
+import regression
+import batch
+from ingest import GamesFileFollower, IngestionPipeline, load_sources
+
+class RankingService:
+	power_limit = 1e5 # a solve giving any power further out than this is taken as failed and not published
+
+	def __init__(self, ranking, make_ranking = None):
+		self.ranking = self._prepare(ranking) # only the solver thread touches this once the service has started
+		self.make_ranking = make_ranking # builds a fresh ranking when the games have to be reloaded
+		self.snapshot = None # the snapshot every query reads, replaced after each successful solve
+		self.reload_requested = False
+		self.follower = None
+		self.pending = [] # games waiting for the next solve
+		self.pending_lock = threading.Lock()
+		self.new_games = threading.Event()
+		self.solves = 0
+		self.last_error = None
+		self.last_solve_time = 0.0
+		self.solving = False
+		self.running = False
+		self._solve()
+		if self.snapshot is None:
+			# there is nothing to answer queries from, so the service can't start
+			raise RuntimeError("The first solve failed, there is no ranking to serve: %s" %(self.last_error))
+
+	def _prepare(self, ranking):
+		ranking.interactive = False
+		ranking.outputs = [] # a resident service answers queries rather than writing files
+		return ranking
+
+	def _solve(self):
+		start_time = time.time()
+		self.solving = True
+		try:
+			# a warm start that goes wrong is already solved again from the linearised guess by Ranking._warm_solve
+			snapshot = self._checked_solve()
+			if snapshot is not None:
+				self.snapshot = snapshot
+				self.last_error = None
+			# otherwise the previous snapshot stays published
+		finally:
+			self.solving = False
+		self.solves += 1
+		self.last_solve_time = time.time() - start_time
+
+	def _checked_solve(self):
+		# the new snapshot, or None with last_error set if the solve failed or its powers aren't fit to publish
+		try:
+			self.ranking.create_ranking()
+		except Exception as error:
+			# anything the solve raises is kept for /status, the solver thread carries on with the previous snapshot
+			self.last_error = "%s: %s" %(error.__class__.__name__, error)
+			return None
+		snapshot = self.ranking.snapshot
+		if not (np.all(np.isfinite(snapshot.power)) and np.all(np.abs(snapshot.power) <= self.power_limit)):
+			self.last_error = "The solve gave powers outside +/-%g, the previous ranking is kept" %(self.power_limit)
+			return None
+		return snapshot
+
+	def add_games(self, games, action = 'add'):
+		# checks the games can be read before queueing them, so a bad game is rejected rather than lost in the solver thread
+		# json gives unicode strings, the team names everywhere else are utf-8 byte strings
+		games = [[item.encode('utf-8') if isinstance(item, unicode) else item for item in game_data] for game_data in games]
+		for game_data in games:
+			game = regression.Game(game_data)
+			if not self.ranking.start <= game.date <= self.ranking.end:
+				raise ValueError("The game %s is outside the ranking period %s - %s" %(game, self.ranking.start, self.ranking.end))
+		with self.pending_lock:
+			self.pending.extend((action, game_data) for game_data in games)
+		self.new_games.set()
+
+	def correct_games(self, games):
+		# each game replaces the one between the same teams on the same date
+		self.add_games(games, 'correct')
+
+	def in_period(self, rows):
+		# the rows in the clean format that fall inside the ranking period
+		return [row for row in rows if len(row) == 5 and row[0].isdigit() and self.ranking.start <= regression.str2dt(row[0]) <= self.ranking.end]
+
+	def _solver_loop(self):
+		while self.running:
+			self.new_games.wait(0.5)
+			if not self.new_games.is_set():
+				continue
+			self.new_games.clear()
+			with self.pending_lock:
+				games, self.pending = self.pending, []
+				reload_requested, self.reload_requested = self.reload_requested, False
+			if reload_requested:
+				# the new ranking reads every game from the file itself, so anything queued is already in it
+				try:
+					self.ranking = self._prepare(self.make_ranking())
+				except Exception as error:
+					self.last_error = "%s: %s" %(error.__class__.__name__, error)
+					continue
+				self._solve()
+				continue
+			if not games:
+				continue
+			errors = []
+			for action, game_data in games:
+				# a game the ranking won't take is left out and reported, the rest are still solved
+				try:
+					if action == 'correct':
+						self.ranking.correct_game(game_data)
+					else:
+						self.ranking.add_new_game(game_data)
+				except Exception as error:
+					errors.append("%s: %s" %(error.__class__.__name__, error))
+			self.ranking.initial_guess = dict(zip(self.snapshot.names, self.snapshot.power))
+			self._solve()
+			if errors:
+				self.last_error = "; ".join(errors + ([self.last_error] if self.last_error else []))
+
+	def reload(self):
+		# throws away the current ranking and builds a new one with make_ranking
+		with self.pending_lock:
+			self.pending = []
+			self.reload_requested = True
+		self.new_games.set()
+
+	def _followed_games(self, rows):
+		# rows appended to the games file, the ones outside the ranking period are left out
+		games = self.in_period(rows)
+		if games:
+			self.add_games(games)
+
+	def follow(self, games_file, interval = 1.0, debounce = 5.0):
+		# watches the games file for appended results, the rows already there are assumed to be in the ranking
+		self.follower = GamesFileFollower(games_file, self._followed_games, lambda rows: self.reload(), interval, debounce)
+		self.follower.skip_existing()
+		self.follower.start()
+
+	def start(self):
+		self.running = True
+		self.solver = threading.Thread(target=self._solver_loop)
+		self.solver.daemon = True
+		self.solver.start()
+
+	def stop(self):
+		if self.follower is not None:
+			self.follower.stop()
+		self.running = False
+		self.new_games.set()
+		self.solver.join()
+
+	# Queries - each reads the snapshot once at the start so it sees a single consistent ranking
+
+	def status(self):
+		snapshot = self.snapshot
+		return {
+			'engine': snapshot.engine,
+			'start': str(snapshot.start),
+			'end': str(snapshot.end),
+			'teams': len(snapshot),
+			'games': len(snapshot.game_DOS),
+			'snapshot_time': snapshot.created,
+			'solves': self.solves,
+			'last_solve_time': self.last_solve_time,
+			'solving': self.solving,
+			'pending_games': len(self.pending),
+			'converged': snapshot.diagnostics.converged(),
+			'last_error': self.last_error}
+
+	def rank(self, team):
+		snapshot = self.snapshot
+		i = snapshot.index[team]
+		return {'team': team, 'rank': snapshot.rank_of(team), 'power': float(snapshot.power[i]), 'games': int(snapshot.num_games[i]), 'active': bool(snapshot.active[i])}
+
+	def top(self, k = 10, only_active_teams = True):
+		snapshot = self.snapshot
+		return [{'rank': rank, 'team': team, 'power': power} for rank, team, power in snapshot.top(k, only_active_teams)]
+
+	def expected_result(self, home_team, away_team):
+		snapshot = self.snapshot
+		e_DOS = snapshot.expected_DOS(home_team, away_team)
+		return {'home': home_team, 'away': away_team, 'home_power': snapshot.power_of(home_team), 'away_power': snapshot.power_of(away_team),
+			'DOS': e_DOS, 'ratio': (1 - e_DOS)/(1 + e_DOS)} # away_score = home_score * ratio
+
+	def expected_power(self, home_team, home_score, away_score):
+		snapshot = self.snapshot
+		return {'home': home_team, 'home_power': snapshot.power_of(home_team), 'opponent_power': snapshot.expected_power(home_team, home_score, away_score)}
+
+	def what_if(self, home_team, home_score, away_team, away_score):
+		# how the two teams' powers and ranks would move if this game were played, other teams held where they are
+		snapshot = self.snapshot
+		powers = snapshot.what_if([0, home_team, home_score, away_team, away_score])
+		active_powers = snapshot.power[snapshot.active_order]
+		result = {}
+		for team, power in powers.items():
+			if team in snapshot.index and snapshot.active[snapshot.index[team]]:
+				others = active_powers[active_powers != snapshot.power_of(team)]
+				new_rank = 1 + int((others > power).sum())
+				result[team] = {'power': snapshot.power_of(team), 'new_power': power, 'rank': snapshot.rank_of(team), 'new_rank': new_rank}
+			else:
+				old_power = snapshot.power_of(team) if team in snapshot.index else None
+				result[team] = {'power': old_power, 'new_power': power, 'rank': None, 'new_rank': None}
+		return result
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def _send(self, code, data):
+		body = json.dumps(data)
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		query = dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).items())
+		service = self.server.service
+		try:
+			if url.path == '/status':
+				result = service.status()
+			elif url.path == '/rank':
+				result = service.rank(query['team'])
+			elif url.path == '/top':
+				result = service.top(int(query.get('k', 10)), query.get('all', '0') in ('', '0'))
+			elif url.path == '/expected_result':
+				result = service.expected_result(query['home'], query['away'])
+			elif url.path == '/expected_power':
+				result = service.expected_power(query['home'], int(query['home_score']), int(query['away_score']))
+			elif url.path == '/what_if':
+				result = service.what_if(query['home'], int(query['home_score']), query['away'], int(query['away_score']))
+			else:
+				self._send(404, {'error': "Unknown query %s" %(url.path)})
+				return
+		except KeyError as error:
+			self._send(404, {'error': "Unknown team or missing parameter %s" %(error)})
+			return
+		except ValueError as error:
+			self._send(400, {'error': str(error)})
+			return
+		self._send(200, result)
+
+	def do_POST(self):
+		if self.path != '/games':
+			self._send(404, {'error': "Unknown query %s" %(self.path)})
+			return
+		try:
+			games = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+			self.server.service.add_games(games)
+		except (ValueError, IndexError, TypeError) as error:
+			self._send(400, {'error': str(error)})
+			return
+		self._send(202, {'queued': len(games)})
+
+	def log_message(self, format, *args):
+		pass
+
+class RankingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, service, port = 8642):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+		self.service = service
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve a ranking from a job file over a local JSON API")
+	parser.add_argument('job_file')
+	parser.add_argument('--job', help="name of the job to serve, the first job if not given")
+	parser.add_argument('--port', type=int, default=8642)
+	parser.add_argument('--follow', action='store_true', help="rank games as they are appended to the games file")
+	parser.add_argument('--debounce', type=float, default=5.0, help="seconds the games file must be quiet before new games are ranked")
+	parser.add_argument('--ingest', help="JSON list of result sources to watch, see ingest.load_sources")
+	parser.add_argument('--ingest-state', default='ingest_state.json', help="where the position reached in each source is kept")
+	args = parser.parse_args()
+
+	jobs = batch.load_jobs(args.job_file)
+	if args.job:
+		jobs = [job for job in jobs if job['name'] == args.job]
+		if not jobs:
+			sys.exit("No job called %s in %s" %(args.job, args.job_file))
+	job = jobs[0]
+	batch.load_stores([job])
+	cwd = os.getcwd()
+	if not os.path.isdir(job['directory']):
+		os.makedirs(job['directory'])
+	os.chdir(job['directory'])
+
+	def make_ranking():
+		batch.load_stores([job], reload=True)
+		return batch.make_ranking(job)
+
+	try:
+		service = RankingService(batch.make_ranking(job), make_ranking)
+	except RuntimeError as error:
+		sys.exit(str(error))
+	service.start()
+	if args.follow:
+		service.follow(job['games'], debounce=args.debounce)
+	pipeline = None
+	if args.ingest:
+		pipeline = IngestionPipeline(load_sources(os.path.join(cwd, args.ingest)), service, os.path.join(cwd, args.ingest_state))
+		store = batch.load_stores([job])[job['games']]
+		pipeline.mark_seen(store.row(i) for i in xrange(len(store)))
+		pipeline.start()
+	server = RankingServer(service, args.port)
+	print "Serving %s on http://127.0.0.1:%d" %(job['name'], args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if pipeline is not None:
+			pipeline.stop()
+		service.stop()
+
+if __name__ == "__main__":
+	main()
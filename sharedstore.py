@@ -0,0 +1,182 @@
+# Runs many ranking windows over worker processes without sending each worker the games
+# The game columns and the team registry of a gamestore.GameStore are copied once into shared memory when
+# the pool starts, and forked workers read them in place, so a task is only a small dict naming the window,
+# and a result is a few arrays keyed by the teams' places in the registry. A worker finds a window's games by
+# a binary search on a date sorted index, so a task costs the same however long the archive behind it is
+# Python 2 has no multiprocessing.shared_memory, the columns are multiprocessing.sharedctypes.RawArrays,
+# which a forked worker inherits rather than being sent
+#
+# store = GameStore('MRDAallgames.csv')
+# pool = RankingPool(store, processes=4)
+# results = pool.map([window(20170101, 20171231), window(20170101, 20171231, {'s': 150})]) a parameter sweep
+# results = pool.map([window(20170101, 20171231, seed=seed) for seed in range(200)])  bootstrap resamples
+# results = pool.map([window(20170101, 20171231, extra_games=[['20171230', 'Austin Anarchy', '150', 'Denver Ground Control', '120']])])
+# pool.close()
+#
+# Each result has 'teams' (registry indices, pool.team_names[i] is the name), 'power', 'rank' (0 for teams
+# that aren't ranked as active) and 'num_games' for every team with games in the window, and 'converged', 'error' and 'time'
+
+import time
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+import regression
+
+rankings = {
+	'regression': regression.Ranking,
+	'dynamic': regression.DynamicRanking,
+	'wftda': regression.WFTDARanking,
+}
+
+def window(start, end, params = None, seed = None, engine = 'regression', extra_games = None):
+	# a task for RankingPool.map
+	# params sets attributes on the ranking before it is solved, e.g. {'s': 150}
+	# seed solves a bootstrap resample of the window's games instead of the games themselves
+	# extra_games are rows in the clean format added to the window, between teams the store already has
+	return {'start': start, 'end': end, 'params': params or {}, 'seed': seed, 'engine': engine, 'extra_games': extra_games or []}
+
+def _shared(values, typecode, dtype):
+	raw = RawArray(typecode, max(len(values), 1)) # a RawArray can't be empty
+	np.ctypeslib.as_array(raw)[:len(values)] = np.asarray(values, dtype=dtype)
+	return raw
+
+class SharedGameStore:
+	# the columns of a GameStore in shared memory, read through numpy views that don't copy them
+	# it answers games(start, end) as a GameStore does, so a Ranking can load its window from it
+	def __init__(self, store):
+		self.num_games = len(store)
+		self._raw = {}
+		for name, values in store.columns().items():
+			self._raw[name] = _shared(values, 'l', np.int64)
+		self._raw['order'] = _shared(np.argsort(np.asarray(store.dates, dtype=np.int64), kind='mergesort'), 'l', np.int64)
+		# the registry as one block of names with the offset of each, a list of strings can't be shared
+		names = [np.frombuffer(name, dtype=np.uint8) for name in store.team_names]
+		self._raw['name_bytes'] = _shared(np.concatenate(names) if names else [], 'B', np.uint8)
+		self._raw['name_offsets'] = _shared(np.cumsum([0] + [len(name) for name in names]), 'l', np.int64)
+		self.columns = None
+		self.attach()
+
+	def attach(self):
+		# the views on the shared columns, made again in each worker as the pool starts
+		# Game objects are made as windows ask for them and kept, as a GameStore does, but only in this process
+		self.columns = dict((name, np.ctypeslib.as_array(raw)) for name, raw in self._raw.items())
+		self.sorted_dates = self.columns['date'][:self.num_games][self.columns['order'][:self.num_games]]
+		name_bytes = self.columns['name_bytes'].tostring()
+		offsets = self.columns['name_offsets']
+		self.team_names = [name_bytes[offsets[i]:offsets[i + 1]] for i in xrange(len(offsets) - 1)]
+		self.team_index = dict((name, i) for i, name in enumerate(self.team_names))
+		self._games = {}
+
+	def __len__(self):
+		return self.num_games
+
+	def rows(self, start = None, end = None):
+		# indices of the games played between start and end inclusive, in file order as GameStore.rows gives them
+		order = self.columns['order'][:self.num_games]
+		first = 0 if start is None else np.searchsorted(self.sorted_dates, _date_int(start), 'left')
+		last = self.num_games if end is None else np.searchsorted(self.sorted_dates, _date_int(end), 'right')
+		return np.sort(order[first:last]).tolist()
+
+	def row(self, i):
+		columns = self.columns
+		return [str(columns['date'][i]), self.team_names[columns['home_team'][i]], str(columns['home_score'][i]),
+			self.team_names[columns['away_team'][i]], str(columns['away_score'][i])]
+
+	def game(self, i):
+		if i not in self._games:
+			self._games[i] = regression.Game(self.row(i))
+		return self._games[i]
+
+	def games(self, start = None, end = None):
+		return [self.game(i) for i in self.rows(start, end)]
+
+def _date_int(date):
+	# YYYYMMDD as an integer from a date or YYYYMMDD
+	return date.year*10000 + date.month*100 + date.day if hasattr(date, 'year') else int(date)
+
+class _Window:
+	# the games a task ranks, for Ranking.load_games
+	def __init__(self, games):
+		self._games = games
+
+	def games(self, start, end):
+		return self._games
+
+_store = None # the SharedGameStore this worker reads, set by _start_worker
+_files = None # (hiatus_file, disbanded_file)
+
+def _start_worker(store, files):
+	global _store, _files
+	_store = store
+	_files = files
+	store.attach()
+
+def _run_task(task):
+	start_time = time.time()
+	result = {'teams': np.zeros(0, dtype=np.int32), 'power': np.zeros(0), 'rank': np.zeros(0, dtype=np.int32), 'num_games': np.zeros(0, dtype=np.int32),
+		'converged': False, 'error': None, 'time': 0.0}
+	try:
+		rows = _store.rows(regression.str2dt(task['start']), regression.str2dt(task['end']))
+		if task['seed'] is None:
+			games = [_store.game(i) for i in rows]
+		else:
+			# each draw is a new Game made from its row, Team.add_game counts a game object once however often it appears
+			# and copy.copy gives back the same Game
+			draws = np.random.RandomState(task['seed']).randint(0, len(rows), len(rows)) if rows else []
+			games = [regression.Game(_store.row(rows[i])) for i in draws]
+		for game_data in task['extra_games']:
+			if game_data[1] not in _store.team_index or game_data[3] not in _store.team_index:
+				raise ValueError("%s or %s is not in the games store" %(game_data[1], game_data[3]))
+			games.append(regression.Game(game_data))
+
+		hiatus_file, disbanded_file = _files
+		ranking = rankings[task['engine']](task['start'], task['end'], _Window(games), None, hiatus_file, disbanded_file)
+		for attribute, value in task['params'].items():
+			if not hasattr(ranking, attribute):
+				raise ValueError("%s has no setting %s" %(ranking.__class__.__name__, attribute))
+			setattr(ranking, attribute, value)
+		ranking.interactive = False
+		ranking.outputs = []
+		ranking.create_ranking()
+
+		teams = [ranking.teams[name] for name in ranking.fixed_order if ranking.teams[name].num_games != 0]
+		result['teams'] = np.array([_store.team_index[team.name] for team in teams], dtype=np.int32)
+		result['power'] = np.array([team.power for team in teams], dtype=float)
+		result['rank'] = np.array([team.rank or 0 for team in teams], dtype=np.int32)
+		result['num_games'] = np.array([team.num_games for team in teams], dtype=np.int32)
+		result['converged'] = ranking.diagnostics.converged()
+	except (regression.ConvergenceError, KeyError, ValueError, IndexError) as error:
+		result['error'] = "%s: %s" %(error.__class__.__name__, error)
+	result['time'] = time.time() - start_time
+	return result
+
+class RankingPool:
+	def __init__(self, store, processes = None, hiatus_file = None, disbanded_file = None):
+		# store is a gamestore.GameStore, copied into shared memory here and not read again
+		self.store = SharedGameStore(store)
+		self.team_names = self.store.team_names
+		self.files = (hiatus_file, disbanded_file)
+		self.processes = processes or multiprocessing.cpu_count()
+		self.pool = None
+		if self.processes > 1:
+			# the workers are forked with the store, so the shared columns are inherited and never pickled
+			self.pool = multiprocessing.Pool(self.processes, _start_worker, (self.store, self.files))
+
+	def map(self, tasks):
+		# the results in the order of the tasks
+		if self.pool is None:
+			if _store is not self.store:
+				_start_worker(self.store, self.files)
+			return [_run_task(task) for task in tasks]
+		return self.pool.map(_run_task, tasks, chunksize=max(1, len(tasks)//(4*self.processes)))
+
+	def powers(self, result):
+		# a result's powers as {team name: power}
+		return dict((self.team_names[i], power) for i, power in zip(result['teams'], result['power']))
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
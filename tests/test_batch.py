@@ -0,0 +1,50 @@
+# Checks jobs run over several processes and stacked jobs report what went wrong
+# python -m unittest discover tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batch
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RunJobsTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.teams_file = os.path.join(self.directory, 'teams.csv')
+		with open(self.teams_file, 'w') as teams_out:
+			teams_out.write("Austin Anarchy\n")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def jobs(self, jobs):
+		job_file = os.path.join(self.directory, 'jobs.json')
+		with open(job_file, 'w') as jfile:
+			json.dump({'defaults': {'games': os.path.join(data, 'clean_june_official.csv'), 'teams': 'teams.csv', 'outputs': []}, 'jobs': jobs}, jfile)
+		return batch.load_jobs(job_file)
+
+	def test_parallel_jobs_list_each_team_once(self):
+		jobs = self.jobs([{'start': 20170101, 'end': 20171231}, {'start': 20170601, 'end': 20180531}, {'start': 20180101, 'end': 20180630}])
+		summaries = batch.run_jobs(jobs, processes=3)
+		self.assertEqual([summary['error'] for summary in summaries], [None]*3)
+		with open(self.teams_file, 'r') as teams_in:
+			teams = [row.rstrip('\n') for row in teams_in]
+		self.assertEqual(len(teams), len(set(teams)))
+		self.assertEqual(teams[0], "Austin Anarchy")
+		games = batch._stores[jobs[0]['games']].games(batch.regression.str2dt('20170101'), batch.regression.str2dt('20180630'))
+		self.assertEqual(set(teams), set(["Austin Anarchy"] + [game.home_team for game in games] + [game.away_team for game in games]))
+
+	def test_stacked_job_reports_its_error(self):
+		jobs = self.jobs([{'start': 20170101, 'end': 20171231}, {'start': 20170101, 'end': 20171231, 'team_overrides': {'Austin Anarchy': {'min_game': 3}}}])
+		summaries = batch.run_jobs(jobs, stacked=True)
+		self.assertIsNone(summaries[0]['error'])
+		self.assertTrue(summaries[1]['error'].startswith("ValueError"))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,71 @@
+# Checks how the cleaner and gamestore.GameMeetings tell duplicates, double-headers and conflicts apart
+# python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gamestore import GameMeetings
+from clean_up import Cleaner
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class GameMeetingsTest(unittest.TestCase):
+	def test_other_side_listing_is_a_duplicate(self):
+		meetings = GameMeetings()
+		self.assertEqual(meetings.check(['20170423', 'A', '100', 'B', '50'], 'file'), 'new')
+		self.assertEqual(meetings.check(['20170423', 'B', '50', 'A', '100'], 'file'), 'duplicate')
+		self.assertEqual(len(meetings), 1)
+
+	def test_typo_on_one_side_is_a_conflict(self):
+		meetings = GameMeetings()
+		self.assertEqual(meetings.check(['20170423', 'A', '100', 'B', '50'], 'file'), 'new')
+		self.assertEqual(meetings.check(['20170423', 'B', '55', 'A', '100'], 'file'), 'conflict')
+		self.assertEqual(len(meetings), 1)
+
+	def test_double_header_from_both_sides(self):
+		meetings = GameMeetings()
+		rows = [['20170423', 'A', '232', 'B', '72'], ['20170423', 'A', '281', 'B', '81'], ['20170423', 'B', '72', 'A', '232'], ['20170423', 'B', '81', 'A', '281']]
+		self.assertEqual([meetings.check(row, 'file') for row in rows], ['new', 'new', 'duplicate', 'duplicate'])
+		self.assertEqual(len(meetings), 2)
+
+	def test_other_source_disagreeing_is_a_conflict(self):
+		meetings = GameMeetings()
+		meetings.check(['20170423', 'A', '100', 'B', '50'], 'first')
+		self.assertEqual(meetings.check(['20170423', 'A', '100', 'B', '60'], 'second'), 'conflict')
+		self.assertEqual(meetings.check(['20170423', 'A', '100', 'B', '50'], 'second'), 'duplicate')
+		self.assertEqual(len(meetings), 1)
+
+class CleanerTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_march_export_keeps_the_double_header(self):
+		rows = []
+		counts = Cleaner(rows.append).clean_file(os.path.join(data, 'march.csv'))
+		self.assertEqual(counts['conflict'], 0)
+		self.assertEqual(counts['kept'], len(rows))
+		self.assertEqual(counts['duplicate'], len(rows))
+		manchester = [row for row in rows if row[0] == '20170423' and set([row[1], row[3]]) == set(['Manchester Roller Derby', 'Manneken Beasts'])]
+		self.assertEqual(sorted(row[2] for row in manchester), ['232', '281'])
+
+	def test_merge_reports_a_disagreement_and_keeps_the_first(self):
+		files = []
+		for name, lines in [('first.csv', ["20170423,A,100,B,50", "20170430,A,90,C,80"]), ('second.csv', ["20170423,B,60,A,100", "20170430,C,80,A,90", "20170507,B,70,C,75"])]:
+			files.append(os.path.join(self.directory, name))
+			with open(files[-1], 'w') as games:
+				games.write("\n".join(lines) + "\n")
+		rows = []
+		first, second = Cleaner(rows.append).merge_files(files)
+		self.assertEqual((first['kept'], second['kept'], second['duplicate'], second['conflict']), (2, 1, 1, 1))
+		self.assertIn(['20170423', 'A', '100', 'B', '50'], rows)
+		self.assertEqual(len(rows), 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+# Checks IngestionPipeline keeps games a failing sink didn't take, and keeps its state file down to what the sink lacks
+# python -m unittest discover tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ingest
+
+class Sink:
+	def __init__(self):
+		self.games = []
+		self.failures = 0 # how many more calls raise
+
+	def add_games(self, rows):
+		if self.failures:
+			self.failures -= 1
+			raise IOError("the sink is down")
+		self.games.extend(rows)
+
+	def correct_games(self, rows):
+		self.add_games(rows)
+
+class IngestionPipelineTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.games_file = os.path.join(self.directory, 'games.csv')
+		self.state_file = os.path.join(self.directory, 'state.json')
+		self.sink = Sink()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def append(self, rows):
+		with open(self.games_file, 'a') as games_out:
+			games_out.write("".join(",".join(row) + "\n" for row in rows))
+
+	def pipeline(self):
+		source = ingest.CsvSource(self.games_file, 'games', layout='clean', date_order='ymd')
+		return ingest.IngestionPipeline([source], self.sink, self.state_file)
+
+	def state(self):
+		with open(self.state_file, 'r') as sfile:
+			return json.load(sfile)
+
+	def test_failed_batch_is_handed_over_again(self):
+		pipeline = self.pipeline()
+		self.append([['20180601', 'Austin Anarchy', '150', 'Denver Ground Control', '120']])
+		self.sink.failures = 1
+		pipeline.run_once()
+		self.assertEqual(self.sink.games, [])
+		self.assertTrue(pipeline.last_error.startswith("IOError"))
+		self.assertEqual(len(self.state()['undelivered']), 1)
+
+		# the next batch hands over both games, and so does a pipeline restarted from the state file
+		self.append([['20180602', 'Austin Anarchy', '110', 'Race City Rebels', '90']])
+		self.sink.failures = 1
+		pipeline.run_once()
+		pipeline = self.pipeline()
+		pipeline.run_once()
+		self.assertEqual(len(self.sink.games), 2)
+		self.assertIsNone(pipeline.last_error)
+		self.assertEqual(self.state()['undelivered'], [])
+		self.assertEqual(len(self.state()['games']), 2)
+
+	def test_games_the_sink_has_are_dropped_from_the_state(self):
+		rows = [['20180601', 'Austin Anarchy', '150', 'Denver Ground Control', '120'], ['20180602', 'Austin Anarchy', '110', 'Race City Rebels', '90']]
+		self.append(rows)
+		self.pipeline().run_once()
+		self.assertEqual(len(self.state()['games']), 2)
+
+		# after a restart the sink's own files have the first game, only the second is kept and handed over again
+		self.sink.games = []
+		pipeline = self.pipeline()
+		pipeline.mark_seen(rows[:1])
+		self.assertEqual(len(self.state()['games']), 1)
+		self.assertNotIn('seen', self.state())
+		pipeline.run_once()
+		self.assertEqual(self.sink.games, rows[1:])
+
+if __name__ == '__main__':
+	unittest.main()
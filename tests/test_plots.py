@@ -0,0 +1,49 @@
+# Checks PlotRenderer draws every team a plot of its own, whatever their names
+# python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import regression
+import plots
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class PlotRendererTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def ranking(self):
+		ranking = regression.Ranking(20171205, 20181205, os.path.join(data, 'clean_june_official.csv'), os.path.join(data, 'teams.csv'),
+			os.path.join(data, 'hiatus.csv'), os.path.join(data, 'disbanded.csv'))
+		ranking.interactive = False
+		ranking.outputs = []
+		ranking.create_ranking()
+		return ranking
+
+	def test_non_ascii_team(self):
+		ranking = self.ranking()
+		team = 'Derby Club le Cr\xc3\xa8s Lattes Montpellier' # as read from the utf-8 games file
+		self.assertIn(team, ranking.teams)
+		drawn = plots.PlotRenderer(self.directory, processes=1).render(ranking, [team])
+		self.assertEqual(len(drawn), 1)
+		self.assertTrue(os.path.exists(os.path.join(self.directory, drawn[0])))
+
+	def test_unchanged_plots_are_not_redrawn(self):
+		# the two Capital City teams share their first two words, each still needs a plot of its own
+		ranking = self.ranking()
+		teams = ['Capital City Derby Doods', 'Capital City Hooligans', 'Austin Anarchy']
+		renderer = plots.PlotRenderer(self.directory, processes=1)
+		self.assertEqual(len(set(renderer.render(ranking, teams))), 3)
+		self.assertEqual(renderer.render(ranking, teams), [])
+		self.assertEqual(len(renderer.skipped), 3)
+
+if __name__ == '__main__':
+	unittest.main()
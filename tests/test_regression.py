@@ -0,0 +1,131 @@
+# Pins the regression ranking to the powers the original fsolve gave for the march.py ranking,
+# and the stacked solve of many windows to the powers each window gets on its own
+# python -m unittest discover tests
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import regression
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# region 1 of python march.py before the solver changes, as printed to one decimal place
+march_powers = {
+	'St. Louis Gatekeepers': 1000.0,
+	'Bridgetown Roller Derby': 984.1,
+	'Roller Derby Toulouse': 945.0,
+	'Southern Discomfort': 933.9,
+	'Magic City Misfits': 914.0,
+	'Manchester Roller Derby': 912.9,
+	"Texas Men's Roller Derby": 911.1,
+	'Philadelphia Hooligans': 885.4,
+	'Vancouver Murder': 883.1,
+	'Lincolnshire Rolling Thunder': 870.5,
+	'Tyne and Fear Roller Derby': 845.4,
+	'Denver Ground Control': 843.8,
+	'New York Shock Exchange': 830.2,
+	'Austin Anarchy': 825.0,
+	"Quadfathers Men's Roller Derby": 801.1,
+	'Drive-By City Rollers': 788.3,
+	'Thunderquads Roller Derby Masculino': 784.9,
+	'San Diego Aftershocks': 783.6,
+	'Puget Sound Outcast Derby': 772.8,
+	"Your Mom Men's Derby": 762.7,
+	"Montreal Men's Roller Derby": 760.8,
+	'Mass Maelstrom': 759.4,
+	'Race City Rebels': 758.8,
+	"Toronto Men's Roller Derby": 755.7,
+	'Panam Squad': 750.9,
+	"Minnesota Men's Roller Derby": 743.7,
+	'Derby Club le Cr\xc3\xa8s Lattes Montpellier': 739.6,
+	'Manneken Beasts': 739.4,
+	'Lane County Concussion': 720.2,
+	'Barrow Infernos': 715.0,
+	'Granite City Brawlers': 709.4,
+	"Oklahoma Men's Roller Derby": 706.2,
+	"Glasgow Men's Roller Derby": 704.1,
+	'South Wales Silures': 681.8,
+	"Tampere Rollin' Bros": 674.4,
+	'Chicago Bruise Brothers': 669.2,
+	'Glenmore Reservoir Dogs': 657.4,
+	'Crash Test Brummies': 656.7,
+	'Wheels of Mayhem': 640.6,
+	'Capital City Derby Doods': 625.5,
+	'Super Smash Brollers': 620.9,
+	'Carolina Wreckingballs': 619.9,
+	'West Swedish Roller Derby Society': 582.1,
+	"Collision Men's Derby": 577.6,
+	"Wisconsin Men's Roller Derby": 561.4,
+	'Pittsburgh Blue Streaks': 559.5,
+	"Casco Bay Gentlemen's Derby": 559.5,
+	"Houston Men's Roller Derby": 554.1,
+	"Atlanta Men's Roller Derby": 543.2,
+	"Cleveland Men's Roller Derby": 514.0,
+	"Harm City Men's Derby": 506.7,
+	"Dakota Men's Roller Derby": 505.6,
+	"Flour City Fear Men's Roller Derby": 502.6,
+	'Cincinnati Battering Rams': 485.5,
+	"Detroit Men's Roller Derby": 461.7,
+	'Capital City Hooligans': 413.5,
+}
+
+def march_ranking():
+	ranking = regression.Ranking(20171205, 20181205, os.path.join(data, 'clean_june_official.csv'), os.path.join(data, 'teams.csv'),
+		os.path.join(data, 'hiatus.csv'), os.path.join(data, 'disbanded.csv'))
+	ranking.teams["Thunderquads Roller Derby Masculino"].min_games_required = 3
+	ranking.interactive = False
+	ranking.outputs = []
+	return ranking
+
+class MarchRankingTest(unittest.TestCase):
+	def test_powers_match_baseline(self):
+		ranking = march_ranking()
+		ranking.create_ranking()
+		for team, power in march_powers.items():
+			self.assertAlmostEqual(ranking.teams[team].power, power, delta=0.06, msg=team)
+
+	def test_far_start_returns_to_minimum(self):
+		# a team started so far out that all its games are flat on the tanh curve is refitted from level powers
+		ranking = march_ranking()
+		ranking.create_ranking()
+		home, away, DOS, weights = ranking._regression_arrays()
+		index = dict((team, i) for i, team in enumerate(ranking.fixed_order))
+		x0 = np.array([ranking.teams[team].power for team in ranking.fixed_order], dtype=float)
+		region = sorted(set(index[team] for team in march_powers))
+		local = dict((team, i) for i, team in enumerate(region))
+		games = [g for g in xrange(len(home)) if home[g] in local and away[g] in local]
+		block_home = np.array([local[home[g]] for g in games])
+		block_away = np.array([local[away[g]] for g in games])
+		start = x0[region]
+		start[local[index['Capital City Derby Doods']]] -= 1e5
+		x, evaluations, jacobians, gradient_norm, status, message, wall_time = regression._solve_region(
+			(block_home, block_away, DOS[games], weights[games], start, ranking.s))
+		self.assertEqual(status, 1, message)
+		difference = x[local[index['Capital City Derby Doods']]] - x[local[index["Toronto Men's Roller Derby"]]]
+		self.assertAlmostEqual(difference, march_powers['Capital City Derby Doods'] - march_powers["Toronto Men's Roller Derby"], delta=0.11)
+
+class StackedSolveTest(unittest.TestCase):
+	def test_stacked_powers_match_single_solves(self):
+		# the windows ending in the first half of 2016 are the ones the stacked solve once gave up on
+		import gamestore
+		store = gamestore.GameStore(os.path.join(data, 'MRDAallgames.csv'))
+		ends = [20160101, 20160301, 20160501, 20160601, 20170501, 20171201]
+		def window(end):
+			ranking = regression.Ranking(end - 10000, end, store, None)
+			ranking.interactive = False
+			ranking.outputs = []
+			return ranking
+		stacked = [window(end) for end in ends]
+		regression.solve_rankings(stacked)
+		for end, ranking in zip(ends, stacked):
+			ranking.create_ranking(solve=False)
+			single = window(end)
+			single.create_ranking()
+			for team in single.ranked_list_active:
+				self.assertAlmostEqual(ranking.teams[team.name].power, team.power, delta=1e-3, msg="%s %s" %(end, team.name))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,44 @@
+# Checks SeasonPipeline ranks every season it returns, whether or not earlier seasons come from the cache
+# python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import OOranking
+
+games_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MRDAallgames.csv')
+
+def powers(season):
+	return dict((name, (team.power, team.num_games, len(team.opponents))) for name, team in season.teams.items())
+
+class SeasonPipelineTest(unittest.TestCase):
+	def setUp(self):
+		self.cache_directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_directory)
+
+	def test_single_season_is_ranked(self):
+		pipeline = OOranking.SeasonPipeline([(2016, games_file)], self.cache_directory)
+		season = pipeline.run()
+		self.assertTrue(season.teams)
+		self.assertTrue(all(team.power is not None for team in season.teams.values()))
+
+	def test_cached_season_matches_replayed(self):
+		seasons = [(2016, games_file), (2017, games_file)]
+		pipeline = OOranking.SeasonPipeline(seasons, self.cache_directory)
+		replayed = powers(pipeline.run())
+		replayed_2016 = powers(pipeline.season_list[2016])
+		self.assertEqual(pipeline.replayed, [2016, 2017])
+
+		pipeline = OOranking.SeasonPipeline(seasons, self.cache_directory)
+		self.assertEqual(powers(pipeline.run()), replayed)
+		self.assertEqual(pipeline.replayed, [2017])
+		self.assertEqual(powers(pipeline.season_list[2016]), replayed_2016)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,65 @@
+# Runs the ranking service on an ephemeral localhost port and talks to it over HTTP
+# python -m unittest discover tests
+
+import os
+import sys
+import json
+import time
+import urllib
+import urllib2
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import regression
+import service
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RankingServiceTest(unittest.TestCase):
+	def setUp(self):
+		ranking = regression.Ranking(20171205, 20181205, os.path.join(data, 'clean_june_official.csv'), os.path.join(data, 'teams.csv'),
+			os.path.join(data, 'hiatus.csv'), os.path.join(data, 'disbanded.csv'))
+		self.service = service.RankingService(ranking)
+		self.service.start()
+		self.server = service.RankingServer(self.service, 0) # port 0 lets the system pick a free port
+		self.url = "http://127.0.0.1:%d" %(self.server.server_address[1])
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.service.stop()
+
+	def get(self, path, **query):
+		return json.load(urllib2.urlopen(self.url + path + "?" + urllib.urlencode(query)))
+
+	def test_add_query_and_what_if(self):
+		before = self.get('/rank', team='Austin Anarchy')
+		request = urllib2.Request(self.url + '/games', json.dumps([['20181201', 'Austin Anarchy', '200', 'Denver Ground Control', '180']]))
+		self.assertEqual(json.load(urllib2.urlopen(request)), {'queued': 1})
+		deadline = time.time() + 30
+		while self.get('/status')['solves'] < 2 and time.time() < deadline:
+			time.sleep(0.1)
+		status = self.get('/status')
+		self.assertEqual(status['solves'], 2)
+		self.assertIsNone(status['last_error'])
+		self.assertTrue(status['converged'])
+		after = self.get('/rank', team='Austin Anarchy')
+		self.assertEqual(after['games'], before['games'] + 1)
+
+		what_if = self.get('/what_if', home='Austin Anarchy', home_score=250, away='Denver Ground Control', away_score=100)
+		self.assertGreater(what_if['Austin Anarchy']['new_power'], what_if['Austin Anarchy']['power'])
+		self.assertLess(what_if['Denver Ground Control']['new_power'], what_if['Denver Ground Control']['power'])
+
+	def test_bad_queries_are_rejected(self):
+		for path, query in [('/what_if', {'home': 'Austin Anarchy', 'home_score': 0, 'away': 'Denver Ground Control', 'away_score': 0}),
+			('/rank', {'team': 'No Such Team'})]:
+			with self.assertRaises(urllib2.HTTPError) as caught:
+				self.get(path, **query)
+			self.assertIn(caught.exception.code, (400, 404))
+
+if __name__ == '__main__':
+	unittest.main()
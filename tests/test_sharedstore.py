@@ -0,0 +1,31 @@
+# Checks the windows RankingPool solves in its workers
+# python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gamestore
+import sharedstore
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RankingPoolTest(unittest.TestCase):
+	def setUp(self):
+		self.store = gamestore.GameStore(os.path.join(data, 'clean_june_official.csv'))
+		self.pool = sharedstore.RankingPool(self.store, processes=1)
+
+	def tearDown(self):
+		self.pool.close()
+
+	def test_resample_counts_every_draw(self):
+		# a game drawn more than once has to count each time, so the teams' games add up to twice the window's games
+		num_games = len(self.store.rows(20170701, 20180630))
+		plain, resample = self.pool.map([sharedstore.window(20170701, 20180630), sharedstore.window(20170701, 20180630, seed=3)])
+		self.assertIsNone(resample['error'])
+		self.assertEqual(plain['num_games'].sum(), 2*num_games)
+		self.assertEqual(resample['num_games'].sum(), 2*num_games)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+# Checks the strength factors and ranking points WFTDARanking.calculate finds
+# python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import regression
+import gamestore
+
+data = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def ranking(start, end, games):
+	ranking = regression.WFTDARanking(start, end, games)
+	ranking.interactive = False
+	ranking.outputs = []
+	return ranking
+
+class CalculateTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def games_file(self, rows):
+		games_file = os.path.join(self.directory, 'games.csv')
+		with open(games_file, 'w') as games_out:
+			games_out.write("".join(",".join(row) + "\n" for row in rows))
+		return games_file
+
+	def test_two_teams(self):
+		# 150-50 gives WL factors of 2.25 and 0.75, the strength factors are then in the ratio sqrt(2.25/0.75) and average 1
+		wftda = ranking(20180101, 20180630, self.games_file([['20180601', 'Home', '150', 'Away', '50']]))
+		points = dict(zip(wftda.fixed_order, wftda.calculate()))
+		strength = wftda.strength_factors
+		self.assertAlmostEqual(strength['Home']/strength['Away'], np.sqrt(3))
+		self.assertAlmostEqual(strength['Home'] + strength['Away'], 2)
+		self.assertAlmostEqual(points['Home'], 225*strength['Away'])
+		self.assertAlmostEqual(points['Away'], 75*strength['Home'])
+		self.assertEqual([round(game_points, 6) for game, game_points in wftda.teams['Home'].game_points], [round(points['Home'], 6)])
+		self.assertTrue(wftda.diagnostics.converged())
+
+	def test_regions_are_scaled_apart(self):
+		# teams that never meet each other's region have their strength factors average 1 within their own region
+		wftda = ranking(20180101, 20180630, self.games_file([['20180601', 'A', '150', 'B', '50'], ['20180602', 'B', '120', 'C', '100'],
+			['20180603', 'D', '90', 'E', '200']]))
+		wftda.calculate()
+		strength = wftda.strength_factors
+		self.assertAlmostEqual(strength['A'] + strength['B'] + strength['C'], 3)
+		self.assertAlmostEqual(strength['D'] + strength['E'], 2)
+
+	def test_matches_the_iteration(self):
+		# the eigenvector is the limit of recomputing the strength factors from the ranking points until they settle
+		store = gamestore.GameStore(os.path.join(data, 'clean_june_official.csv'))
+		wftda = ranking(20170701, 20180630, store)
+		ranking_points = wftda.calculate()
+		games, home, away, WL_home, WL_away, weight = wftda._game_arrays()
+		num_teams = len(wftda.fixed_order)
+		weight_total = np.bincount(home, weight, num_teams) + np.bincount(away, weight, num_teams)
+		played = np.flatnonzero(weight_total > 0)
+		weight_total[weight_total == 0] = 1
+		region = dict((team, r) for r, teams in enumerate(wftda.region_list) for team in teams)
+		members = [np.array([i for i in played if region[wftda.fixed_order[i]] == r]) for r in xrange(len(wftda.region_list))]
+
+		strength = np.ones(num_teams)
+		for iteration in xrange(20000):
+			points = (np.bincount(home, 100*weight*WL_home*strength[away], num_teams) + np.bincount(away, 100*weight*WL_away*strength[home], num_teams))/weight_total
+			# half of the old factors are kept, a region with two teams would otherwise swap them back and forth
+			new_strength = strength.copy()
+			for teams in members:
+				new_strength[teams] = (strength[teams] + points[teams]/points[teams].mean())/2
+			if np.abs(new_strength - strength).max() < 1e-12:
+				break
+			strength = new_strength
+
+		for i in played:
+			self.assertAlmostEqual(wftda.strength_factors[wftda.fixed_order[i]], strength[i], places=6)
+			self.assertAlmostEqual(ranking_points[i], points[i], places=4)
+
+if __name__ == '__main__':
+	unittest.main()